@@ -10,6 +10,9 @@ import importlib
 import traceback
 
 import irc.client
+import irc.dispatch
+import irc.outbound
+import irc.ratelimit
 
 from aiotwirc.stdio import async_readlines
 
@@ -25,6 +28,8 @@ BASE_CONFIG = dict(
     CAPS='twitch.tv/tags twitch.tv/commands twitch.tv/membership',
     CHANNELS=(),
     PLUGINS='hostnotify ping sub highlight log say'.split(),
+    # 'user', 'moderator' or 'verified'; see irc.ratelimit.TWITCH
+    RATE_LIMITS='user',
 )
 
 
@@ -61,10 +66,15 @@ class Client:
         if args.channel:
             self.config.CHANNELS = args.channel
         self.loop = loop
+        self.subhandlers = {}
+        self._dispatch_table = {}
         self.connection = irc.client.ServerConnection(
-            self.event_handler, loop=loop)
+            self.event_handler, loop=loop, handler_wants=self.wants_event,
+            event_queue=irc.dispatch.EventQueue(),
+            rate_limits=irc.ratelimit.TWITCH[config.RATE_LIMITS],
+            # Keep room in the rate limits for what the user types
+            lane_reserves={irc.outbound.BULK: 2})
         self.welcomed = asyncio.Event()
-        self.subhandlers = {}
         self.intentional_disconnect = False
 
     async def connect(self):
@@ -73,6 +83,7 @@ class Client:
         for m in self.config.PLUGINS:
             if m not in self.subhandlers:
                 self.subhandlers[m] = await self.load_subhandler(m)
+                self._dispatch_table.clear()
         if 'say' not in self.subhandlers:
             print("Remember to /load say")
         if self.config.USERNAME:
@@ -85,8 +96,39 @@ class Client:
             self.config.SERVER, self.config.PORT, username, password,
             caps=self.config.CAPS)
         await self.welcomed.wait()
-        for c in self.config.CHANNELS:
-            await self.connection.join('#'+c)
+        joins = await self.connection.join_many(
+            ['#'+c for c in self.config.CHANNELS])
+        self.loop.create_task(self.report_joins(joins))
+
+    async def reconnect(self):
+        """
+        Reconnect, keeping loaded plugins, and rejoin the channels we
+        were in along with the configured ones.
+        """
+        self.welcomed.clear()
+        self.intentional_disconnect = False
+        joins = await self.connection.reconnect(
+            ['#'+c for c in self.config.CHANNELS], timeout=30)
+        self.loop.create_task(self.report_joins(joins))
+
+    async def report_joins(self, joins):
+        if not joins:
+            return
+        # asyncio.wait() leaves the futures alone on timeout; they are
+        # shared with the connection, which still resolves them later
+        done, pending = await asyncio.wait(joins.values(), timeout=30)
+        for channel, joined in joins.items():
+            if joined in pending:
+                print("No reply to JOIN %s" % channel)
+            elif joined.cancelled():
+                continue
+            elif joined.exception() is not None:
+                print("Could not join %s: %s" %
+                      (channel, joined.exception().args[-1]))
+        rejoined = self.connection.timings.get('rejoined')
+        if rejoined is not None:
+            print("Rejoined %s channels in %.1f seconds" %
+                  (len(joins), rejoined))
 
     async def handle_stdin(self):
         self.readlines = async_readlines(self.loop)
@@ -119,21 +161,46 @@ class Client:
             self.readlines.set_buffer(msg)
             self.last_buffer_set = msg
 
-    async def event_handler(self, connection, event):
-        if event.type == 'all_raw_messages':
-            return
+    def handlers_for(self, event_type):
+        """
+        The handle_<event_type> methods of the client and its plugins.
+
+        The lookup happens once per event type; the result is kept until
+        a plugin is loaded or unloaded. A plugin that only cares about
+        some event types can list them in an `event_types` attribute,
+        and is then not asked about any other type.
+        """
+        try:
+            return self._dispatch_table[event_type]
+        except KeyError:
+            pass
+        methods = []
         for handler in [self] + list(self.subhandlers.values()):
+            wanted = getattr(handler, 'event_types', None)
+            if wanted is not None and event_type not in wanted:
+                continue
             try:
-                method = getattr(handler, 'handle_' + event.type)
+                methods.append(getattr(handler, 'handle_' + event_type))
             except AttributeError:
                 continue
+        self._dispatch_table[event_type] = methods
+        return methods
+
+    def wants_event(self, event_type):
+        "Whether the client or any plugin handles this event type"
+        return (event_type != 'all_raw_messages' and
+                bool(self.handlers_for(event_type)))
+
+    async def event_handler(self, connection, event):
+        for method in self.handlers_for(event.type):
             try:
                 await method(connection, event)
             except Exception:
+                handler = method.__self__
                 print('Exception in %s.%s.%s' %
                       (handler.__class__.__module__,
                        handler.__class__.__name__,
-                       getattr(handler, '__name__')))
+                       method.__name__))
                 traceback.print_exc()
 
     async def handle_welcome(self, connection, event):
@@ -151,6 +218,7 @@ class Client:
             except HandlerImportError as exn:
                 print(exn)
             else:
+                self._dispatch_table.clear()
                 try:
                     on_reload = r.reload
                 except AttributeError:
@@ -198,6 +266,7 @@ class Client:
             except KeyError:
                 print('Module %s not loaded' % m)
                 continue
+            self._dispatch_table.clear()
             try:
                 on_unload = r.unload
             except AttributeError:
@@ -244,7 +313,8 @@ class Client:
             print('Invalid method %r' % method)
             return
         try:
-            res = await fn()
+            with self.connection.lane(irc.outbound.INTERACTIVE):
+                res = await fn()
         except Exception:
             traceback.print_exc()
         else:
@@ -274,9 +344,9 @@ async def main_async(loop, config, args):
     delay = 0
     client = Client(config, loop, args)
     try:
+        await client.connect()
+        task = loop.create_task(client.handle_stdin())
         while True:
-            await client.connect()
-            task = loop.create_task(client.handle_stdin())
             t1 = time.time()
             await client.connection.wait_disconnected()
             t2 = time.time()
@@ -290,6 +360,11 @@ async def main_async(loop, config, args):
             else:
                 print("We were disconnected. Try again.")
                 delay = 0
+            try:
+                await client.reconnect()
+            except irc.client.ServerConnectionError as exn:
+                print(exn)
+                await client.connection.disconnect()
     finally:
         try:
             client.readlines.close()
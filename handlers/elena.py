@@ -47,7 +47,7 @@ class Handler:
         await connection.privmsg(target, msg)
 
     async def handle_pubmsg(self, connection, event):
-        name = event.source.split('!')[0]
+        name = event.source.nick
         if not name.startswith('elena'):
             return
         if not self.should_post(event.args, event.target):
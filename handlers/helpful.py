@@ -127,11 +127,7 @@ class Handler:
                 return command
 
     async def handle_pubmsg(self, connection, event):
-        tags = {
-            k: v
-            for kv in (event.tags or ())
-            for k, v in [(kv['key'], kv['value'])]
-        }
+        tags = event.tags
         name = tags.get('display-name') or event.source.nick
         if name == 'dbSRL':
             return
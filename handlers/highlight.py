@@ -10,5 +10,5 @@ class Handler:
     async def handle_pubmsg(self, connection, event):
         if re.search(self.pattern, event.args):
             create_and_show_notification(
-                'From %s in %s' % (event.source.split('!')[0], event.target),
+                'From %s in %s' % (event.source.nick, event.target),
                 event.args, key='highlight')
@@ -68,7 +68,6 @@ class Handler:
 
     async def handle_pubnotice(self, connection, event):
         hosting_channel = event.target.lstrip('#')
-        msg_id = next((o['value'] for o in event.tags if o['key'] == 'msg-id'),
-                      None)
+        msg_id = event.tags.get('msg-id')
         if msg_id in ('host_on', 'host_off', 'host_target_went_offline'):
             self.host_mode[hosting_channel] = msg_id
@@ -111,6 +111,15 @@ def adorn_message(message, tags, highlight):
 
 
 class Handler:
+    # The Twitch events worth logging. Other types are not listened for,
+    # so the client can skip the ones no plugin wants.
+    event_types = frozenset([
+        'pubmsg', 'usernotice', 'join', 'part', 'ping', 'userstate',
+        'clearchat', 'clearmsg', 'roomstate', 'hosttarget', 'notice',
+        'pubnotice', 'privnotice', 'whisper', 'globaluserstate', 'reconnect',
+        'privmsg', 'ctcp', 'action', 'mode', 'umode',
+    ])
+
     def __init__(self):
         self.messages = open('messages.txt', 'a')
         self.events = open('events.txt', 'a')
@@ -188,11 +197,7 @@ class Handler:
         print(f'[{s}] {message}')
 
     def print_message(self, event):
-        tags = {
-            k: v
-            for kv in (event.tags or ())
-            for k, v in [(kv['key'], kv['value'])]
-        }
+        tags = event.tags
         name = tags.get('display-name') or event.source.nick
         try:
             self.recent_chatters.remove(name)
@@ -245,6 +250,12 @@ class Handler:
     async def _handle_event(self, connection, event):
         self.print_event(event)
 
+    handle_clearmsg = handle_roomstate = handle_hosttarget = _handle_event
+    handle_notice = handle_pubnotice = handle_privnotice = _handle_event
+    handle_whisper = handle_globaluserstate = handle_reconnect = _handle_event
+    handle_privmsg = handle_ctcp = handle_action = _handle_event
+    handle_mode = handle_umode = _handle_event
+
     async def handle_join(self, connection, event):
         self.joinparts.append(event)
         t = self._delayed_print_joinpart_task
@@ -262,18 +273,9 @@ class Handler:
         pass
 
     async def handle_clearchat(self, connection, event):
-        tags = {
-            k: v
-            for kv in (event.tags or ())
-            for k, v in [(kv['key'], kv['value'])]
-        }
+        tags = event.tags
         duration = tags.get('ban-duration')
         message = 'Timeout %s for %s second%s' % (
             event.args, duration, '' if duration == '1' else 's')
         self.log_custom_event('timeout', message, event.target, 'clearchat',
                               event)
-
-    def __getattr__(self, key):
-        if key.startswith('handle_'):
-            return self._handle_event
-        raise AttributeError(key)
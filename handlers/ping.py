@@ -5,6 +5,13 @@ import traceback
 
 
 class Handler:
+    # Events that show the connection is alive. Other types are not
+    # listened for, so the client can skip the ones no plugin wants.
+    event_types = frozenset([
+        'ping', 'pong', 'pubmsg', 'usernotice', 'join', 'part',
+        'userstate', 'roomstate',
+    ])
+
     async def handle_ping(self, connection, event):
         await self._handle_any(connection, event)
         await connection.pong(event.args)
@@ -12,10 +19,8 @@ class Handler:
     async def _handle_any(self, connection, event):
         self._last_event = time.time()
 
-    def __getattr__(self, key):
-        if key.startswith('handle_'):
-            return self._handle_any
-        raise AttributeError(key)
+    handle_pubmsg = handle_usernotice = _handle_any
+    handle_join = handle_part = handle_userstate = handle_roomstate = _handle_any
 
     async def command_pingevery(self, client, args, showhide):
         showhide.show()
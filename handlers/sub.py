@@ -1,7 +1,5 @@
 import time
 import random
-import asyncio
-import traceback
 
 
 MSGS = (
@@ -26,12 +24,6 @@ try:
 except NameError:
     last_msg = None
 
-try:
-    repost_mutex
-except NameError:
-    repost_mutex = asyncio.Lock()
-
-
 def get_next_msg():
     global last_msg
     msg = random.choice(MSGS)
@@ -67,7 +59,7 @@ class Handler:
         await connection.privmsg(target, msg)
 
     async def handle_pubmsg(self, connection, event):
-        name = event.source.split('!')[0]
+        name = event.source.nick
         if name != 'twitchnotify':
             return
         if not self.should_post(event.args, event.target):
@@ -75,27 +67,20 @@ class Handler:
         await self.post(connection, event.target)
 
     async def handle_usernotice(self, connection, event):
-        tags = {
-            k: v
-            for kv in (event.tags or ())
-            for k, v in [(kv['key'], kv['value'])]
-        }
+        tags = event.tags
         system_msg = tags.get('system-msg') or ''
         if not self.should_post(system_msg, event.target):
             return
         await self.post(connection, event.target)
 
     async def handle_pubnotice(self, connection, event):
-        tags = {
-            k: v
-            for kv in (event.tags or ())
-            for k, v in [(kv['key'], kv['value'])]
-        }
+        tags = event.tags
         if tags.get('msg-id') == 'msg_ratelimit':
-            self.msg_ratelimit(connection, event.target)
+            await self.msg_ratelimit(connection, event.target)
 
-    def msg_ratelimit(self, connection, target):
-        loop = connection.loop
+    async def msg_ratelimit(self, connection, target):
+        # Only happens if the rate limits are set too high, or another
+        # client shares the account: back off and queue the message again.
         try:
             last_msg, last_msg_time = self.last_msg[target]
         except KeyError:
@@ -103,15 +88,7 @@ class Handler:
         elapsed = time.time() - last_msg_time
         if elapsed > 1:
             return
-        loop.create_task(self.repost(connection, last_msg))
-
-    async def repost(self, connection, target, msg):
-        try:
-            await repost_mutex.acquire()
-            await asyncio.sleep(1)
-            print("Repost message to %s: %r" % (target, msg))
-            await connection.privmsg(target, msg)
-        except Exception:
-            traceback.print_exc()
-        finally:
-            repost_mutex.release()
+        if connection.rate_limiter:
+            connection.rate_limiter.throttle(target)
+        print("Repost message to %s: %r" % (target, last_msg))
+        await connection.privmsg(target, last_msg)
@@ -20,6 +20,7 @@ import six
 import irc.client
 import irc.modes
 from .dict import IRCDict
+from .strings import IRCFoldedCase
 
 class ServerSpec(object):
     """
@@ -112,7 +113,9 @@ class SingleServerIRCBot(irc.client.SimpleIRCClient):
     The bot keeps track of the channels it has joined, the other
     clients that are present in the channels and which of those that
     have operator or voice modes.  The "database" is kept in the
-    self.channels attribute, which is an IRCDict of Channels.
+    self.channels attribute, which is an IRCDict of Channels, along
+    with an index of the channels each nick is in (see
+    channels_of), so that QUIT and NICK only touch those channels.
 
     Arguments:
 
@@ -140,6 +143,7 @@ class SingleServerIRCBot(irc.client.SimpleIRCClient):
         super(SingleServerIRCBot, self).__init__()
         self.__connect_params = connect_params
         self.channels = IRCDict()
+        self._nick_channels = IRCDict()
         self.server_list = [
             ServerSpec(*server)
                 if isinstance(server, (tuple, list))
@@ -166,19 +170,49 @@ class SingleServerIRCBot(irc.client.SimpleIRCClient):
 
     def _connect(self):
         """
-        Establish a connection to the server at the front of the server_list.
+        Start connecting to the server at the front of the server_list,
+        in a task on the connection's loop. Returns the task.
         """
-        server = self.server_list[0]
+        return self.connection.loop.create_task(
+            self._connect_to(self.server_list[0]))
+
+    async def _connect_to(self, server):
         try:
-            self.connect(server.host, server.port, self._nickname,
+            await self.connect(server.host, server.port, self._nickname,
                 server.password, ircname=self._realname,
                 **self.__connect_params)
             self.connection_attempts = 1
         except irc.client.ServerConnectionError:
             pass
 
+    def channels_of(self, nick):
+        """
+        The names of the channels we share with `nick`, as an unsorted
+        set; do not modify it.
+        """
+        return self._nick_channels.get(nick, frozenset())
+
+    def _add_user(self, channel, nick):
+        self.channels[channel].add_user(nick)
+        self._nick_channels.setdefault(nick, set()).add(
+            IRCFoldedCase(channel))
+
+    def _remove_user(self, channel, nick):
+        self.channels[channel].remove_user(nick)
+        channels = self._nick_channels.get(nick)
+        if channels is not None:
+            channels.discard(IRCFoldedCase(channel))
+            if not channels:
+                del self._nick_channels[nick]
+
+    def _leave(self, channel):
+        for nick in list(self.channels[channel].users()):
+            self._remove_user(channel, nick)
+        del self.channels[channel]
+
     def _on_disconnect(self, c, e):
         self.channels = IRCDict()
+        self._nick_channels = IRCDict()
         self.recon.run(self)
 
     def _on_join(self, c, e):
@@ -186,16 +220,16 @@ class SingleServerIRCBot(irc.client.SimpleIRCClient):
         nick = e.source.nick
         if nick == c.get_nickname():
             self.channels[ch] = Channel()
-        self.channels[ch].add_user(nick)
+        self._add_user(ch, nick)
 
     def _on_kick(self, c, e):
         nick = e.arguments[0]
         channel = e.target
 
         if nick == c.get_nickname():
-            del self.channels[channel]
+            self._leave(channel)
         else:
-            self.channels[channel].remove_user(nick)
+            self._remove_user(channel, nick)
 
     def _on_mode(self, c, e):
         t = e.target
@@ -235,29 +269,31 @@ class SingleServerIRCBot(irc.client.SimpleIRCClient):
             for mode in nick_modes:
                 self.channels[channel].set_mode(mode, nick)
 
-            self.channels[channel].add_user(nick)
+            self._add_user(channel, nick)
 
     def _on_nick(self, c, e):
         before = e.source.nick
         after = e.target
-        for ch in self.channels.values():
-            if ch.has_user(before):
-                ch.change_nick(before, after)
+        channels = self._nick_channels.pop(before, None)
+        if channels is None:
+            return
+        for ch in channels:
+            self.channels[ch].change_nick(before, after)
+        self._nick_channels[after] = channels
 
     def _on_part(self, c, e):
         nick = e.source.nick
         channel = e.target
 
         if nick == c.get_nickname():
-            del self.channels[channel]
+            self._leave(channel)
         else:
-            self.channels[channel].remove_user(nick)
+            self._remove_user(channel, nick)
 
     def _on_quit(self, c, e):
         nick = e.source.nick
-        for ch in self.channels.values():
-            if ch.has_user(nick):
-                ch.remove_user(nick)
+        for ch in self._nick_channels.pop(nick, ()):
+            self.channels[ch].remove_user(nick)
 
     def die(self, msg="Bye, cruel world!"):
         """Let the bot die.
@@ -0,0 +1,98 @@
+"""
+Client side of IRCv3 capability negotiation
+(https://ircv3.net/specs/extensions/capability-negotiation).
+"""
+
+from __future__ import absolute_import
+
+
+class Negotiation(object):
+    """
+    Capability negotiation for one connection, pipelined with
+    registration: ``CAP LS 302`` and ``CAP REQ`` go out together with
+    PASS, NICK and USER, and ``CAP END`` as soon as the server has
+    answered for every requested capability, so negotiation costs no
+    extra round trips.
+
+    >>> negotiation = Negotiation(['multi-prefix', 'sasl'])
+    >>> negotiation.start()
+    ['CAP LS 302', 'CAP REQ :multi-prefix sasl']
+    >>> negotiation.handle(['*', 'LS', '*', 'multi-prefix sasl=PLAIN'])
+    []
+    >>> negotiation.handle(['*', 'LS', 'away-notify'])
+    []
+    >>> negotiation.available['sasl']
+    'PLAIN'
+    >>> negotiation.handle(['*', 'ACK', '*', 'multi-prefix'])
+    []
+    >>> negotiation.handle(['*', 'ACK', 'sasl'])
+    ['CAP END']
+    >>> sorted(negotiation.enabled)
+    ['multi-prefix', 'sasl']
+    >>> negotiation.done
+    True
+    """
+    def __init__(self, wanted=()):
+        self.wanted = list(wanted)
+        self.available = {}
+        self.enabled = set()
+        self.rejected = set()
+        self.unanswered = set()
+        "Requested capabilities the server has not ACKed or NAKed yet"
+        self.state = 'idle'
+
+    @property
+    def done(self):
+        return self.state == 'done'
+
+    def start(self):
+        "The lines to send before registering"
+        if not self.wanted:
+            self.state = 'done'
+            return []
+        self.state = 'requested'
+        self.unanswered = set(self.wanted)
+        return ['CAP LS 302', 'CAP REQ :' + ' '.join(self.wanted)]
+
+    def handle(self, arguments):
+        """
+        Handle the arguments of a CAP line from the server. Returns the
+        lines to send in reply.
+        """
+        subcommand = arguments[1].upper() if len(arguments) > 1 else ''
+        caps = arguments[-1].split() if len(arguments) > 2 else []
+        if subcommand in ('LS', 'NEW'):
+            for cap in caps:
+                name, sep, value = cap.partition('=')
+                self.available[name] = value or None
+        elif subcommand == 'DEL':
+            for cap in caps:
+                self.available.pop(cap, None)
+                self.enabled.discard(cap)
+        elif subcommand == 'ACK':
+            for cap in caps:
+                self.unanswered.discard(cap)
+                if cap.startswith('-'):
+                    self.enabled.discard(cap[1:])
+                else:
+                    self.enabled.add(cap)
+            return self._finish()
+        elif subcommand == 'NAK':
+            self.unanswered.difference_update(caps)
+            self.rejected.update(caps)
+            return self._finish()
+        return []
+
+    def _finish(self):
+        # A long answer is split over several lines
+        if self.state != 'requested' or self.unanswered:
+            return []
+        self.state = 'done'
+        return ['CAP END']
+
+    def registered(self):
+        """
+        The server registered us without waiting for CAP END (it does
+        not hold registration for negotiation, or does not know CAP).
+        """
+        self.state = 'done'
@@ -50,10 +50,12 @@ Notes:
 from __future__ import absolute_import, division
 
 import re
+import time
 import socket
 import struct
 import logging
 import abc
+import functools
 import collections
 import asyncio
 
@@ -64,10 +66,17 @@ try:
 except ImportError:
     pass
 
+from . import capabilities
+from . import connection
 from . import events
 from . import features
 from . import ctcp
 from . import message
+from . import dispatch
+from .dispatch import PrioritizedHandler
+from . import outbound
+from . import ratelimit
+from . import transports
 
 log = logging.getLogger(__name__)
 
@@ -89,34 +98,161 @@ class InvalidCharacters(ValueError):
 class MessageTooLong(ValueError):
     "Message is too long"
 
+# The regex form of the line grammar; ServerConnection uses the faster
+# message.split_line, which produces the same groups.
 _cmd_pat = "^(@(?P<tags>[^ ]*) )?(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?"
 _rfc_1459_command_regexp = re.compile(_cmd_pat)
 
 
+# Twitch allows 8191 bytes of tags in front of the 512 byte RFC 1459 line.
+MAX_LINE_LENGTH = 8191 + 512
+
+
 class ServerConnectionError(IRCError):
     pass
 
 class ServerNotConnectedError(ServerConnectionError):
     pass
 
+class JoinError(IRCError):
+    """
+    The server refused to let us join a channel. The arguments are the
+    error event type (e.g. "bannedfromchan"), the channel and the
+    server's message.
+    """
+
+
+_JOIN_ERRORS = frozenset([
+    "nosuchchannel", "toomanychannels", "unavailresource", "channelisfull",
+    "inviteonlychan", "bannedfromchan", "badchannelkey", "badchanmask",
+])
+_MEMBERSHIP_COMMANDS = frozenset(["join", "part", "kick"]) | _JOIN_ERRORS
+_NEGOTIATION_COMMANDS = frozenset(["cap", "unknowncommand"])
+# Parsed whether or not anyone listens, for the connection's own state
+_EAGER_COMMANDS = frozenset(["nick", "welcome", "featurelist"])
+
 
-class ServerConnection:
+class _WelcomeMixin(object):
+    """
+    Waiting for the server's welcome, for ServerConnection and the
+    stand-ins for connections in other processes (workers.WorkerShard).
+    Needs a welcomed_event and a disconnected_event.
+    """
+    async def _wait_welcomed(self, timeout=None):
+        welcomed = asyncio.ensure_future(self.welcomed_event.wait())
+        lost = asyncio.ensure_future(self.disconnected_event.wait())
+        try:
+            await asyncio.wait(
+                [welcomed, lost], timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            welcomed.cancel()
+            lost.cancel()
+        if not self.welcomed_event.is_set():
+            raise ServerConnectionError("Not welcomed by the server")
+
+
+class ServerConnection(_WelcomeMixin):
     """
     An IRC server connection.
 
     ServerConnection objects are instantiated by calling the server
     method on a Reactor object.
+
+    Arguments:
+
+        handler -- A coroutine function called as handler(connection,
+            event) for every event.
+
+        handler_wants -- A function taking an event type and returning
+            whether `handler` wants events of that type. Events that
+            neither `handler` nor a global handler wants are not even
+            built; `handler` gets every event that is.
+
+        lazy_events -- Deliver LazyEvent objects, which parse their
+            source, arguments and tags on first access. This pays off
+            when handlers look at few events closely; when they read
+            every field of every event, eager events are faster.
+
+        read_size -- Read the socket in chunks of this many bytes and
+            split all complete lines at once. If None, read one line at
+            a time with readline().
+
+        max_line_length -- The longest incomplete line kept while
+            waiting for the rest of it to arrive.
+
+        transport_class -- transports.StreamTransport (the default) to go
+            through asyncio streams, or transports.ProtocolTransport to
+            use a line-splitting asyncio.Protocol.
+
+        event_queue -- A dispatch.EventQueue. If given, the reader only
+            parses lines and queues the events, and `dispatchers` tasks
+            run the handlers, so that slow handlers don't stall reading
+            from the socket. With more than one dispatcher, events may
+            be handled out of order.
+
+        rate_limits -- A ratelimit.RateLimits, such as
+            ratelimit.TWITCH['user']. Sent lines then wait in the send
+            queue until they fit within the limits.
+
+        rate_limiter -- A ratelimit.RateLimiter to use instead, shared
+            with other connections of the same account (as in a
+            pool.ConnectionPool), whose limits they all count against.
+
+        lane_reserves -- The tokens each send queue lane leaves for the
+            lanes above it, by lane name; see outbound.SendQueue.
+
+        split_long_messages -- Split the text given to privmsg() and
+            notice() over as many lines as it takes, instead of raising
+            MessageTooLong.
     """
 
     socket = None
 
-    def __init__(self, handler=None, *, loop=None):
+    def __init__(self, handler=None, *, loop=None, handler_wants=None,
+                 lazy_events=False,
+                 read_size=65536, max_line_length=MAX_LINE_LENGTH,
+                 transport_class=transports.StreamTransport,
+                 event_queue=None, dispatchers=1, rate_limits=None,
+                 rate_limiter=None, lane_reserves=None,
+                 split_long_messages=False):
         self.loop = loop if loop else asyncio.get_event_loop()
         self.handler = handler
+        self.handler_wants = handler_wants
+        self.lazy_events = lazy_events
+        self.read_size = read_size
+        self.max_line_length = max_line_length
+        self.transport_class = transport_class
+        self.event_queue = event_queue
+        self.dispatchers = dispatchers
+        self._dispatch_tasks = []
+        if rate_limiter is None and rate_limits:
+            rate_limiter = ratelimit.RateLimiter(rate_limits)
+        self.rate_limiter = rate_limiter
+        self.send_queue = outbound.SendQueue(
+            self.rate_limiter, lane_reserves)
+        self._writer_task = None
+        self.handlers = dispatch.HandlerRegistry()
+        self.real_server_name = ""
+        self.real_nickname = ""
+        self.own_prefix = ""
+        self.joined_channels = set()
+        self._pending_joins = {}
+        self._rejoin = set()
+        "Channels still being joined when the connection was lost"
+        self.split_long_messages = split_long_messages
+        self.capabilities = capabilities.Negotiation()
+        self.timings = {}
+        self._connect_started = self._registration_started = time.monotonic()
+        self._tls_context = None
+        self.tls_session_reused = False
+        self.socket_options = {}
+        self.shard = None
         self.connected_event = asyncio.Event()
+        self.welcomed_event = asyncio.Event()
         self.disconnected_event = asyncio.Event()
         self.features = features.FeatureSet()
-        self._reader = self._writer = None
+        self._transport = None
 
     @property
     def connected(self):
@@ -125,6 +261,45 @@ class ServerConnection:
     def wait_disconnected(self):
         return self.disconnected_event.wait()
 
+    def add_global_handler(self, event, handler, priority=0):
+        """Adds a global handler function for a specific event type.
+
+        Arguments:
+
+            event -- Event type (a string).  Check the values of
+                     numeric_events for possible event types.
+
+            handler -- Callback function taking 'connection' and 'event'
+                       parameters; a plain function or a coroutine
+                       function.
+
+            priority -- A number (the lower number, the higher priority).
+
+        The handler function is called whenever the specified event is
+        triggered in any of the connections.  See documentation for
+        the Event class.
+
+        The handler functions are called in priority order (lowest
+        number is highest priority).  If a handler function returns
+        "NO MORE", no more handlers will be called.
+
+        Handlers for the special event type "all_events" are called for
+        every event.
+        """
+        self.handlers.add(event, handler, priority)
+
+    def remove_global_handler(self, event, handler):
+        """Removes a global handler function.
+
+        Arguments:
+
+            event -- Event type (a string).
+            handler -- Callback function.
+
+        Returns 1 on success, otherwise 0.
+        """
+        return int(self.handlers.remove(event, handler))
+
     def get_server_name(self):
         """Get the (real) server name.
 
@@ -145,7 +320,8 @@ class ServerConnection:
     # save the method args to allow for easier reconnection.
     # @irc_functools.save_method_args
     async def connect(self, server, port, nickname, password=None,
-                      username=None, ircname=None, caps=None):
+                      username=None, ircname=None, caps=None, ssl=None,
+                      socket_options=None):
         """Connect/reconnect to a server.
 
         Arguments:
@@ -156,24 +332,66 @@ class ServerConnection:
         * password - Password (if any)
         * username - The username
         * ircname - The IRC name ("realname")
-        * server_address - The remote host/port of the server
+        * caps - IRCv3 capabilities to request (a space-separated string
+          or a list)
+        * ssl - True, or an ssl.SSLContext, to connect with TLS
+        * socket_options - A connection.SocketOptions, for TCP tuning;
+          the defaults suit chat. The values the socket ended up with
+          are put in self.socket_options.
+
+        The server's addresses are cached for a while (see
+        connection.DNSCache), and connection attempts to them are raced
+        (see connection.race). With ssl=True, or a context from
+        connection.tls_context() or prepared with
+        connection.session_cache(), TLS sessions are cached per server
+        in the SSLContext, so that reconnecting resumes the session;
+        tls_session_reused says whether it did. Other SSLContexts are
+        used as they are.
+
+        timings holds the seconds each phase took: 'resolve',
+        'connect' (TCP), 'tls_handshake', 'registration' (from sending
+        NICK to the welcome) and 'welcome' (all of it).
 
         This function can be called to reconnect a closed connection.
 
+        Capability negotiation and registration are pipelined: the CAP
+        LS/REQ, PASS, NICK and USER lines go out in one write, and CAP
+        END once the server answers the request. The capabilities the
+        server enabled end up in self.capabilities.enabled.
+        welcomed_event is set when the server welcomes us.
+
         Returns the ServerConnection object.
         """
+        started = time.monotonic()
         log.debug("connect(server=%r, port=%r, nickname=%r, ...)", server,
             port, nickname)
         self._saved_connect_args = (server, port, nickname, password,
-                                    username, ircname, caps)
+                                    username, ircname, caps, ssl,
+                                    socket_options)
+        if ssl is True:
+            if self._tls_context is None:
+                self._tls_context = connection.tls_context()
+            ssl = self._tls_context
+        elif not ssl:
+            ssl = None
 
         if self.connected:
             await self.quit("Changing servers")
             await self.disconnect()
 
-        self.handlers = {}
         self.real_server_name = ""
         self.real_nickname = nickname
+        self.own_prefix = ""
+        self.joined_channels.clear()
+        self._rejoin.clear()
+        # Those of the previous connection are its own to cancel
+        pending_joins = self._pending_joins = {}
+        self.welcomed_event.clear()
+        self.timings.clear()
+        self._connect_started = started
+        if isinstance(caps, str):
+            caps = caps.split()
+        self.capabilities = capabilities.Negotiation(caps or ())
         self.server = server
         self.port = port
         self.server_address = (server, port)
@@ -182,117 +400,403 @@ class ServerConnection:
         self.ircname = ircname or nickname
         self.password = password
         try:
-            self._reader, self._writer = await asyncio.open_connection(
-                server, port, loop=self.loop)
+            self._transport = await self.transport_class.open(
+                server, port, ssl=ssl, socket_options=socket_options,
+                read_size=self.read_size,
+                max_line_length=self.max_line_length)
         except Exception as ex:
             raise ServerConnectionError("Couldn't connect to socket: %s" % ex)
-
-        self._handler_coroutine = self.loop.create_task(
-            self._handle_client())
+        self.timings.update(self._transport.timings)
+        self.socket_options = self._transport.socket_options
+        self._registration_started = time.monotonic()
+        ssl_object = self._transport.get_extra_info('ssl_object')
+        self.tls_session_reused = bool(
+            ssl_object and ssl_object.session_reused)
+
+        dispatch_tasks = []
+        if self.event_queue is not None:
+            # The previous connection's dispatchers may still be working
+            # through its backlog, which is dropped now
+            await self._stop_dispatchers(self._dispatch_tasks)
+            self.event_queue.clear()
+            dispatch_tasks.extend(
+                self.loop.create_task(self._dispatch_events(dispatch_tasks))
+                for i in range(self.dispatchers)
+            )
+        self._dispatch_tasks = dispatch_tasks
+        self.send_queue.clear()
+        writer_task = self._writer_task = self.loop.create_task(
+            self.send_queue.run(self._transport))
+        self._handler_coroutine = self.loop.create_task(self._handle_client(
+            self._transport, writer_task, dispatch_tasks, pending_joins))
         self.disconnected_event.clear()
         self.connected_event.set()
 
         # Log on...
-        if caps:
-            await self.cap('REQ', ':' + caps)
-        if self.password:
-            await self.pass_(self.password)
-        await self.nick(self.nickname)
-        await self.user(self.username, self.ircname)
+        async with self.batch():
+            for line in self.capabilities.start():
+                await self.send_raw(line)
+            if self.password:
+                await self.pass_(self.password)
+            await self.nick(self.nickname)
+            await self.user(self.username, self.ircname)
         return self
 
-    def reconnect(self):
+    async def reconnect(self, channels=(), timeout=None):
         """
-        Reconnect with the last arguments passed to self.connect()
+        Reconnect with the last arguments passed to self.connect(), and
+        rejoin the channels we were in (or joining), and `channels`,
+        with join_many().
+
+        Global handlers and the server's features are kept, so the
+        JOINs are packed by the TARGMAX and CHANLIMIT we already know
+        and go out as soon as the server welcomes us. TLS sessions are
+        resumed (see connect()).
+
+        Waits up to `timeout` seconds (default: no limit) for the
+        welcome, and raises ServerConnectionError if the connection is
+        lost first. Returns the dict join_many() returns. Once every
+        channel is joined (or refused), timings['rejoined'] holds the
+        seconds since reconnect() was called.
         """
-        self.connect(*self._saved_connect_args)
+        rejoin = list(self.joined_channels.union(
+            self._pending_joins, self._rejoin))
+        rejoin.extend(channels)
+        await self.connect(*self._saved_connect_args)
+        await self._wait_welcomed(timeout)
+        joins = await self.join_many(rejoin)
+        self._time_rejoin(joins)
+        return joins
+
+    def _time_rejoin(self, joins):
+        "Set timings['rejoined'] when every join in `joins` is done"
+        pending = set(joins.values())
+        def done(joined):
+            pending.discard(joined)
+            if pending or any(j.cancelled() for j in joins.values()):
+                return
+            self.timings['rejoined'] = (
+                time.monotonic() - self._connect_started)
+        if not pending:
+            done(None)
+        for joined in list(pending):
+            joined.add_done_callback(done)
 
     async def disconnect(self, timeout=None):
         """Hang up the connection."""
         if not self.connected:
             return
-        writer, self._writer = self._writer, None
-        if not writer:
+        transport, self._transport = self._transport, None
+        if not transport:
             # Another disconnect in progress
             await self.disconnected_event.wait()
             return
-        if writer.can_write_eof():
-            writer.write_eof()
-            await writer.drain()
+        self._save_tls_session(transport)
         if timeout is None:
             timeout = 1
         try:
-            await asyncio.wait_for(self._handler_coroutine,
-                                   timeout, loop=self.loop)
+            # Let the writer task send what is already queued, e.g. QUIT
+            await asyncio.wait_for(self.send_queue.flush(), timeout)
+        except asyncio.TimeoutError:
+            log.error('Could not send queued lines within %s s', timeout)
+        if self._writer_task:
+            self._writer_task.cancel()
+        if transport.can_write_eof():
+            transport.write_eof()
+            await transport.drain()
+        try:
+            await asyncio.wait_for(self._handler_coroutine, timeout)
         except asyncio.TimeoutError:
             log.error('Server did not close connection after %s s, aborting',
                       timeout)
-            writer.transport.abort()
+            transport.abort()
             self._handler_coroutine.cancel()
-        await self._handle_event(Event("disconnect", self.server, "", []))
+            # Its cleanup must not run after a new connect()
+            await asyncio.wait([self._handler_coroutine])
+        transport.close()
+        if self._wants("disconnect"):
+            await self._handle_event(Event("disconnect", self.server, "", []))
+
+    def _save_tls_session(self, transport=None):
+        "Keep the TLS session for resuming it when reconnecting"
+        transport = transport or self._transport
+        ssl_object = transport and transport.get_extra_info('ssl_object')
+        cache = ssl_object and getattr(
+            ssl_object.context, 'session_cache', None)
+        if cache is not None:
+            cache.save(ssl_object)
+
+    async def _handle_client(self, transport, writer_task, dispatch_tasks,
+                             pending_joins):
+        """
+        Read from `transport` until the connection ends, then stop its
+        writer and dispatcher tasks and cancel its pending joins. A new
+        connect() may have happened by then (while the backlog was
+        being handled); its tasks and joins are left alone.
+        """
+        try:
+            await self._read_loop(transport)
+            if self.event_queue is not None:
+                # Until the backlog is handled, or a new connection
+                # drops it
+                await self.event_queue.join()
+        finally:
+            for task in dispatch_tasks:
+                task.cancel()
+            writer_task.cancel()
+            if self._pending_joins is pending_joins:
+                self._rejoin.update(pending_joins)
+            for joined in pending_joins.values():
+                joined.cancel()
+            pending_joins.clear()
+            # However the connection ended (EOF, read error, or abort
+            # and cancel by disconnect()), it is now disconnected
+            if self._transport in (transport, None):
+                self._transport = None
+                self.connected_event.clear()
+                self.disconnected_event.set()
+            transport.close()
+        log.info('_handle_client is done')
 
-    async def _handle_client(self):
+    async def _read_loop(self, transport):
         while True:
             try:
-                line = await self._reader.readline()
+                lines = await transport.read_lines()
             except Exception as exn:
-                log.exception("readline() failed")
+                log.exception("Reading from server failed")
                 self.connected_event.clear()
                 self.disconnected_event.set()
                 try:
-                    if self._writer:
+                    if self._transport:
                         await self.quit('Read error')
                 except Exception:
                     log.exception('quit() also failed')
                 await self.disconnect()
                 break
+            if not lines:
+                log.info('EOF from server')
+                self.connected_event.clear()
+                self.disconnected_event.set()
+                assert not self.connected
+                if self._transport is transport:
+                    self._transport = None
+                    transport.close()
+                await self.disconnect()
+                break
+            await self._process_lines(lines)
+
+    async def _dispatch_events(self, tasks):
+        """
+        Run the handlers for queued events, as one of the dispatcher
+        `tasks` of a connection, until another connection replaces them.
+        """
+        queue = self.event_queue
+        while tasks is self._dispatch_tasks:
+            event = await queue.get()
+            try:
+                await self._handle_event(event)
+            finally:
+                # Once replaced, the queue was cleared and no longer
+                # counts this event
+                if tasks is self._dispatch_tasks:
+                    queue.task_done()
+
+    async def _stop_dispatchers(self, tasks):
+        """
+        Cancel dispatcher tasks and wait for them to finish, except for
+        the one running this (a handler that reconnects), which stops
+        by itself once its handler returns.
+        """
+        current = asyncio.current_task()
+        tasks = [task for task in tasks if task is not current]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def _emit(self, event):
+        """Pass an event from the reader on to the handlers."""
+        if self.event_queue is None:
+            await self._handle_event(event)
+        else:
+            await self.event_queue.put(event)
+
+    async def _process_lines(self, lines):
+        for line in lines:
             try:
-                if line == b'':
-                    log.info('EOF from server')
-                    self.connected_event.clear()
-                    self.disconnected_event.set()
-                    assert not self.connected
-                    await self.disconnect()
-                    break
                 log.debug("FROM SERVER: %r", line)
                 line = line.rstrip(b'\r\n')
                 if line:
-                    await self._process_line(line.decode())
+                    await self._process_line(line)
             except Exception as exn:
                 log.exception("_process_line failed, line = %r", line)
-        log.info('_handle_client is done')
 
     async def _process_line(self, line):
-        event = Event("all_raw_messages", self.get_server_name(), None,
-            [line])
-        await self._handle_event(event)
-
-        grp = _rfc_1459_command_regexp.match(line).group
-
-        source = NickMask.from_group(grp("prefix"))
-        command = self._command_from_group(grp("command"))
-        arguments = message.Arguments.from_group(grp('argument'))
-        tags = message.Tag.from_group(grp('tags'))
+        """Process one line (bytes, without CR LF) from the server."""
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        if self._wants("all_raw_messages"):
+            event = Event("all_raw_messages", self.get_server_name(), None,
+                [line.decode('utf-8')])
+            await self._emit(event)
+
+        tags, prefix, command, argument = message.split_line(line)
+        command = self._command_from_group(command)
+        if not self.own_prefix and prefix:
+            self._learn_own_prefix(prefix)
+        if command in _MEMBERSHIP_COMMANDS:
+            self._track_membership(command, prefix, argument)
+        elif command in _NEGOTIATION_COMMANDS:
+            await self._negotiate(command, argument)
+        if prefix and not self.real_server_name:
+            self.real_server_name = NickMask.from_group(prefix)
+
+        if self.lazy_events:
+            parts = self._lazy_parts(command, argument)
+            if parts is not None:
+                event_type, target, argument, parse = parts
+                if self._wants(event_type):
+                    await self._emit(LazyEvent(
+                        event_type, target, prefix, argument, tags, parse))
+                return
+
+        if command in _EAGER_COMMANDS:
+            wanted = self._wants(command)
+        else:
+            wanted = any(map(self._wants, self._event_types(command, argument)))
+            if not wanted:
+                return
 
-        if source and not self.real_server_name:
-            self.real_server_name = source
+        source = NickMask.from_group(prefix)
+        arguments = message.Arguments.from_group(argument)
+        tags = message.Tags.from_group(tags)
 
         if command == "nick":
             if source.nick == self.real_nickname:
                 self.real_nickname = arguments[0]
+                self.own_prefix = ""
         elif command == "welcome":
             # Record the nickname in case the client changed nick
             # in a nicknameinuse callback.
             self.real_nickname = arguments[0]
+            self.capabilities.registered()
+            # TLS 1.3 session tickets arrive after the handshake
+            self._save_tls_session()
+            if not self.welcomed_event.is_set():
+                now = time.monotonic()
+                self.timings['welcome'] = now - self._connect_started
+                self.timings['registration'] = (
+                    now - self._registration_started)
+                self.welcomed_event.set()
         elif command == "featurelist":
             self.features.load(arguments)
 
-        handler = (
-            self._handle_message
-            if command in ["privmsg", "notice"]
-            else self._handle_other
-        )
-        await handler(arguments, command, source, tags)
+        if command in ["privmsg", "notice"]:
+            await self._handle_message(arguments, command, source, tags)
+        elif wanted:
+            await self._handle_other(arguments, command, source, tags)
+
+    def _learn_own_prefix(self, prefix):
+        """
+        Remember our nick!user@host when the server echoes a line of
+        ours, e.g. a JOIN, to know how long relayed lines of ours are.
+        """
+        nick, sep, userhost = prefix.partition('!')
+        if sep and nick.lower() == self.real_nickname.lower():
+            self.own_prefix = prefix
+
+    async def _negotiate(self, command, argument):
+        """Answer CAP lines from the server while negotiating."""
+        arguments = message.Arguments.from_group(argument)
+        if command == "cap":
+            replies = self.capabilities.handle(arguments)
+        elif arguments[1:2] == ["CAP"]:
+            # ERR_UNKNOWNCOMMAND: the server does not negotiate at all
+            self.capabilities.registered()
+            replies = []
+        else:
+            replies = []
+        for line in replies:
+            await self.send_raw(line)
+
+    def _track_membership(self, command, prefix, argument):
+        """
+        Keep joined_channels up to date, and resolve join_many() futures
+        when the server echoes our JOIN or refuses it.
+        """
+        arguments = message.Arguments.from_group(argument) or ['']
+        nick = prefix.partition('!')[0].lower() if prefix else ''
+        me = self.real_nickname.lower()
+        if command == "join":
+            if nick != me:
+                return
+            channel = arguments[0].lower()
+            self.joined_channels.add(channel)
+            joined = self._pending_joins.pop(channel, None)
+            if joined is not None and not joined.done():
+                joined.set_result(None)
+        elif command == "part":
+            if nick == me:
+                self.joined_channels.discard(arguments[0].lower())
+        elif command == "kick":
+            if arguments[1:2] and arguments[1].lower() == me:
+                self.joined_channels.discard(arguments[0].lower())
+        elif len(arguments) > 1:
+            channel = arguments[1].lower()
+            joined = self._pending_joins.pop(channel, None)
+            if joined is not None and not joined.done():
+                joined.set_exception(
+                    JoinError(command, arguments[1], arguments[-1]))
+
+    @staticmethod
+    def _event_types(command, argument):
+        """
+        The event types _handle_message or _handle_other may emit for a
+        line, worked out from its command and target alone so that lines
+        nobody listens for need not be parsed.
+        """
+        target = message.Arguments.split_target(argument)[0]
+        if command == "privmsg":
+            return ("pubmsg" if is_channel(target) else "privmsg",
+                    "ctcp", "action")
+        if command == "notice":
+            return ("pubnotice" if is_channel(target) else "privnotice",
+                    "ctcpreply")
+        if command == "mode" and not is_channel(target):
+            return ("umode",)
+        return (command,)
+
+    def _lazy_parts(self, command, argument):
+        """
+        The event type, target, unparsed arguments and argument parser
+        of a LazyEvent for a line that yields exactly one event and
+        needs no bookkeeping, or None to take the eager path.
+
+        Mirrors the event types and targets of _handle_message and
+        _handle_other.
+        """
+        if command in _EAGER_COMMANDS:
+            return None
+        parse = message.Arguments.from_group
+        if command in ("privmsg", "notice"):
+            target, argument = message.Arguments.split_target(argument)
+            if argument is None or ctcp.DELIMITER in argument:
+                return None
+            if command == "privmsg":
+                command = "pubmsg" if is_channel(target) else "privmsg"
+            else:
+                command = "pubnotice" if is_channel(target) else "privnotice"
+            parse = _parse_message_arguments
+        elif command == "quit":
+            target = None
+            parse = _parse_first_argument
+        elif command == "ping":
+            target, rest = message.Arguments.split_target(argument)
+        else:
+            target, argument = message.Arguments.split_target(argument)
+            if command == "mode" and not is_channel(target):
+                command = "umode"
+        return command, target, argument, parse
 
     async def _handle_message(self, arguments, command, source, tags):
         target, msg = arguments[:2]
@@ -315,16 +819,18 @@ class ServerConnection:
                 m = list(m)
                 log.debug("command: %s, source: %s, target: %s, "
                           "arguments: %s, tags: %s", command, source, target, m, tags)
-                event = Event(command, source, target, m, tags)
-                await self._handle_event(event)
-                if command == "ctcp" and m[0] == "ACTION":
+                if self._wants(command):
+                    event = Event(command, source, target, m, tags)
+                    await self._emit(event)
+                if (command == "ctcp" and m[0] == "ACTION"
+                        and self._wants("action")):
                     event = Event("action", source, target, m[1:], tags)
-                    await self._handle_event(event)
-            else:
+                    await self._emit(event)
+            elif self._wants(command):
                 log.debug("command: %s, source: %s, target: %s, "
                           "arguments: %s, tags: %s", command, source, target, [m], tags)
                 event = Event(command, source, target, [m], tags)
-                await self._handle_event(event)
+                await self._emit(event)
 
     async def _handle_other(self, arguments, command, source, tags):
         target = None
@@ -341,7 +847,7 @@ class ServerConnection:
         log.debug("command: %s, source: %s, target: %s, "
                   "arguments: %s, tags: %s", command, source, target, arguments, tags)
         event = Event(command.strip(), source, target, arguments, tags)
-        await self._handle_event(event)
+        await self._emit(event)
 
     @staticmethod
     def _command_from_group(group):
@@ -349,36 +855,162 @@ class ServerConnection:
         # Translate numerics into more readable strings.
         return events.numeric.get(command, command)
 
+    def _wants(self, event_type):
+        """
+        Whether any handler listens for events of this type. Events
+        nobody listens for are neither built nor dispatched.
+        """
+        if self.handlers.get(event_type):
+            return True
+        return self.handler is not None and (
+            self.handler_wants is None or self.handler_wants(event_type))
+
     async def _handle_event(self, event: 'Event'):
         """[Internal]"""
-        try:
-            if self.handler is not None:
-                await self.handler(self, event)
-            if event.type in self.handlers:
-                for fn in self.handlers[event.type]:
-                    fn(self, event)
-        except Exception:
-            log.exception("Handler raised an exception")
+        event.shard = self.shard
+        await dispatch.call_handlers(self, event, self.handler, self.handlers)
 
     async def send_items(self, *items):
         """
         Send all non-empty items, separated by spaces.
         """
-        await self.send_raw(' '.join(filter(None, items)))
+        return await self.send_raw(' '.join(filter(None, items)))
 
     async def send_raw(self, string):
         """Send raw string to the server.
 
         The string will be padded with appropriate CR LF.
+
+        The line is queued for the writer task, which sends everything
+        queued in the meantime in one write. Returns a future that is
+        resolved once the line has been written, or cancelled if the
+        connection closes first; await it to wait for delivery.
+        """
+        data = self._prep_message(string)
+        log.debug("TO SERVER: %s", string)
+        command, _, params = string.partition(' ')
+        target = params.partition(' ')[0]
+        return self._queue_line((data,), command.upper(), target)
+
+    async def send_bytes(self, command, target, text):
+        """
+        Send ``COMMAND target :text``, the fast way.
+
+        The ``COMMAND target :`` part is encoded once per command and
+        target and cached, so only `text` (a str, or bytes already
+        encoded) is encoded for each line, and the parts are queued
+        without being joined. Returns the delivery future like
+        send_raw().
+        """
+        head = _command_prefix(command, target)
+        if isinstance(text, str):
+            if '\n' in text:
+                msg = "Carriage returns not allowed in privmsg(text)"
+                raise InvalidCharacters(msg)
+            text = text.encode('utf-8')
+        elif b'\n' in text:
+            raise InvalidCharacters("Carriage returns not allowed in text")
+        if len(head) + len(text) > 510:
+            msg = "Messages limited to 512 bytes including CR/LF"
+            raise MessageTooLong(msg)
+        log.debug("TO SERVER: %s %s :%s", command, target, text)
+        return self._queue_line((head, text, b'\r\n'), command, target)
+
+    def _queue_line(self, parts, command, target):
+        """
+        Queue a line, as a tuple of encoded parts ending in CR LF, on
+        the send queue.
         """
         if not self.connected:
             raise ServerNotConnectedError("Not connected.")
-        writer = self._writer
-        if not writer:
+        if not self._transport or self._writer_task.done():
             raise ServerNotConnectedError("Connection shutting down.")
-        writer.write(self._prep_message(string))
-        log.debug("TO SERVER: %s", string)
-        await writer.drain()
+        return self.send_queue.put(parts, command, target)
+
+    def _max_targets(self, command, default=None):
+        """
+        How many targets the server takes in one `command`, according to
+        its TARGMAX (or, for PRIVMSG and NOTICE, MAXTARGETS) feature.
+        None means no limit.
+        """
+        targmax = getattr(self.features, 'targmax', {})
+        if command in targmax:
+            return targmax[command] or None
+        if command in ('PRIVMSG', 'NOTICE'):
+            return getattr(self.features, 'maxtargets', default)
+        return default
+
+    async def _send_to_many(self, command, targets, tail='', sep=',',
+                            default_max=None):
+        """
+        Send `command` for all `targets` in as few lines as the server
+        allows, each line being ``COMMAND target,target...`` followed by
+        `tail`. The lines are queued as one batch. Returns the delivery
+        future of the last.
+        """
+        head = command + ' '
+        size = 510 - len(head.encode('utf-8')) - len(tail.encode('utf-8'))
+        max_count = self._max_targets(command, default_max)
+        delivered = None
+        async with self.batch():
+            for group in _pack_targets(targets, size, max_count, sep):
+                delivered = await self.send_raw(head + group + tail)
+        return delivered
+
+    def _relayed_length(self):
+        """
+        The bytes the server adds in front of our lines when it relays
+        them to others: ``:nick!user@host ``. Until the server has shown
+        us our user@host, assume the longest usual one.
+        """
+        prefix = self.own_prefix or '%s!%s@%s' % (
+            self.real_nickname, 'u' * 10, 'h' * 63)
+        return len(prefix.encode('utf-8')) + 2
+
+    async def _send_split(self, command, target, text):
+        """
+        Send `text` to `target` in as many lines as it takes for each
+        line, as relayed to others, to fit in 512 bytes. The lines are
+        queued as one batch. Returns the delivery future of the last.
+        """
+        if '\n' in text:
+            msg = "Carriage returns not allowed in privmsg(text)"
+            raise InvalidCharacters(msg)
+        head = _command_prefix(command, target)
+        size = 512 - 2 - len(head) - self._relayed_length()
+        if size < 4:
+            raise MessageTooLong("No room for text to %s" % target)
+        chunks = message.split_utf8(text.encode('utf-8'), size)
+        async with self.batch():
+            for chunk in chunks:
+                log.debug("TO SERVER: %s %s :%s", command, target, chunk)
+                delivered = self._queue_line(
+                    (head, chunk, b'\r\n'), command, target)
+        return delivered
+
+    def batch(self):
+        """
+        Hold back writing lines sent within an ``async with`` block until
+        the block exits, then write them all at once::
+
+            async with connection.batch():
+                for channel in channels:
+                    await connection.join(channel)
+        """
+        return self.send_queue.batch()
+
+    def lane(self, name):
+        """
+        Queue lines sent from the current task within a ``with`` block
+        in the given outbound lane (other than control commands, which
+        always go first)::
+
+            with connection.lane(outbound.INTERACTIVE):
+                await connection.privmsg(channel, text)
+
+        Lines are otherwise sent in the outbound.BULK lane.
+        """
+        return self.send_queue.lane(name)
 
     def _prep_message(self, string):
         # The string should not contain any carriage return other than the
@@ -396,11 +1028,11 @@ class ServerConnection:
 
     async def action(self, target, action):
         """Send a CTCP ACTION command."""
-        await self.ctcp("ACTION", target, action)
+        return await self.ctcp("ACTION", target, action)
 
     async def admin(self, server=""):
         """Send an ADMIN command."""
-        await self.send_items('ADMIN', server)
+        return await self.send_items('ADMIN', server)
 
     async def cap(self, subcommand, *args):
         """
@@ -438,7 +1070,7 @@ class ServerConnection:
                 return (':' + args[0],) + args[1:]
             return args
 
-        await self.send_items('CAP', subcommand, *_multi_parameter(args))
+        return await self.send_items('CAP', subcommand, *_multi_parameter(args))
 
     async def ctcp(self, ctcptype, target, parameter=""):
         """Send a CTCP command."""
@@ -447,23 +1079,23 @@ class ServerConnection:
             "\001{ctcptype} {parameter}\001" if parameter else
             "\001{ctcptype}\001"
         )
-        await self.privmsg(target, tmpl.format(**vars()))
+        return await self.privmsg(target, tmpl.format(**vars()))
 
     async def ctcp_reply(self, target, parameter):
         """Send a CTCP REPLY command."""
-        await self.notice(target, "\001%s\001" % parameter)
+        return await self.notice(target, "\001%s\001" % parameter)
 
     async def globops(self, text):
         """Send a GLOBOPS command."""
-        await self.send_items('GLOBOPS', ':' + text)
+        return await self.send_items('GLOBOPS', ':' + text)
 
     async def info(self, server=""):
         """Send an INFO command."""
-        await self.send_items('INFO', server)
+        return await self.send_items('INFO', server)
 
     async def invite(self, nick, channel):
         """Send an INVITE command."""
-        await self.send_items('INVITE', nick, channel)
+        return await self.send_items('INVITE', nick, channel)
 
     async def ison(self, nicks):
         """Send an ISON command.
@@ -472,138 +1104,252 @@ class ServerConnection:
 
             nicks -- List of nicks.
         """
-        await self.send_items('ISON', *tuple(nicks))
+        return await self.send_items('ISON', *tuple(nicks))
 
     async def join(self, channel, key=""):
         """Send a JOIN command."""
-        await self.send_items('JOIN', channel, key)
+        return await self.send_items('JOIN', channel, key)
+
+    async def join_many(self, channels):
+        """
+        Join many channels with as few JOIN lines as the server allows:
+        within 512 bytes, its TARGMAX for JOIN and the JOIN rate limit,
+        and not beyond its CHANLIMIT.
+
+        Returns a dict mapping each channel to a future that is resolved
+        when the server echoes our JOIN, or fails with JoinError if the
+        server refuses it (or CHANLIMIT would be exceeded).
+        """
+        for key, joined in list(self._pending_joins.items()):
+            if joined.cancelled():
+                # Given up on by whoever awaited it; join again
+                del self._pending_joins[key]
+        result = {}
+        futures = dict(self._pending_joins)
+        new = []
+        for channel in channels:
+            key = channel.lower()
+            joined = futures.get(key)
+            if joined is None:
+                joined = futures[key] = self.loop.create_future()
+                if key in self.joined_channels:
+                    joined.set_result(None)
+                else:
+                    new.append(channel)
+            result[channel] = joined
+        room, group_of = self._chanlimit_room()
+        send = []
+        for channel in new:
+            group = group_of.get(channel[:1])
+            if group is not None:
+                if room[group] <= 0:
+                    result[channel].set_exception(JoinError(
+                        "toomanychannels", channel, "CHANLIMIT reached"))
+                    continue
+                room[group] -= 1
+            self._pending_joins[channel.lower()] = result[channel]
+            send.append(channel)
+        max_count = self._max_targets('JOIN')
+        limiter = self.rate_limiter
+        if limiter and limiter.joins:
+            # One line must not take more tokens than the bucket holds
+            max_count = min(max_count or limiter.joins.count,
+                            limiter.joins.count)
+        async with self.batch():
+            for group in _pack_targets(send, 510 - len('JOIN '), max_count):
+                await self.send_raw('JOIN ' + group)
+        return result
+
+    def _chanlimit_room(self):
+        """
+        How many more channels we can be in, per group of prefixes that
+        share a limit in the server's CHANLIMIT (such as '#&'), counting
+        joins in progress. Returns that, and the group of each prefix.
+        """
+        limits = getattr(self.features, 'chanlimit', {})
+        groups = getattr(limits, 'groups', limits)
+        room = {group: limit for group, limit in groups.items()
+                if limit is not None}
+        group_of = {kind: group for group in room for kind in group}
+        for channel in self.joined_channels.union(self._pending_joins):
+            group = group_of.get(channel[:1])
+            if group is not None:
+                room[group] -= 1
+        return room, group_of
 
     async def kick(self, channel, nick, comment=""):
         """Send a KICK command."""
-        await self.send_items('KICK', channel, nick, comment and ':' + comment)
+        return await self.send_items('KICK', channel, nick, comment and ':' + comment)
 
     async def links(self, remote_server="", server_mask=""):
         """Send a LINKS command."""
-        await self.send_items('LINKS', remote_server, server_mask)
+        return await self.send_items('LINKS', remote_server, server_mask)
 
     async def list(self, channels=None, server=""):
         """Send a LIST command."""
-        await self.send_items('LIST', ','.join(channels), server)
+        return await self.send_items('LIST', ','.join(channels), server)
 
     async def lusers(self, server=""):
         """Send a LUSERS command."""
-        await self.send_items('LUSERS', server)
+        return await self.send_items('LUSERS', server)
 
     async def mode(self, target, command):
         """Send a MODE command."""
-        await self.send_items('MODE', target, command)
+        return await self.send_items('MODE', target, command)
 
     async def motd(self, server=""):
         """Send an MOTD command."""
-        await self.send_items('MOTD', server)
+        return await self.send_items('MOTD', server)
 
     async def names(self, channels=None):
         """Send a NAMES command."""
+        if not channels:
+            return await self.send_items('NAMES')
         if isinstance(channels, str):
             channels = [channels]
-        await self.send_items('NAMES', ','.join(channels))
+        return await self._send_to_many('NAMES', channels)
 
     async def nick(self, newnick):
         """Send a NICK command."""
-        await self.send_items('NICK', newnick)
+        return await self.send_items('NICK', newnick)
 
     async def notice(self, target, text):
         """Send a NOTICE command."""
-        # Should limit len(text) here!
-        await self.send_items('NOTICE', target, ':' + text)
+        if self.split_long_messages and text[:1] != ctcp.DELIMITER:
+            return await self._send_split('NOTICE', target, text)
+        return await self.send_bytes('NOTICE', target, text)
 
     async def oper(self, nick, password):
         """Send an OPER command."""
-        await self.send_items('OPER', nick, password)
+        return await self.send_items('OPER', nick, password)
 
     async def part(self, channels, message=""):
         """Send a PART command."""
-        await self.send_items('PART', ','.join(channels), message)
+        if isinstance(channels, str):
+            channels = [channels]
+        return await self._send_to_many(
+            'PART', channels, message and ' :' + message)
 
     async def pass_(self, password):
         """Send a PASS command."""
-        await self.send_items('PASS', password)
+        return await self.send_items('PASS', password)
 
     async def ping(self, target, target2=""):
         """Send a PING command."""
-        await self.send_items('PING', target, target2)
+        return await self.send_items('PING', target, target2)
 
     async def pong(self, target, target2=""):
         """Send a PONG command."""
-        await self.send_items('PONG', target, target2)
+        return await self.send_items('PONG', target, target2)
 
     async def privmsg(self, target, text):
         """Send a PRIVMSG command."""
-        await self.send_items('PRIVMSG', target, ':' + text)
+        if self.split_long_messages and text[:1] != ctcp.DELIMITER:
+            return await self._send_split('PRIVMSG', target, text)
+        return await self.send_bytes('PRIVMSG', target, text)
 
     async def privmsg_many(self, targets, text):
         """Send a PRIVMSG command to multiple targets."""
-        target = ','.join(targets)
-        return await self.privmsg(target, text)
+        if '\n' in text:
+            msg = "Carriage returns not allowed in privmsg(text)"
+            raise InvalidCharacters(msg)
+        return await self._send_to_many('PRIVMSG', targets, ' :' + text)
 
     async def quit(self, message=""):
         """Send a QUIT command."""
         # Note that many IRC servers don't use your QUIT message
         # unless you've been connected for at least 5 minutes!
-        await self.send_items('QUIT', message and ':' + message)
+        return await self.send_items('QUIT', message and ':' + message)
 
     async def squit(self, server, comment=""):
         """Send an SQUIT command."""
-        await self.send_items('SQUIT', server, comment and ':' + comment)
+        return await self.send_items('SQUIT', server, comment and ':' + comment)
 
     async def stats(self, statstype, server=""):
         """Send a STATS command."""
-        await self.send_items('STATS', statstype, server)
+        return await self.send_items('STATS', statstype, server)
 
     async def time(self, server=""):
         """Send a TIME command."""
-        await self.send_items('TIME', server)
+        return await self.send_items('TIME', server)
 
     async def topic(self, channel, new_topic=None):
         """Send a TOPIC command."""
-        await self.send_items('TOPIC', channel, new_topic and ':' + new_topic)
+        return await self.send_items('TOPIC', channel, new_topic and ':' + new_topic)
 
     async def trace(self, target=""):
         """Send a TRACE command."""
-        await self.send_items('TRACE', target)
+        return await self.send_items('TRACE', target)
 
     async def user(self, username, realname):
         """Send a USER command."""
         cmd = 'USER {username} 0 * :{realname}'.format(**locals())
-        await self.send_raw(cmd)
+        return await self.send_raw(cmd)
 
     async def userhost(self, nicks):
         """Send a USERHOST command."""
-        await self.send_items('USERHOST', ",".join(nicks))
+        # RFC 1459: up to five space-separated nicks
+        return await self._send_to_many(
+            'USERHOST', nicks, sep=' ', default_max=5)
 
     async def users(self, server=""):
         """Send a USERS command."""
-        await self.send_items('USERS', server)
+        return await self.send_items('USERS', server)
 
     async def version(self, server=""):
         """Send a VERSION command."""
-        await self.send_items('VERSION', server)
+        return await self.send_items('VERSION', server)
 
     async def wallops(self, text):
         """Send a WALLOPS command."""
-        await self.send_items('WALLOPS', ':' + text)
+        return await self.send_items('WALLOPS', ':' + text)
 
     async def who(self, target="", op=""):
         """Send a WHO command."""
-        await self.send_items('WHO', target, op and 'o')
+        return await self.send_items('WHO', target, op and 'o')
 
     async def whois(self, targets):
         """Send a WHOIS command."""
-        await self.send_items('WHOIS', ",".join(targets))
+        if isinstance(targets, str):
+            targets = [targets]
+        return await self._send_to_many('WHOIS', targets)
 
     async def whowas(self, nick, max="", server=""):
         """Send a WHOWAS command."""
-        await self.send_items('WHOWAS', nick, max, server)
+        return await self.send_items('WHOWAS', nick, max, server)
+
+
+class SimpleIRCClient(object):
+    """
+    A simple single-server IRC client class.
+
+    A real IRC client can be made by subclassing this class and adding
+    appropriate methods: on_join is called for "join" events, on_privmsg
+    for "privmsg" events, and so on. The handler methods get the
+    connection (same as self.connection) and the event; they may be
+    plain methods or coroutine methods.
+
+    Keyword arguments are passed on to the ServerConnection.
+
+    Instance attributes that can be used by subclasses:
+
+        connection -- The ServerConnection object.
+    """
+    def __init__(self, **connection_kwargs):
+        self.connection = ServerConnection(
+            self._dispatcher, **connection_kwargs)
+
+    async def _dispatcher(self, connection, event):
+        method = getattr(self, "on_" + event.type, None)
+        if method is None:
+            return
+        result = method(connection, event)
+        if asyncio.iscoroutine(result):
+            await result
+
+    async def connect(self, *args, **kwargs):
+        """Connect using the underlying connection"""
+        return await self.connection.connect(*args, **kwargs)
 
 
 class Event(object):
@@ -611,8 +1357,10 @@ class Event(object):
     An IRC event.
 
     >>> print(Event('privmsg', '@somebody', '#channel'))
-    type: privmsg, source: @somebody, target: #channel, arguments: [], tags: []
+    type: privmsg, source: @somebody, target: #channel, arguments: [], tags: {}
     """
+    __slots__ = ('type', 'source', 'target', 'arguments', 'tags', 'shard')
+
     def __init__(self, type, source, target, arguments=None, tags=None):
         """
         Initialize an Event.
@@ -626,17 +1374,23 @@ class Event(object):
             target -- The target of the event (a nick or a channel).
 
             arguments -- Any event-specific arguments.
+
+            tags -- A message.Tags mapping of the IRCv3 message tags.
+
+        The `shard` attribute is the index of the connection the event
+        came from in a pool.ConnectionPool, and None otherwise.
         """
         if not isinstance(type, str):
             raise TypeError(type)
         self.type = type
         self.source = source
         self.target = target
+        self.shard = None
         if arguments is None:
             arguments = []
         self.arguments = arguments
         if tags is None:
-            tags = []
+            tags = message.Tags()
         self.tags = tags
 
     @property
@@ -651,7 +1405,9 @@ class Event(object):
             "arguments: {arguments}, "
             "tags: {tags}"
         )
-        return tmpl.format(**vars(self))
+        return tmpl.format(type=self.type, source=self.source,
+                           target=self.target, arguments=self.arguments,
+                           tags=self.tags)
 
     def __repr__(self):
         args = [repr(self.type), repr(self.source), repr(self.target)]
@@ -662,6 +1418,94 @@ class Event(object):
         return '%s(%s)' % (self.__class__.__name__, ', '.join(args))
 
 
+_UNPARSED = object()
+"What the slots of a LazyEvent hold until they are first read"
+
+
+class _LazySlot(object):
+    """
+    Descriptor that computes an Event attribute on first read and stores
+    it in the Event slot of the same name.
+    """
+    def __init__(self, name, parse):
+        slot = Event.__dict__[name]
+        self.get = slot.__get__
+        self.set = slot.__set__
+        self.parse = parse
+
+    def __get__(self, event, owner=None):
+        if event is None:
+            return self
+        value = self.get(event, owner)
+        if value is _UNPARSED:
+            value = self.parse(event)
+            self.set(event, value)
+        return value
+
+    def __set__(self, event, value):
+        self.set(event, value)
+
+
+_set_source = Event.__dict__['source'].__set__
+_set_arguments = Event.__dict__['arguments'].__set__
+_set_tags = Event.__dict__['tags'].__set__
+
+
+def _parse_message_arguments(group):
+    # PRIVMSG/NOTICE without CTCP: the text is the only argument
+    return ctcp.dequote(message.Arguments.from_group(group)[0])
+
+
+def _parse_first_argument(group):
+    return message.Arguments.from_group(group)[:1]
+
+
+class LazyEvent(Event):
+    """
+    An Event that keeps the raw parts of its line and only parses
+    `source`, `arguments` and `tags` when they are first read.
+
+    >>> e = LazyEvent('pubmsg', '#chan', 'nick!user@host', ' :hi there',
+    ...     'color=;display-name=Nick', _parse_message_arguments)
+    >>> e.source.nick
+    'nick'
+    >>> e.arguments
+    ['hi there']
+    >>> e.args
+    'hi there'
+    >>> e.tags['display-name']
+    'Nick'
+    >>> e.arguments = ['changed']
+    >>> e.arguments
+    ['changed']
+    >>> print(LazyEvent('join', '#chan', 'nick!user@host', None, None))
+    type: join, source: nick!user@host, target: #chan, arguments: [], tags: {}
+    """
+    __slots__ = ('_prefix', '_argument', '_tags', '_parse_arguments')
+
+    def __init__(self, type, target, prefix, argument, tags,
+                 parse_arguments=message.Arguments.from_group):
+        if not isinstance(type, str):
+            raise TypeError(type)
+        self.type = type
+        self.target = target
+        self.shard = None
+        self._prefix = prefix
+        self._argument = argument
+        self._tags = tags
+        self._parse_arguments = parse_arguments
+        _set_source(self, _UNPARSED)
+        _set_arguments(self, _UNPARSED)
+        _set_tags(self, _UNPARSED)
+
+    source = _LazySlot(
+        'source', lambda self: NickMask.from_group(self._prefix))
+    arguments = _LazySlot(
+        'arguments', lambda self: self._parse_arguments(self._argument))
+    tags = _LazySlot(
+        'tags', lambda self: message.Tags.from_group(self._tags))
+
+
 def is_channel(string):
     """Check if a string is a channel name.
 
@@ -710,6 +1554,9 @@ class NickMask(six.text_type):
     >>> nm.user
     'username'
 
+    >>> nm.userhost
+    'username@example.com'
+
     >>> isinstance(nm, six.text_type)
     True
 
@@ -728,33 +1575,78 @@ class NickMask(six.text_type):
     >>> nm.userhost
     >>> nm.host
     >>> nm.user
+
+    The mask is split into its parts once, when it is created.
     """
+    __slots__ = ('nick', 'userhost', 'user', 'host')
+
+    def __new__(cls, value=''):
+        self = super(NickMask, cls).__new__(cls, value)
+        nick, sep, userhost = self.partition("!")
+        user, sep, host = userhost.partition('@')
+        self.nick = nick
+        self.userhost = userhost or None
+        self.user = user or None
+        self.host = host or None
+        return self
+
     @classmethod
     def from_params(cls, nick, user, host):
         return cls('{nick}!{user}@{host}'.format(**vars()))
 
-    @property
-    def nick(self):
-        nick, sep, userhost = self.partition("!")
-        return nick
+    @classmethod
+    def from_group(cls, group):
+        """
+        Construct a NickMask from the regex group, sharing one instance
+        between the recently seen occurrences of the same prefix.
 
-    @property
-    def userhost(self):
-        nick, sep, userhost = self.partition("!")
-        return userhost or None
+        >>> a = NickMask.from_group('nick!user@host')
+        >>> a is NickMask.from_group('nick!user@host')
+        True
+        >>> NickMask.from_group('')
+        """
+        return _interned_nickmask(cls, group) if group else None
 
-    @property
-    def host(self):
-        nick, sep, userhost = self.partition("!")
-        user, sep, host = userhost.partition('@')
-        return host or None
 
-    @property
-    def user(self):
-        nick, sep, userhost = self.partition("!")
-        user, sep, host = userhost.partition('@')
-        return user or None
+@functools.lru_cache(maxsize=4096)
+def _interned_nickmask(cls, prefix):
+    return cls(prefix)
 
-    @classmethod
-    def from_group(cls, group):
-        return cls(group) if group else None
+
+def _pack_targets(targets, size, max_count=None, sep=','):
+    """
+    Join `targets` with `sep` into as few groups as possible, in order,
+    of at most `max_count` targets and `size` encoded bytes each.
+
+    >>> list(_pack_targets(['#a', '#bb', '#c', '#d', '#e'], 100, 2))
+    ['#a,#bb', '#c,#d', '#e']
+    >>> list(_pack_targets(['#a', '#bb', '#c'], 6))
+    ['#a,#bb', '#c']
+    """
+    group = []
+    length = 0
+    for target in targets:
+        target_length = len(target.encode('utf-8'))
+        if target_length > size:
+            raise MessageTooLong("Target %r does not fit in a line" % target)
+        if group and (length + len(sep) + target_length > size
+                      or len(group) == max_count):
+            yield sep.join(group)
+            group = []
+        length = length + len(sep) + target_length if group else target_length
+        group.append(target)
+    if group:
+        yield sep.join(group)
+
+
+@functools.lru_cache(maxsize=1024)
+def _command_prefix(command, target):
+    """
+    The encoded ``COMMAND target :`` in front of a line's text.
+
+    >>> _command_prefix('PRIVMSG', '#chan')
+    b'PRIVMSG #chan :'
+    """
+    if not target or ' ' in target or '\n' in target:
+        raise InvalidCharacters("Invalid target %r" % target)
+    return ('%s %s :' % (command, target)).encode('utf-8')
@@ -0,0 +1,333 @@
+"""
+Opening connections to IRC servers.
+"""
+
+from __future__ import absolute_import
+
+import ssl
+import time
+import socket
+import asyncio
+import inspect
+import logging
+import itertools
+
+log = logging.getLogger(__name__)
+
+
+class SessionCache(object):
+    """
+    The last TLS session of each server a context connected to, so that
+    reconnecting resumes the session instead of doing a full handshake.
+    """
+    def __init__(self):
+        self.sessions = {}
+
+    def get(self, server_hostname):
+        return self.sessions.get(server_hostname)
+
+    def save(self, ssl_object):
+        "Remember the session of a connected SSLObject"
+        session = ssl_object.session
+        if session is not None and ssl_object.server_hostname:
+            self.sessions[ssl_object.server_hostname] = session
+
+
+def _can_resume():
+    """
+    Whether ssl.SSLObject has the private _create() hook that
+    _ResumingSSLObject overrides, with the arguments it passes on.
+    """
+    create = getattr(ssl.SSLObject, '_create', None)
+    try:
+        parameters = inspect.signature(create).parameters
+    except (TypeError, ValueError):
+        return False
+    return {'incoming', 'outgoing', 'server_side', 'server_hostname',
+            'session', 'context'} <= set(parameters)
+
+
+class _ResumingSSLObject(ssl.SSLObject):
+    session_cache = None
+
+    @classmethod
+    def _create(cls, incoming, outgoing, server_side=False,
+                server_hostname=None, session=None, context=None):
+        # asyncio has no way to pass a session, so look it up here
+        if session is None and server_hostname and not server_side:
+            session = cls.session_cache.get(server_hostname)
+        return super(_ResumingSSLObject, cls)._create(
+            incoming, outgoing, server_side=server_side,
+            server_hostname=server_hostname, session=session,
+            context=context)
+
+
+def session_cache(context):
+    """
+    The SessionCache of an SSLContext. The first call installs it, after
+    which connections made with the context resume cached sessions.
+
+    This changes `context` itself: it gets a session_cache attribute,
+    and its sslobject_class is replaced with one that looks sessions up
+    in the cache, through the private ssl.SSLObject._create(). Every
+    user of the context is affected. If that hook is missing or has
+    changed, or the context already has its own sslobject_class,
+    sessions are still cached but not resumed.
+    """
+    cache = getattr(context, 'session_cache', None)
+    if cache is None:
+        cache = context.session_cache = SessionCache()
+        if context.sslobject_class is not ssl.SSLObject:
+            log.warning('Not resuming TLS sessions: the context has its '
+                        'own sslobject_class')
+        elif not _can_resume():
+            log.warning('Not resuming TLS sessions: unknown '
+                        'ssl.SSLObject._create()')
+        else:
+            context.sslobject_class = type(
+                'ResumingSSLObject', (_ResumingSSLObject,),
+                dict(session_cache=cache))
+    return cache
+
+
+def tls_context(verify=True):
+    """
+    A default client SSLContext, with session resumption. Pass
+    ``verify=False`` to skip certificate checks.
+    """
+    context = ssl.create_default_context()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    session_cache(context)
+    return context
+
+
+class SocketOptions(object):
+    """
+    TCP options for the connection to the server. The defaults suit
+    chat: no Nagle delay for short interactive lines, keepalive probes
+    to notice a dead connection within about two minutes, and a large
+    receive buffer to absorb bursts of long tagged lines.
+
+    nodelay -- Set TCP_NODELAY.
+
+    keepalive -- Set SO_KEEPALIVE, with the first probe after
+        `keepalive_idle` seconds of silence, then one every
+        `keepalive_interval` seconds, giving up after `keepalive_count`
+        unanswered probes. The tuning options are skipped where the
+        platform lacks them.
+
+    receive_buffer, send_buffer -- SO_RCVBUF and SO_SNDBUF in bytes, or
+        None to leave the system default.
+
+    reader_limit -- The buffer limit of the StreamReader, which bounds
+        the length of a line read with read_size=None.
+
+    Options the system refuses are logged and skipped; effective()
+    reports what the socket ended up with.
+    """
+    def __init__(self, nodelay=True, keepalive=True, keepalive_idle=60,
+                 keepalive_interval=15, keepalive_count=4,
+                 receive_buffer=256 * 1024, send_buffer=None,
+                 reader_limit=2 ** 16):
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.receive_buffer = receive_buffer
+        self.send_buffer = send_buffer
+        self.reader_limit = reader_limit
+
+    def _settings(self):
+        "(level, option name, value) for each option to set"
+        settings = [
+            (socket.IPPROTO_TCP, 'TCP_NODELAY', int(self.nodelay)),
+            (socket.SOL_SOCKET, 'SO_KEEPALIVE', int(self.keepalive)),
+        ]
+        if self.keepalive:
+            # macOS calls the idle time TCP_KEEPALIVE
+            idle = 'TCP_KEEPIDLE' if hasattr(socket, 'TCP_KEEPIDLE') else (
+                'TCP_KEEPALIVE')
+            settings.extend([
+                (socket.IPPROTO_TCP, idle, self.keepalive_idle),
+                (socket.IPPROTO_TCP, 'TCP_KEEPINTVL', self.keepalive_interval),
+                (socket.IPPROTO_TCP, 'TCP_KEEPCNT', self.keepalive_count),
+            ])
+        if self.receive_buffer is not None:
+            settings.append(
+                (socket.SOL_SOCKET, 'SO_RCVBUF', self.receive_buffer))
+        if self.send_buffer is not None:
+            settings.append((socket.SOL_SOCKET, 'SO_SNDBUF', self.send_buffer))
+        return settings
+
+    def apply(self, sock):
+        """
+        Set the options on `sock`. Buffer sizes are best set before
+        connecting, as the TCP window scale is agreed on then.
+        """
+        for level, name, value in self._settings():
+            option = getattr(socket, name, None)
+            if option is None:
+                continue
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as exn:
+                log.warning('Could not set %s to %s: %s', name, value, exn)
+
+    def effective(self, sock):
+        """
+        The values of the options on `sock`, by option name, as the
+        system reports them (Linux reports twice the buffer sizes set,
+        as it counts its bookkeeping).
+        """
+        names = [(socket.IPPROTO_TCP, 'TCP_NODELAY'),
+                 (socket.SOL_SOCKET, 'SO_KEEPALIVE'),
+                 (socket.SOL_SOCKET, 'SO_RCVBUF'),
+                 (socket.SOL_SOCKET, 'SO_SNDBUF')]
+        names.extend((level, name) for level, name, value
+                     in self._settings()[2:] if name.startswith('TCP_'))
+        values = {}
+        for level, name in names:
+            option = getattr(socket, name, None)
+            if option is None:
+                continue
+            try:
+                values[name] = sock.getsockopt(level, option)
+            except OSError:
+                pass
+        values['reader_limit'] = self.reader_limit
+        return values
+
+
+class DNSCache(object):
+    """
+    getaddrinfo() results by host and port, kept for `ttl` seconds so
+    that reconnecting skips the lookup. (getaddrinfo() does not report
+    the records' TTL, so one TTL applies to all.)
+    """
+    def __init__(self, ttl=300, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+
+    async def resolve(self, host, port):
+        """
+        The addresses of `host`, as getaddrinfo() tuples for TCP.
+        Returns them and whether they came from the cache.
+        """
+        key = host, port
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > self.clock():
+            return entry[1], True
+        infos = await asyncio.get_event_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM)
+        self._entries[key] = self.clock() + self.ttl, infos
+        return infos, False
+
+    def forget(self, host, port):
+        self._entries.pop((host, port), None)
+
+
+dns_cache = DNSCache()
+"The DNSCache of this process"
+
+HAPPY_EYEBALLS_DELAY = 0.25
+"Seconds to give a connection attempt before starting the next one"
+
+
+def _interleave(infos):
+    """
+    Alternate between address families, starting with the first one
+    (RFC 8305, section 4).
+
+    >>> infos = [(10, 'a'), (10, 'b'), (10, 'c'), (2, 'd')]
+    >>> [info[1] for info in _interleave(infos)]
+    ['a', 'd', 'b', 'c']
+    """
+    families = {}
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    return [info for group in itertools.zip_longest(*families.values())
+            for info in group if info is not None]
+
+
+async def _connect_socket(family, type, proto, address, options):
+    sock = socket.socket(family, type, proto)
+    try:
+        sock.setblocking(False)
+        if options is not None:
+            options.apply(sock)
+        await asyncio.get_event_loop().sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def race(infos, delay=HAPPY_EYEBALLS_DELAY, options=None):
+    """
+    Connect to the first of the getaddrinfo() tuples `infos` that
+    answers. Attempts start `delay` seconds apart, alternating between
+    address families, or as soon as the previous attempt fails (happy
+    eyeballs, RFC 8305). Each socket gets the SocketOptions `options`
+    before it connects. Returns the connected socket.
+    """
+    pending = set()
+    errors = []
+    queue = _interleave(infos)
+    try:
+        while queue or pending:
+            if queue:
+                family, type, proto, _, address = queue.pop(0)
+                pending.add(asyncio.ensure_future(
+                    _connect_socket(family, type, proto, address, options)))
+            done, pending = await asyncio.wait(
+                pending, timeout=delay if queue else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            connected = []
+            for attempt in done:
+                if attempt.exception() is None:
+                    connected.append(attempt.result())
+                else:
+                    errors.append(attempt.exception())
+            if connected:
+                for sock in connected[1:]:
+                    sock.close()
+                return connected[0]
+    finally:
+        for attempt in pending:
+            attempt.cancel()
+    if len(errors) == 1:
+        raise errors[0]
+    raise OSError('Could not connect to any address: %s' % (
+        ', '.join(str(error) for error in errors) or 'none found'))
+
+
+async def open_socket(host, port, timings=None, cache=dns_cache,
+                      options=None):
+    """
+    A socket connected to `host`, looked up through `cache`, with the
+    attempts raced by race() and the SocketOptions `options` applied.
+    If the cached addresses all fail, they are looked up again once.
+    The seconds the lookup and the connect took go in
+    timings['resolve'] and timings['connect'].
+    """
+    if timings is None:
+        timings = {}
+    while True:
+        start = time.monotonic()
+        infos, cached = await cache.resolve(host, port)
+        timings['resolve'] = time.monotonic() - start
+        start = time.monotonic()
+        try:
+            sock = await race(infos, options=options)
+        except OSError:
+            if not cached:
+                raise
+            log.info('Cached addresses of %s failed; looking it up', host)
+            cache.forget(host, port)
+            continue
+        timings['connect'] = time.monotonic() - start
+        return sock
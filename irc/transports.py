@@ -0,0 +1,330 @@
+"""
+Line-oriented transports for ServerConnection.
+
+Both transports offer the same small interface: ``read_lines()`` returns
+the next batch of complete lines from the server, ``write()``,
+``writelines()`` and ``drain()`` send data, and ``write_eof()``,
+``close()`` and ``abort()`` shut the connection down.
+
+StreamTransport goes through asyncio.open_connection and its
+StreamReader/StreamWriter pair. ProtocolTransport is an asyncio.Protocol
+that splits lines directly in data_received and writes straight to the
+socket transport, using pause_writing/resume_writing for flow control.
+"""
+
+from __future__ import absolute_import
+
+import time
+import asyncio
+import logging
+import collections
+
+from . import connection
+
+log = logging.getLogger(__name__)
+
+
+class LineSplitter(object):
+    r"""
+    Split incoming data into lines, keeping the unfinished tail.
+
+    >>> splitter = LineSplitter(max_line_length=10)
+    >>> splitter.feed(b'PING :a\r\nPI')
+    [b'PING :a\r']
+    >>> splitter.feed(b'NG :b\r\n')
+    [b'PING :b\r']
+    >>> splitter.feed(b'x' * 11)
+    []
+    >>> splitter.feed(b'\nok\n')
+    [b'ok']
+    >>> splitter.feed(b'tail')
+    []
+    >>> splitter.flush()
+    [b'tail']
+    """
+    def __init__(self, max_line_length):
+        self.max_line_length = max_line_length
+        self.tail = b''
+        self.discarding = False
+
+    def feed(self, data):
+        "Return the complete lines (without LF) ending in `data`"
+        lines = (self.tail + data).split(b'\n')
+        self.tail = lines.pop()
+        if self.discarding and lines:
+            # The first line is the end of the overlong one
+            del lines[0]
+            self.discarding = False
+        if len(self.tail) > self.max_line_length:
+            log.error('Discarding %s bytes without a line ending',
+                      len(self.tail))
+            self.tail = b''
+            self.discarding = True
+        return lines
+
+    def flush(self):
+        "Return the unfinished tail, if any, as a final line"
+        tail, self.tail = self.tail, b''
+        if self.discarding:
+            self.discarding = False
+            return []
+        return [tail] if tail else []
+
+
+class StreamTransport(object):
+    """
+    A transport on top of asyncio.open_connection.
+
+    If read_size is None, lines are read one at a time with readline();
+    otherwise the socket is read in chunks of read_size bytes and all
+    complete lines of a chunk are returned at once.
+    """
+    def __init__(self, reader, writer, read_size=65536,
+                 max_line_length=8192):
+        self.reader = reader
+        self.writer = writer
+        self.read_size = read_size
+        self.splitter = LineSplitter(max_line_length)
+        self.timings = {}
+        self.socket_options = {}
+
+    @classmethod
+    async def open(cls, host, port, ssl=None, socket_options=None,
+                   **kwargs):
+        """
+        Connect (see connection.open_socket), and with an SSLContext
+        `ssl`, do the TLS handshake. The seconds each step took are put
+        in timings, and the effective connection.SocketOptions in
+        socket_options.
+        """
+        if socket_options is None:
+            socket_options = connection.SocketOptions()
+        timings = {}
+        sock = await connection.open_socket(
+            host, port, timings, options=socket_options)
+        effective = socket_options.effective(sock)
+        limit = socket_options.reader_limit
+        if ssl is not None and not hasattr(asyncio.StreamWriter, 'start_tls'):
+            # No StreamWriter.start_tls before Python 3.11
+            start = time.monotonic()
+            reader, writer = await asyncio.open_connection(
+                sock=sock, ssl=ssl, server_hostname=host, limit=limit)
+            timings['tls_handshake'] = time.monotonic() - start
+        else:
+            reader, writer = await asyncio.open_connection(
+                sock=sock, limit=limit)
+            if ssl is not None:
+                start = time.monotonic()
+                await writer.start_tls(ssl, server_hostname=host)
+                timings['tls_handshake'] = time.monotonic() - start
+        self = cls(reader, writer, **kwargs)
+        self.timings = timings
+        self.socket_options = effective
+        return self
+
+    async def read_lines(self):
+        """
+        Read the next batch of lines (bytes, without LF) from the server.
+        Returns an empty list on EOF.
+        """
+        if not self.read_size:
+            line = await self.reader.readline()
+            return [line] if line else []
+        while True:
+            data = await self.reader.read(self.read_size)
+            if not data:
+                return self.splitter.flush()
+            lines = self.splitter.feed(data)
+            if lines:
+                return lines
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def writelines(self, lines):
+        self.writer.writelines(lines)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def can_write_eof(self):
+        return self.writer.can_write_eof()
+
+    def write_eof(self):
+        self.writer.write_eof()
+
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.transport.abort()
+
+
+class ProtocolTransport(asyncio.Protocol):
+    """
+    A transport implemented directly as an asyncio.Protocol.
+
+    Incoming data is split into lines in data_received and queued for
+    read_lines(). Reading from the socket is paused while more than
+    max_pending_lines are waiting to be processed.
+    """
+    max_pending_lines = 10000
+
+    def __init__(self, read_size=None, max_line_length=8192):
+        # read_size is accepted for symmetry with StreamTransport; the
+        # event loop decides how much data_received gets at a time.
+        self.splitter = LineSplitter(max_line_length)
+        self.transport = None
+        self._batches = collections.deque()
+        self._pending = 0
+        self._eof = False
+        self._exception = None
+        self._read_waiter = None
+        self._reading_paused = False
+        self._drain_waiter = None
+        self._writing_paused = False
+        self._connection_lost = False
+        self.timings = {}
+        self.socket_options = {}
+
+    @classmethod
+    async def open(cls, host, port, ssl=None, socket_options=None,
+                   **kwargs):
+        """
+        Connect (see connection.open_socket), and with an SSLContext
+        `ssl`, do the TLS handshake. The seconds each step took are put
+        in timings, and the effective connection.SocketOptions in
+        socket_options (there is no StreamReader, so no reader_limit).
+        """
+        if socket_options is None:
+            socket_options = connection.SocketOptions()
+        loop = asyncio.get_event_loop()
+        timings = {}
+        sock = await connection.open_socket(
+            host, port, timings, options=socket_options)
+        effective = socket_options.effective(sock)
+        del effective['reader_limit']
+        transport, protocol = await loop.create_connection(
+            lambda: cls(**kwargs), sock=sock)
+        protocol.timings.update(timings)
+        protocol.socket_options = effective
+        if ssl is not None:
+            start = time.monotonic()
+            protocol.transport = await loop.start_tls(
+                transport, protocol, ssl, server_hostname=host)
+            protocol.timings['tls_handshake'] = time.monotonic() - start
+        return protocol
+
+    # asyncio.Protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        lines = self.splitter.feed(data)
+        if not lines:
+            return
+        self._batches.append(lines)
+        self._pending += len(lines)
+        if self._pending > self.max_pending_lines and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+        self._wake_reader()
+
+    def eof_received(self):
+        self._end()
+        # Keep the transport open so that a QUIT can still be written
+        return True
+
+    def connection_lost(self, exc):
+        self._exception = exc
+        self._connection_lost = True
+        self._writing_paused = False
+        self._end()
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _end(self):
+        if not self._eof:
+            self._eof = True
+            tail = self.splitter.flush()
+            if tail:
+                self._batches.append(tail)
+            self._wake_reader()
+
+    def _wake_reader(self):
+        waiter, self._read_waiter = self._read_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    # Transport interface used by ServerConnection
+
+    async def read_lines(self):
+        """
+        Return the next batch of lines (bytes, without LF) from the
+        server. Returns an empty list on EOF.
+        """
+        while not self._batches:
+            if self._eof:
+                if self._exception is not None:
+                    raise self._exception
+                return []
+            self._read_waiter = asyncio.get_event_loop().create_future()
+            await self._read_waiter
+        lines = self._batches.popleft()
+        self._pending -= len(lines)
+        if self._reading_paused and self._pending <= self.max_pending_lines:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return lines
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writelines(self, lines):
+        self.transport.writelines(lines)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            # Yield, like StreamWriter.drain, so that connection_lost
+            # gets a chance to run
+            await asyncio.sleep(0)
+        if self._connection_lost:
+            if self._exception is not None:
+                raise self._exception
+            raise ConnectionResetError('Connection lost')
+        if self._writing_paused:
+            if self._drain_waiter is None:
+                self._drain_waiter = asyncio.get_event_loop().create_future()
+            await asyncio.shield(self._drain_waiter)
+
+    def can_write_eof(self):
+        return self.transport.can_write_eof()
+
+    def write_eof(self):
+        self.transport.write_eof()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def close(self):
+        self.transport.close()
+
+    def abort(self):
+        self.transport.abort()
@@ -0,0 +1,336 @@
+"""
+Connection shards in worker processes.
+
+A ProcessPool is a pool.ConnectionPool whose connections each run in a
+worker process, with their own event loop, so reading and parsing the
+lines of busy channels is spread over several cores. Workers send their
+events to the pool as plain tuples over a socket pair, a batch per turn
+of their event loop; the pool turns them back into Events and runs the
+handlers. Commands sent through a shard go back over the same socket.
+Both ends use asyncio streams, so neither blocks its event loop, and a
+pool that falls behind stops reading, which slows its workers down.
+"""
+
+from __future__ import absolute_import
+
+import pickle
+import socket
+import struct
+import asyncio
+import logging
+import functools
+import multiprocessing
+
+from . import client
+from . import dispatch
+from . import message
+from . import pool
+from . import ratelimit
+
+log = logging.getLogger(__name__)
+
+context = multiprocessing.get_context('spawn')
+"Workers are spawned, as forking a process with a running loop is unsafe"
+
+_CLOSE = None, (), {}
+
+_LENGTH = struct.Struct('!I')
+
+
+def _write(writer, obj):
+    "Send `obj` as a length-prefixed pickle"
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    writer.writelines([_LENGTH.pack(len(data)), data])
+
+
+async def _read(reader):
+    "Receive what _write() sent; raises IncompleteReadError at EOF"
+    length, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return pickle.loads(await reader.readexactly(length))
+
+
+def _pack(event):
+    "An Event as a tuple of builtins, which pickle quickly"
+    source = event.source
+    tags = event.tags
+    return (event.type, source and str(source), event.target,
+            list(event.arguments), dict(tags) if tags else None)
+
+
+def _unpack(item):
+    type, source, target, arguments, tags = item
+    return client.Event(
+        type, source and client.NickMask(source), target, arguments,
+        message.Tags(tags) if tags else None)
+
+
+def _run_worker(*args):
+    try:
+        asyncio.run(_worker(*args))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker(sock, connect_args, connection_kwargs, event_types):
+    loop = asyncio.get_running_loop()
+    reader, writer = await asyncio.open_connection(sock=sock)
+    batch = []
+
+    def flush():
+        _write(writer, batch)
+        batch.clear()
+
+    async def forward(connection, event):
+        first = not batch
+        if first:
+            loop.call_soon(flush)
+        batch.append(_pack(event))
+        if first:
+            # While the pool is behind, stop reading from the server
+            await writer.drain()
+
+    def wants(event_type):
+        return event_type == 'welcome' or event_type in event_types
+
+    connection = client.ServerConnection(
+        forward, handler_wants=wants if event_types is not None else None,
+        **connection_kwargs)
+    args, kwargs = connect_args
+    await connection.connect(*args, **kwargs)
+    keeper = loop.create_task(_keep_connected(connection))
+    try:
+        while True:
+            try:
+                name, args, kwargs = await _read(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # The pool is gone
+                break
+            if name is None:
+                break
+            try:
+                result = await getattr(connection, name)(*args, **kwargs)
+            except Exception:
+                log.exception("%s() failed", name)
+                continue
+            if name == 'join_many':
+                for channel, joined in result.items():
+                    joined.add_done_callback(
+                        functools.partial(_log_refusal, channel))
+    finally:
+        keeper.cancel()
+        await connection.disconnect()
+        writer.close()
+
+
+def _log_refusal(channel, joined):
+    "Log a join the server refused, as nobody awaits it in the worker"
+    if not joined.cancelled() and joined.exception() is not None:
+        log.warning("Could not join %s: %s",
+                    channel, joined.exception().args[-1])
+
+
+async def _keep_connected(connection):
+    "Reconnect, backing off, whenever the connection is lost"
+    delay = 0
+    while True:
+        await connection.wait_disconnected()
+        delay = min(2 * delay or 1, 60)
+        await asyncio.sleep(delay)
+        try:
+            await connection.reconnect(timeout=30)
+        except client.ServerConnectionError:
+            log.exception("Reconnecting failed")
+            await connection.disconnect()
+        else:
+            delay = 0
+
+
+class WorkerShard(client._WelcomeMixin):
+    """
+    Stands in for the ServerConnection of a worker process. The
+    ServerConnection commands in `commands` can be called on it; they
+    are sent to the worker, and the coroutine returns None once sent.
+    Other ServerConnection attributes, such as get_nickname() or
+    features, live in the worker and raise AttributeError here.
+    join_many() returns an empty dict, as the join futures stay in the
+    worker; the join events come back as events.
+    """
+    commands = frozenset([
+        'send_items', 'send_raw', 'action', 'admin', 'cap', 'ctcp',
+        'ctcp_reply', 'globops', 'info', 'invite', 'ison', 'join', 'kick',
+        'links', 'list', 'lusers', 'mode', 'motd', 'names', 'nick',
+        'notice', 'oper', 'part', 'pass_', 'ping', 'pong', 'privmsg',
+        'privmsg_many', 'quit', 'squit', 'stats', 'time', 'topic', 'trace',
+        'user', 'userhost', 'users', 'version', 'wallops', 'who', 'whois',
+        'whowas',
+    ])
+
+    def __init__(self, pool, shard):
+        self.pool = pool
+        self.shard = shard
+        self.process = None
+        self.reader = self.writer = None
+        self._reader_task = None
+        self.joined_channels = set()
+        self.welcomed_event = asyncio.Event()
+        self.disconnected_event = asyncio.Event()
+        self.disconnected_event.set()
+
+    @property
+    def connected(self):
+        return not self.disconnected_event.is_set()
+
+    async def connect(self, *args, **kwargs):
+        """
+        Start the worker, which connects with the arguments of
+        ServerConnection.connect().
+        """
+        sock, child_sock = socket.socketpair()
+        self.process = context.Process(
+            target=_run_worker, daemon=True,
+            args=(child_sock, (args, kwargs), self.pool.connection_kwargs,
+                  self.pool.event_types))
+        self.process.start()
+        child_sock.close()
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.welcomed_event.clear()
+        self.disconnected_event.clear()
+        self._reader_task = self.pool.loop.create_task(self._read_batches())
+        return self
+
+    async def _read_batches(self):
+        try:
+            while True:
+                batch = await _read(self.reader)
+                # While the queue is full, the socket isn't read, so the
+                # worker's writes back up and it stops reading too
+                await self.pool._batches.put((self, batch))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._lost()
+
+    def _lost(self):
+        if self.disconnected_event.is_set():
+            return
+        self.writer.close()
+        self.disconnected_event.set()
+
+    async def _send(self, name, args, kwargs):
+        if not self.connected:
+            raise client.ServerNotConnectedError("Not connected.")
+        _write(self.writer, (name, args, kwargs))
+        await self.writer.drain()
+
+    def __getattr__(self, name):
+        if name not in self.commands:
+            raise AttributeError(
+                "%r object has no attribute %r"
+                % (type(self).__name__, name))
+
+        async def command(*args, **kwargs):
+            await self._send(name, args, kwargs)
+        command.__name__ = name
+        return command
+
+    async def join_many(self, channels):
+        await self._send('join_many', (list(channels),), {})
+        return {}
+
+    def wait_disconnected(self):
+        return self.disconnected_event.wait()
+
+    async def disconnect(self, timeout=1):
+        "Stop the worker, which disconnects first"
+        if not self.connected:
+            return
+        await self._send(*_CLOSE)
+        await self.pool.loop.run_in_executor(
+            None, self.process.join, timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._reader_task.cancel()
+        self._lost()
+
+
+class ProcessPool(pool.ConnectionPool):
+    """
+    A ConnectionPool of `size` worker processes, each with one
+    connection. Handlers run in this process, and get the WorkerShard of
+    the event's worker as their connection argument.
+
+    event_types -- The event types to send over from the workers, or
+        None for all. Unwanted events are not even built in the workers.
+
+    max_batches -- How many batches of events may wait for the handlers.
+        Once that many wait, the pool stops reading from the workers,
+        which then stop reading from the server, so that handlers that
+        fall behind slow the workers down instead of using ever more
+        memory.
+
+    rate_limits -- A ratelimit.RateLimits for the account. Workers can't
+        share a RateLimiter, so each gets an equal share of the limits
+        (see ratelimit.share). add_shard() is not possible with them.
+
+    Other keyword arguments are passed on to each ServerConnection, in
+    the worker, and so must pickle. A worker reconnects by itself when
+    its connection is lost; the pool only moves channels away from a
+    shard whose worker process died.
+    """
+    def __init__(self, size, handler=None, *, loop=None, replicas=64,
+                 event_types=None, max_batches=100, rate_limits=None,
+                 **kwargs):
+        if rate_limits:
+            kwargs['rate_limits'] = ratelimit.share(rate_limits, size)
+        self.event_types = (
+            frozenset(event_types) if event_types is not None else None)
+        self.handlers = dispatch.HandlerRegistry()
+        self._batches = asyncio.Queue(max_batches)
+        self._dispatcher = None
+        self.connection_kwargs = kwargs
+        super(ProcessPool, self).__init__(
+            size, handler, loop=loop, replicas=replicas)
+
+    async def add_shard(self, timeout=None):
+        if self.connection_kwargs.get('rate_limits'):
+            raise ValueError("The rate limits are shared among the "
+                             "workers the pool started with")
+        return await super(ProcessPool, self).add_shard(timeout)
+
+    def _add_connection(self):
+        shard = WorkerShard(self, len(self.shards))
+        self.shards.append(shard)
+        return shard
+
+    def add_global_handler(self, event, handler, priority=0):
+        "Like ServerConnection.add_global_handler(), for every worker"
+        self.handlers.add(event, handler, priority)
+
+    def remove_global_handler(self, event, handler):
+        return self.handlers.remove(event, handler)
+
+    async def connect(self, *args, **kwargs):
+        if self._dispatcher is None:
+            self._dispatcher = self.loop.create_task(self._dispatch_events())
+        return await super(ProcessPool, self).connect(*args, **kwargs)
+
+    async def disconnect(self, message=""):
+        await super(ProcessPool, self).disconnect(message)
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    async def _dispatch_events(self):
+        wanted = self.event_types
+        while True:
+            shard, batch = await self._batches.get()
+            for item in batch:
+                event = _unpack(item)
+                event.shard = shard.shard
+                if event.type == 'welcome':
+                    shard.welcomed_event.set()
+                    if wanted is not None and 'welcome' not in wanted:
+                        continue
+                await dispatch.call_handlers(
+                    shard, event, self.handler, self.handlers)
+
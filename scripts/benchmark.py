@@ -0,0 +1,653 @@
+#! /usr/bin/env python
+#
+# Micro-benchmarks for the hot paths of irc.client.
+#
+# Each subcommand times the current implementation against the code
+# path it replaced, on a synthetic Twitch-like corpus.
+#
+# This program is free without restrictions; do anything you like with
+# it.
+
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+
+import irc.client
+import irc.message
+import irc.pool
+import irc.transports
+import irc.workers
+
+
+TAGS_TEMPLATE = (
+    '@badge-info=subscriber/{months};badges=subscriber/{months},premium/1;'
+    'color=#{color:06X};display-name={name};emotes=;first-msg=0;flags=;'
+    'id={id:032x};mod=0;returning-chatter=0;room-id=1337;subscriber=1;'
+    'tmi-sent-ts={ts};turbo=0;user-id={uid};user-type='
+)
+
+WORDS = 'darbSubPipe pog the run is on pace for a pb tonight lets go'.split()
+
+
+def twitch_corpus(n, seed=0):
+    """
+    Return `n` raw lines (bytes, no CR LF) resembling a busy Twitch chat:
+    mostly tagged PRIVMSGs, with some JOIN/PART, USERNOTICE and PING.
+    """
+    rng = random.Random(seed)
+    names = ['viewer%d' % i for i in range(200)]
+    channels = ['#chan%d' % i for i in range(10)]
+    lines = []
+    for i in range(n):
+        name = rng.choice(names)
+        channel = rng.choice(channels)
+        prefix = ':{0}!{0}@{0}.tmi.twitch.tv'.format(name)
+        kind = rng.random()
+        if kind < 0.85:
+            tags = TAGS_TEMPLATE.format(
+                months=rng.randrange(60), color=rng.randrange(1 << 24),
+                name=name.capitalize(), id=rng.getrandbits(128),
+                ts=1500000000000 + i, uid=rng.randrange(10 ** 8))
+            text = ' '.join(rng.choice(WORDS)
+                            for _ in range(rng.randrange(1, 15)))
+            line = '%s %s PRIVMSG %s :%s' % (tags, prefix, channel, text)
+        elif kind < 0.95:
+            line = '%s %s %s' % (prefix, rng.choice(['JOIN', 'PART']),
+                                 channel)
+        elif kind < 0.99:
+            line = ('@msg-id=sub;system-msg=%s\\ssubscribed\\sfor\\s3\\s'
+                    'months! :tmi.twitch.tv USERNOTICE %s' % (name, channel))
+        else:
+            line = 'PING :tmi.twitch.tv'
+        lines.append(line.encode('utf-8'))
+    return lines
+
+
+def report(name, count, elapsed, unit='lines'):
+    print('%-28s %12.0f %s/s  (%.3f s)' %
+          (name, count / elapsed, unit, elapsed))
+
+
+def timed(fn, lines, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        fn(lines)
+        best = min(best, time.perf_counter() - t1)
+    return best
+
+
+def parse_regex(lines):
+    match = irc.client._rfc_1459_command_regexp.match
+    for line in lines:
+        grp = match(line.decode()).group
+        grp('tags'), grp('prefix'), grp('command'), grp('argument')
+
+
+def parse_split(lines):
+    split_line = irc.message.split_line
+    for line in lines:
+        split_line(line)
+
+
+def bench_parse(args):
+    "regex vs message.split_line"
+    lines = twitch_corpus(args.lines)
+    for name, fn in [('regex (decode + match)', parse_regex),
+                     ('message.split_line', parse_split)]:
+        report(name, len(lines), timed(fn, lines, args.repeat))
+
+
+def old_tag_parse(item):
+    key, sep, value = item.partition('=')
+    value = value.replace('\\:', ';')
+    value = value.replace('\\s', ' ')
+    value = value.replace('\\n', '\n')
+    value = value.replace('\\r', '\r')
+    value = value.replace('\\\\', '\\')
+    return {'key': key, 'value': value or None}
+
+
+def tags_list(groups):
+    # Tag.from_group as it was, plus the dict every consumer rebuilt
+    for group in groups:
+        tags = list(map(old_tag_parse, group.split(';')))
+        {
+            k: v
+            for kv in (tags or ())
+            for k, v in [(kv['key'], kv['value'])]
+        }
+
+
+def tags_mapping(groups):
+    from_group = irc.message.Tags.from_group
+    for group in groups:
+        from_group(group)
+
+
+def bench_tags(args):
+    "tag list vs message.Tags"
+    groups = [irc.message.split_line(line)[0]
+              for line in twitch_corpus(args.lines)]
+    groups = [group for group in groups if group]
+    for name, fn in [('list + rebuilt dict', tags_list),
+                     ('message.Tags', tags_mapping)]:
+        elapsed = timed(fn, groups, args.repeat)
+        report(name, len(groups), elapsed)
+        print('%-28s %12.2f us/line' % ('', 1e6 * elapsed / len(groups)))
+
+
+def process_lines(lines, lazy_events, handler, **kwargs):
+    loop = asyncio.new_event_loop()
+    connection = irc.client.ServerConnection(
+        handler, loop=loop, lazy_events=lazy_events, **kwargs)
+
+    async def run():
+        for line in lines:
+            await connection._process_line(line)
+
+    try:
+        t1 = time.perf_counter()
+        loop.run_until_complete(run())
+        return time.perf_counter() - t1
+    finally:
+        loop.close()
+
+
+def bench_events(args):
+    "eager Event vs LazyEvent"
+    lines = twitch_corpus(args.lines)
+
+    async def ignore(connection, event):
+        # Like ping/hostnotify: look at the type, ignore the rest
+        event.type
+
+    async def read_all(connection, event):
+        event.source, event.arguments, event.tags
+
+    for lazy in (False, True):
+        name = 'lazy' if lazy else 'eager'
+        for handler in (ignore, read_all):
+            elapsed = min(process_lines(lines, lazy, handler)
+                          for _ in range(args.repeat))
+            report('%s, %s' % (name, handler.__name__), len(lines), elapsed)
+
+        kept = []
+
+        async def keep(connection, event):
+            kept.append(event)
+
+        tracemalloc.start()
+        process_lines(lines, lazy, keep)
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%-28s %12.0f bytes/event retained' % (name, size / len(kept)))
+
+
+async def start_replay_server(data):
+    """
+    A stand-in IRC server that sends `data` to each client, then
+    half-closes and waits for the client to hang up.
+    """
+    clients = []
+
+    async def serve(reader, writer):
+        clients.append(asyncio.current_task())
+        writer.write(data)
+        await writer.drain()
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+
+    server = await asyncio.start_server(serve, '127.0.0.1', 0)
+    server.clients = clients
+    return server
+
+
+def replay(data, **kwargs):
+    """
+    Time a ServerConnection receiving `data` from a local replay server,
+    from connect() until the server's EOF has been processed.
+    """
+    loop = asyncio.new_event_loop()
+
+    async def ignore(connection, event):
+        pass
+
+    async def run():
+        server = await start_replay_server(data)
+        port = server.sockets[0].getsockname()[1]
+        connection = irc.client.ServerConnection(ignore, **kwargs)
+        t1 = time.perf_counter()
+        await connection.connect('127.0.0.1', port, 'benchmark')
+        await connection.wait_disconnected()
+        elapsed = time.perf_counter() - t1
+        server.close()
+        await asyncio.gather(*server.clients)
+        return elapsed
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def bench_read(args):
+    "readline() vs chunked reads"
+    lines = twitch_corpus(args.lines)
+    data = b''.join(line + b'\r\n' for line in lines)
+    for read_size in (None, 4096, 65536):
+        name = 'read(%s)' % read_size if read_size else 'readline()'
+        elapsed = min(replay(data, read_size=read_size)
+                      for _ in range(args.repeat))
+        report(name, len(lines), elapsed)
+
+
+async def send_queued(connection, count):
+    for i in range(count):
+        await connection.privmsg('#chan%d' % (i % 10), WORDS[i % 10])
+
+
+def send_lines(count, send=send_queued, **kwargs):
+    """
+    Time `send(connection, count)` to a local server that reads until
+    EOF, until the server has received everything.
+    """
+    loop = asyncio.new_event_loop()
+
+    async def sink(reader, writer):
+        await reader.read()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(sink, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        connection = irc.client.ServerConnection(**kwargs)
+        await connection.connect('127.0.0.1', port, 'benchmark')
+        t1 = time.perf_counter()
+        await send(connection, count)
+        await connection.disconnect()
+        elapsed = time.perf_counter() - t1
+        server.close()
+        await server.wait_closed()
+        return elapsed
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def bench_transport(args):
+    "StreamTransport vs ProtocolTransport"
+    lines = twitch_corpus(args.lines)
+    data = b''.join(line + b'\r\n' for line in lines)
+    for transport_class in (irc.transports.StreamTransport,
+                            irc.transports.ProtocolTransport):
+        name = transport_class.__name__
+        elapsed = min(replay(data, transport_class=transport_class)
+                      for _ in range(args.repeat))
+        report(name + ' receive', len(lines), elapsed)
+        elapsed = min(send_lines(len(lines), transport_class=transport_class)
+                      for _ in range(args.repeat))
+        report(name + ' send', len(lines), elapsed)
+
+
+def bench_subscribers(args):
+    "dispatching every event type vs only subscribed ones"
+    lines = twitch_corpus(args.lines)
+
+    async def ping_only(connection, event):
+        # Like the ping plugin: only PINGs matter
+        if event.type != 'ping':
+            return
+
+    for name, wants in [('every event type', None),
+                        ('ping only', {'ping'}.__contains__)]:
+        for lazy in (False, True):
+            elapsed = min(
+                process_lines(lines, lazy, ping_only, handler_wants=wants)
+                for _ in range(args.repeat))
+            label = '%s (%s)' % (name, 'lazy' if lazy else 'eager')
+            report(label, len(lines), elapsed)
+            print('%-28s %12.2f us/line' % ('', 1e6 * elapsed / len(lines)))
+
+
+async def send_each(connection, count):
+    # What send_raw() used to do: write and drain every line
+    for i in range(count):
+        await (await connection.privmsg('#chan%d' % (i % 10), WORDS[i % 10]))
+
+
+async def send_batch(connection, count):
+    async with connection.batch():
+        await send_queued(connection, count)
+
+
+async def send_via_items(connection, count):
+    # What privmsg() did before send_bytes()
+    for i in range(count):
+        await connection.send_items(
+            'PRIVMSG', '#chan%d' % (i % 10), ':' + WORDS[i % 10])
+
+
+async def send_via_bytes(connection, count):
+    for i in range(count):
+        await connection.send_bytes(
+            'PRIVMSG', '#chan%d' % (i % 10), WORDS[i % 10])
+
+
+def bench_send(args):
+    "write per line vs send queue vs batch()"
+    for name, send in [('write + drain per line', send_each),
+                       ('send queue', send_queued),
+                       ('batch()', send_batch)]:
+        elapsed = min(send_lines(args.lines, send)
+                      for _ in range(args.repeat))
+        report(name, args.lines, elapsed)
+
+
+def bench_prefix(args):
+    "send_items() vs send_bytes() with cached prefixes"
+    for name, send in [('send_items', send_via_items),
+                       ('send_bytes', send_via_bytes)]:
+        elapsed = min(send_lines(args.lines, send)
+                      for _ in range(args.repeat))
+        report(name, args.lines, elapsed)
+
+
+async def start_registration_server(caps, latency):
+    """
+    A stand-in server that negotiates `caps` and registers clients,
+    holding registration until CAP END if the client sent CAP LS, and
+    echoes JOINs. Every reply arrives `latency` seconds after the line
+    it answers.
+    """
+    loop = asyncio.get_event_loop()
+
+    async def serve(reader, writer):
+        def reply(line):
+            loop.call_later(latency, writer.write, line.encode() + b'\r\n')
+
+        negotiating = registered = False
+        seen = set()
+        async for line in reader:
+            line = line.rstrip(b'\r\n').decode()
+            command = line.partition(' ')[0]
+            seen.add(command)
+            if line == 'CAP LS 302':
+                negotiating = True
+                reply(':srv CAP * LS :' + ' '.join(caps))
+            elif line.startswith('CAP REQ :'):
+                reply(':srv CAP * ACK :' + line[len('CAP REQ :'):])
+            elif line == 'CAP END':
+                negotiating = False
+            elif command == 'JOIN':
+                for channel in line[len('JOIN '):].split(','):
+                    reply(':benchmark!b@h JOIN ' + channel)
+            if {'NICK', 'USER'} <= seen and not negotiating and not registered:
+                registered = True
+                reply(':srv 001 benchmark :Welcome')
+        writer.close()
+
+    return await asyncio.start_server(serve, '127.0.0.1', 0)
+
+
+async def register_round_trips(port, caps):
+    # Wait for each answer before sending the next step, and drain
+    # after every line
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    async def send(line):
+        writer.write(line.encode() + b'\r\n')
+        await writer.drain()
+
+    async def expect(word):
+        while word not in await reader.readline():
+            pass
+
+    await send('CAP LS 302')
+    await expect(b' LS ')
+    await send('CAP REQ :' + caps)
+    await expect(b' ACK ')
+    await send('CAP END')
+    await send('PASS oauth:x')
+    await send('NICK benchmark')
+    await send('USER benchmark 0 * :benchmark')
+    await expect(b' 001 ')
+    writer.close()
+
+
+async def register_pipelined(port, caps):
+    connection = irc.client.ServerConnection()
+    await connection.connect('127.0.0.1', port, 'benchmark', 'oauth:x',
+                             caps=caps)
+    await connection.welcomed_event.wait()
+    await connection.disconnect(timeout=0.01)
+
+
+def bench_welcome(args):
+    "CAP negotiation with round trips vs pipelined, at 20 ms latency"
+    caps = 'twitch.tv/tags twitch.tv/commands twitch.tv/membership'
+    loop = asyncio.new_event_loop()
+
+    async def run(register):
+        server = await start_registration_server(caps.split(), 0.02)
+        port = server.sockets[0].getsockname()[1]
+        best = float('inf')
+        for _ in range(args.repeat):
+            t1 = time.perf_counter()
+            await register(port, caps)
+            best = min(best, time.perf_counter() - t1)
+        server.close()
+        return best
+
+    try:
+        for name, register in [('round trips', register_round_trips),
+                               ('pipelined', register_pipelined)]:
+            elapsed = loop.run_until_complete(run(register))
+            print('%-28s %12.1f ms to welcome' % (name, 1000 * elapsed))
+    finally:
+        loop.close()
+
+
+async def rejoin_serially(connection, channels):
+    # What aiotwirc did after a disconnect: connect, then join each
+    # channel and wait for it
+    connection.joined_channels.clear()
+    await connection.connect('127.0.0.1', connection.port, 'benchmark')
+    await connection.welcomed_event.wait()
+    for channel in channels:
+        joins = await connection.join_many([channel])
+        await joins[channel]
+
+
+async def rejoin_with_reconnect(connection, channels):
+    joins = await connection.reconnect()
+    await asyncio.gather(*joins.values())
+
+
+def bench_rejoin(args):
+    "reconnecting and rejoining 100 channels, at 20 ms latency"
+    channels = ['#channel%d' % i for i in range(100)]
+    loop = asyncio.new_event_loop()
+
+    async def run(rejoin):
+        server = await start_registration_server([], 0.02)
+        port = server.sockets[0].getsockname()[1]
+        connection = irc.client.ServerConnection()
+        await connection.connect('127.0.0.1', port, 'benchmark')
+        await connection.welcomed_event.wait()
+        await asyncio.gather(*(await connection.join_many(channels)).values())
+        best = float('inf')
+        for _ in range(args.repeat):
+            await connection.disconnect(timeout=0.01)
+            t1 = time.perf_counter()
+            await rejoin(connection, channels)
+            best = min(best, time.perf_counter() - t1)
+            assert len(connection.joined_channels) == len(channels)
+        await connection.disconnect(timeout=0.01)
+        server.close()
+        return best
+
+    try:
+        for name, rejoin in [('connect, join one by one', rejoin_serially),
+                             ('reconnect()', rejoin_with_reconnect)]:
+            elapsed = loop.run_until_complete(run(rejoin))
+            print('%-28s %12.1f ms to rejoin' % (name, 1000 * elapsed))
+    finally:
+        loop.close()
+
+
+def run_flood_server(pipe, data):
+    """
+    In its own process, so that it does not compete with the client:
+    welcome each client, and send it `data` followed by ``PING :done``
+    when it sends ``PING go``. Sends the port over `pipe`.
+    """
+    async def serve(reader, writer):
+        async for line in reader:
+            if line.startswith(b'NICK '):
+                writer.write(b':srv 001 benchmark :Welcome\r\n')
+            elif line.startswith(b'PING go'):
+                writer.write(data)
+                writer.write(b'PING :done\r\n')
+                await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        pipe.send(server.sockets[0].getsockname()[1])
+        # Serve until told to stop
+        await asyncio.get_event_loop().run_in_executor(None, pipe.recv)
+        server.close()
+
+    asyncio.run(run())
+
+
+def flood(make_pool, count, data):
+    "Seconds until every connection of the pool handled `data`"
+    pipe, server_pipe = irc.workers.context.Pipe()
+    server = irc.workers.context.Process(
+        target=run_flood_server, args=(server_pipe, data))
+    server.start()
+    port = pipe.recv()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def run():
+        done = asyncio.Event()
+        finished = []
+
+        async def handler(connection, event):
+            if event.type == 'ping' and event.target == 'done':
+                finished.append(event)
+                if len(finished) == count:
+                    done.set()
+            else:
+                event.source, event.arguments, event.tags
+
+        pool = make_pool(count, handler)
+        await pool.connect('127.0.0.1', port, 'benchmark')
+        t1 = time.perf_counter()
+        for shard in pool.shards:
+            await shard.ping('go')
+        await done.wait()
+        elapsed = time.perf_counter() - t1
+        await pool.disconnect()
+        return elapsed
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+        pipe.send(None)
+        server.join()
+
+
+def bench_workers(args):
+    "in-process ConnectionPool vs workers.ProcessPool, per connection"
+    lines = twitch_corpus(args.lines)
+    data = b''.join(line + b'\r\n' for line in lines)
+    wanted = ['pubmsg', 'ping']
+
+    def in_process(count, handler):
+        return irc.pool.ConnectionPool(
+            count, handler, handler_wants=wanted.__contains__)
+
+    def processes(count, handler):
+        return irc.workers.ProcessPool(count, handler, event_types=wanted)
+
+    for name, make_pool in [('ConnectionPool', in_process),
+                            ('ProcessPool', processes)]:
+        for count in (1, 2, 4):
+            elapsed = min(flood(make_pool, count, data)
+                          for _ in range(args.repeat))
+            report('%s, %d' % (name, count), count * len(lines), elapsed,
+                   'lines')
+
+
+def split_reencode(texts, size=400):
+    # Grow each line a word at a time, encoding it to check the length
+    for text in texts:
+        chunks = []
+        line = ''
+        for word in text.split(' '):
+            candidate = line + ' ' + word if line else word
+            if line and len(candidate.encode('utf-8')) > size:
+                chunks.append(line.encode('utf-8'))
+                line = word
+            else:
+                line = candidate
+        chunks.append(line.encode('utf-8'))
+
+
+def split_bytes(texts, size=400):
+    split_utf8 = irc.message.split_utf8
+    for text in texts:
+        split_utf8(text.encode('utf-8'), size)
+
+
+def bench_split(args):
+    "re-encoding word by word vs message.split_utf8"
+    rng = random.Random(0)
+    words = WORDS + ['smörgåsbord', 'naïve', '日本語']
+    texts = [' '.join(rng.choice(words) for _ in range(300))
+             for _ in range(args.lines // 100)]
+    for name, fn in [('re-encode per word', split_reencode),
+                     ('message.split_utf8', split_bytes)]:
+        report(name, len(texts), timed(fn, texts, args.repeat), 'pastes')
+
+
+BENCHMARKS = [
+    ('parse', bench_parse),
+    ('events', bench_events),
+    ('tags', bench_tags),
+    ('read', bench_read),
+    ('transport', bench_transport),
+    ('subscribers', bench_subscribers),
+    ('send', bench_send),
+    ('split', bench_split),
+    ('prefix', bench_prefix),
+    ('welcome', bench_welcome),
+    ('rejoin', bench_rejoin),
+    ('workers', bench_workers),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--lines', type=int, default=100000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    for name, func in BENCHMARKS:
+        subparsers.add_parser(name, help=func.__doc__).set_defaults(func=func)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -95,12 +95,8 @@ class Handler:
         self.print_event(event)
 
     def handle_pubmsg(self, connection, event):
-        tags = {
-            k: v
-            for kv in (event.tags or ())
-            for k, v in [(kv['key'], kv['value'])]
-        }
-        name = tags.get('display-name') or event.source.split('!')[0]
+        tags = event.tags
+        name = tags.get('display-name') or event.source.nick
         args = ' '.join(event.arguments)
         now = datetime.datetime.now()
         now_str = now.isoformat()
@@ -143,8 +139,8 @@ def main():
         raise SystemExit(1)
     print("Connected")
 
-    c.handlers['welcome'] = [on_connect]
-    c.handlers['disconnect'] = [on_disconnect]
+    c.add_global_handler('welcome', on_connect)
+    c.add_global_handler('disconnect', on_disconnect)
     loop.run_until_complete(main_loop(c, handler))
 
 if __name__ == '__main__':
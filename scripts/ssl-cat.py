@@ -8,43 +8,43 @@
 # Jason R. Coombs <jaraco@jaraco.com>
 
 import sys
-import ssl
+import asyncio
 import argparse
-import itertools
 
 import irc.client
+import irc.connection
 
 target = None
 "The nick or channel to which to send messages"
 
-def on_connect(connection, event):
+async def on_connect(connection, event):
     if irc.client.is_channel(target):
-        connection.join(target)
+        await connection.join(target)
         return
-    main_loop(connection)
+    await main_loop(connection)
 
-def on_join(connection, event):
-    main_loop(connection)
+async def on_join(connection, event):
+    await main_loop(connection)
 
-def get_lines():
+async def main_loop(connection):
+    loop = asyncio.get_event_loop()
     while True:
-        yield sys.stdin.readline().strip()
-
-def main_loop(connection):
-    for line in itertools.takewhile(bool, get_lines()):
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        line = line.strip()
+        if not line:
+            break
         print(line)
-        connection.privmsg(target, line)
-    connection.quit("Using irc.client.py")
-
-def on_disconnect(connection, event):
-    raise SystemExit()
+        await connection.privmsg(target, line)
+    await connection.quit("Using irc.client.py")
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('server')
     parser.add_argument('nickname')
     parser.add_argument('target', help="a nickname or channel")
-    parser.add_argument('-p', '--port', default=6667, type=int)
+    parser.add_argument('-p', '--port', default=6697, type=int)
+    parser.add_argument('--insecure', action='store_true',
+                        help="don't verify the server's certificate")
     return parser.parse_args()
 
 def main():
@@ -53,24 +53,22 @@ def main():
     args = get_args()
     target = args.target
 
-    ssl_factory = irc.connection.Factory(wrapper=ssl.wrap_socket)
-    reactor = irc.client.Reactor()
+    loop = asyncio.get_event_loop()
+    c = irc.client.ServerConnection(loop=loop)
+    c.add_global_handler("welcome", on_connect)
+    c.add_global_handler("join", on_join)
     try:
-        c = reactor.server().connect(
+        loop.run_until_complete(c.connect(
             args.server,
             args.port,
             args.nickname,
-            connect_factory=ssl_factory,
-        )
+            ssl=irc.connection.tls_context(verify=not args.insecure),
+        ))
     except irc.client.ServerConnectionError:
         print(sys.exc_info()[1])
         raise SystemExit(1)
 
-    c.add_global_handler("welcome", on_connect)
-    c.add_global_handler("join", on_join)
-    c.add_global_handler("disconnect", on_disconnect)
-
-    reactor.process_forever()
+    loop.run_until_complete(c.wait_disconnected())
 
 if __name__ == '__main__':
     main()